@@ -9,9 +9,8 @@ import json
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from google.oauth2 import service_account
-from google.cloud import bigquery
 import pandas_gbq
+from bq_client import get_credentials, get_bigquery_client
 
 # Import VALD API helpers
 from VALDapiHelpers import get_access_token, get_profiles, FD_Tests_by_Profile, get_FD_results
@@ -21,7 +20,6 @@ import uuid
 PROJECT_ID = "vald-ref-data"
 DATASET_ID = "athlete_performance_db"
 TABLE_ID = "cmj_results"
-CREDENTIALS_FILE = 'gcp_credentials.json'
 JAMES_ATHLETE_ID = "0000004"
 
 def process_cmj_test(results_df, athlete_id, athlete_name, test_date, test_id, assessment_id):
@@ -106,8 +104,8 @@ def process_cmj_test(results_df, athlete_id, athlete_name, test_date, test_id, a
 def setup_bigquery():
     """Setup BigQuery client"""
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+        credentials = get_credentials()
+        bq_client = get_bigquery_client(PROJECT_ID)
         print("BigQuery client setup successful")
         return bq_client, credentials
     except Exception as e:
@@ -10,9 +10,8 @@ import pandas as pd
 import numpy as np
 import uuid
 from datetime import datetime, timedelta
-from google.oauth2 import service_account
-from google.cloud import bigquery
 import pandas_gbq
+from bq_client import get_credentials, get_bigquery_client
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 import logging
@@ -25,7 +24,6 @@ from newcompositescore import calculate_composite_score_per_trial, get_best_tria
 PROJECT_ID = "vald-ref-data"
 DATASET_ID = "athlete_performance_db"
 TABLE_ID = "cmj_results"
-CREDENTIALS_FILE = 'gcp_credentials.json'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
@@ -358,8 +356,8 @@ def main():
     
     try:
         # Setup BigQuery
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+        credentials = get_credentials()
+        bq_client = get_bigquery_client(PROJECT_ID)
         print("BigQuery client setup successful")
         
         # Get VALD API token
@@ -0,0 +1,145 @@
+"""
+In-memory directory of the BigQuery athletes table (profileId -> athlete_ID).
+Loads the whole mapping with one query, then refreshes incrementally: athlete_IDs
+are zero-padded sequential numbers, so a refresh only asks for rows above the
+highest athlete_ID already held. Lookups are plain dict reads, safe from worker
+threads; a miss triggers at most one incremental refresh per MISS_REFRESH_INTERVAL.
+Shared by the CMJ pipeline, process_athletes.py and the automation server.
+"""
+
+import time
+import logging
+import threading
+
+from bq_client import get_bigquery_client
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+PROJECT_ID = 'vald-ref-data'
+DATASET_ID = 'athlete_performance_db'
+ATHLETES_TABLE_ID = 'athletes'
+REFRESH_INTERVAL = 600  # Seconds before a lookup triggers a routine incremental refresh
+MISS_REFRESH_INTERVAL = 30  # Minimum seconds between refreshes triggered by unknown profiles
+
+log = logging.getLogger(__name__)
+
+
+def format_athlete_id(n):
+    """Zero-padded athlete_ID, e.g. 42 -> '0000042'."""
+    return f"{n:07d}"
+
+
+class AthleteDirectory:
+    """profileId -> athlete_ID index over the athletes table."""
+
+    def __init__(self, table=f"{PROJECT_ID}.{DATASET_ID}.{ATHLETES_TABLE_ID}"):
+        self.table = table
+        self._ids = {}
+        self._max_id = None
+        self._loaded = False
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def client(self):
+        return get_bigquery_client(PROJECT_ID)
+
+    def _query(self, where=""):
+        query = f"SELECT athlete_ID, profileId FROM `{self.table}` {where}"
+        return self.client.query(query).to_dataframe()
+
+    def _merge(self, rows):
+        for athlete_id, profile_id in zip(rows['athlete_ID'], rows['profileId']):
+            if athlete_id is None or profile_id is None:
+                continue
+            self._ids[str(profile_id)] = athlete_id
+            if self._max_id is None or athlete_id > self._max_id:
+                self._max_id = athlete_id
+
+    def load(self):
+        """Load the full mapping (one query). Raises on BigQuery errors."""
+        rows = self._query()
+        with self._lock:
+            self._ids = {}
+            self._max_id = None
+            self._merge(rows)
+            self._loaded = True
+            self._refreshed_at = time.monotonic()
+        log.info(f"Loaded {len(self._ids)} athletes from {self.table}")
+        return self
+
+    def refresh(self):
+        """Fetch only athletes added since the last load/refresh. Returns the number of new rows."""
+        if not self._loaded:
+            self.load()
+            return len(self._ids)
+        where = f"WHERE athlete_ID > '{self._max_id}'" if self._max_id is not None else ""
+        rows = self._query(where)
+        with self._lock:
+            self._merge(rows)
+            self._refreshed_at = time.monotonic()
+        if len(rows):
+            log.info(f"Added {len(rows)} athletes to the directory")
+        return len(rows)
+
+    def _is_stale(self, profile_id):
+        since_refresh = time.monotonic() - self._refreshed_at
+        if not self._loaded:
+            # Never loaded, or the last attempt failed: retry at the miss cadence
+            return self._refreshed_at == 0.0 or since_refresh >= MISS_REFRESH_INTERVAL
+        if profile_id not in self._ids:
+            return since_refresh >= MISS_REFRESH_INTERVAL
+        return since_refresh >= REFRESH_INTERVAL
+
+    def get(self, profile_id):
+        """
+        Look up a profile's athlete_ID.
+
+        Returns:
+            athlete_ID string, or None when the profile is not in the athletes table
+        """
+        profile_id = str(profile_id)
+        if not self._is_stale(profile_id):
+            return self._ids.get(profile_id)
+        # One refresh at a time; threads that waited re-check before querying again
+        with self._refresh_lock:
+            if self._is_stale(profile_id):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.error(f"Error refreshing athlete directory: {e}")
+                    self._refreshed_at = time.monotonic()
+        athlete_id = self._ids.get(profile_id)
+        if athlete_id is None:
+            log.warning(f"No athlete_ID found for profileId: {profile_id}")
+        return athlete_id
+
+    def __contains__(self, profile_id):
+        return str(profile_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, profile_id, athlete_id):
+        """Record an athlete just inserted into the table."""
+        with self._lock:
+            self._merge({'athlete_ID': [athlete_id], 'profileId': [profile_id]})
+
+    def next_id(self):
+        """The athlete_ID the next inserted athlete should get."""
+        return format_athlete_id(int(self._max_id) + 1 if self._max_id is not None else 1)
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_athlete_directory():
+    """Process-wide AthleteDirectory (loaded on first lookup)."""
+    global _directory
+    with _directory_lock:
+        if _directory is None:
+            _directory = AthleteDirectory()
+        return _directory
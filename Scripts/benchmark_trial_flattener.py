@@ -0,0 +1,109 @@
+"""
+Benchmark: columnar trial flattener vs the previous pandas flattening path.
+Builds synthetic /trials responses shaped like ForceDecks CMJ tests (or loads a
+saved response with --json), checks both paths produce the same metric x trial
+matrix, and prints per-test timings.
+
+Usage:
+    python benchmark_trial_flattener.py [--tests 2000] [--trials 6] [--metrics 120] [--json saved_trials.json]
+"""
+
+import time
+import json
+import random
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from trial_flattener import flatten_trials, UNIT_MAP
+
+
+def legacy_flatten(test_data):
+    """The per-result dict -> DataFrame -> cumcount -> pivot path get_FD_results used before."""
+    all_results = []
+    for trial in test_data:
+        for res in trial.get("results", []):
+            all_results.append({
+                "resultId": res.get("resultId"),
+                "value": res.get("value"),
+                "time": res.get("time"),
+                "limb": res.get("limb"),
+                "repeat": res.get("repeat"),
+                "definition_id": res["definition"].get("id"),
+                "result_key": res["definition"].get("result"),
+                "description": res["definition"].get("description"),
+                "name": res["definition"].get("name"),
+                "unit": res["definition"].get("unit"),
+                "repeatable": res["definition"].get("repeatable"),
+                "asymmetry": res["definition"].get("asymmetry"),
+            })
+    df = pd.DataFrame(all_results)
+    df['unit'] = df['unit'].apply(lambda unit: UNIT_MAP.get(unit, unit))
+    df['metric_id'] = (df['result_key'].astype(str) + '_' + df['limb'].astype(str) + '_' + df['unit'])
+    df['metric_id'] = df['metric_id'].str.replace('/', '_', regex=False)
+    df['metric_id'] = df['metric_id'].str.rstrip('_')
+    df['trial'] = df.groupby('metric_id').cumcount() + 1
+    pivot = df.pivot(index='metric_id', columns='trial', values='value')
+    pivot.columns = [f'trial {c}' for c in pivot.columns]
+    return pivot.reset_index()
+
+
+def synthetic_test(n_trials, n_metrics, rng):
+    """One fake /trials response: n_trials trials, each reporting n_metrics results."""
+    units = list(UNIT_MAP)
+    limbs = ['Trial', 'Left', 'Right', 'Asym']
+    definitions = [
+        {"id": i, "result": f"METRIC_{i}", "unit": units[i % len(units)], "description": "", "name": f"Metric {i}",
+         "repeatable": False, "asymmetry": False}
+        for i in range(n_metrics)
+    ]
+    trials = []
+    for t in range(n_trials):
+        results = [
+            {"resultId": i, "value": rng.random() * 1000, "time": 0, "limb": limbs[i % len(limbs)], "repeat": 0,
+             "definition": definitions[i]}
+            for i in range(n_metrics)
+        ]
+        trials.append({"id": f"trial-{t}", "results": results})
+    return trials
+
+
+def time_path(fn, tests):
+    start = time.perf_counter()
+    outputs = [fn(test) for test in tests]
+    return time.perf_counter() - start, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tests', type=int, default=2000)
+    parser.add_argument('--trials', type=int, default=6)
+    parser.add_argument('--metrics', type=int, default=120)
+    parser.add_argument('--json', help='Saved /trials response to replicate instead of synthetic data')
+    args = parser.parse_args()
+
+    if args.json:
+        with open(args.json) as f:
+            tests = [json.load(f)] * args.tests
+    else:
+        rng = random.Random(42)
+        tests = [synthetic_test(args.trials, args.metrics, rng) for _ in range(args.tests)]
+
+    legacy_time, legacy_out = time_path(legacy_flatten, tests)
+    new_time, new_out = time_path(flatten_trials, tests)
+
+    for old, new in zip(legacy_out, new_out):
+        assert list(old['metric_id']) == list(new['metric_id']), "metric ids differ"
+        assert list(old.columns) == list(new.columns), "trial columns differ"
+        np.testing.assert_allclose(old.drop(columns='metric_id').to_numpy(dtype=float),
+                                   new.drop(columns='metric_id').to_numpy(dtype=float), equal_nan=True)
+
+    print(f"{len(tests)} tests, {sum(len(t) for t in tests[:1])} trials/test")
+    print(f"pandas path:   {legacy_time:.3f}s ({legacy_time / len(tests) * 1000:.3f} ms/test)")
+    print(f"columnar path: {new_time:.3f}s ({new_time / len(tests) * 1000:.3f} ms/test)")
+    print(f"speed-up:      {legacy_time / new_time:.1f}x (outputs identical)")
+
+
+if __name__ == "__main__":
+    main()
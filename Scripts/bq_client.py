@@ -0,0 +1,129 @@
+"""
+Shared BigQuery access for every script.
+Service-account credentials are read from CREDENTIALS_FILE once per process and
+one bigquery.Client is built per project, lazily and behind a lock; the client
+(and its pooled HTTP session) is then reused by every upload, query and load job,
+including pandas_gbq calls through get_credentials(). Replaces building
+credentials and a client inside each function call.
+
+write_results() is the shared results-table upload. In the default 'merge' mode
+rows are loaded into a short-lived staging table and MERGEd into the target on
+result_id, which result_id_for() derives from the test type and VALD testId, so
+re-syncs and retries update rows in place instead of appending duplicates.
+"""
+
+import os
+import uuid
+import logging
+import threading
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+CREDENTIALS_FILE = os.getenv("GCP_CREDENTIALS_PATH", "gcp_credentials.json")
+PROJECT_ID = "vald-ref-data"
+DATASET_ID = "athlete_performance_db"
+UPLOAD_MODE = os.getenv("BQ_UPLOAD_MODE", "merge")  # 'merge' (upsert on result_id) or 'append'
+RESULT_ID_NAMESPACE = uuid.UUID("6f1c2a4e-9b7d-4e1a-8c35-2d0f7a9e5b13")  # Never change: existing result_ids derive from it
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_credentials = None
+_clients = {}
+
+
+def get_credentials():
+    """Service-account credentials, loaded from CREDENTIALS_FILE on first use. Raises if the file is unusable."""
+    global _credentials
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                _credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
+    return _credentials
+
+
+def get_bigquery_client(project=PROJECT_ID):
+    """The process-wide bigquery.Client for a project (thread-safe; built on first use)."""
+    client = _clients.get(project)
+    if client is None:
+        credentials = get_credentials()
+        with _lock:
+            client = _clients.get(project)
+            if client is None:
+                client = _clients[project] = bigquery.Client(credentials=credentials, project=project)
+    return client
+
+
+def table_path(table_name, dataset=DATASET_ID, project=PROJECT_ID):
+    """Fully qualified 'project.dataset.table' id."""
+    return f"{project}.{dataset}.{table_name}"
+
+
+def result_id_for(test_type, test_id):
+    """Deterministic result_id for one test's row, e.g. result_id_for('CMJ', testId)."""
+    return str(uuid.uuid5(RESULT_ID_NAMESPACE, f"{test_type}:{test_id}"))
+
+
+def write_results(df, table_name, key="result_id", mode=None, dataset=DATASET_ID, table_schema=None):
+    """
+    Write rows to a results table.
+
+    Args:
+        df: Rows to write; columns the table does not have are dropped
+        table_name: Table in the dataset, e.g. 'cmj_results'
+        key: Column the MERGE matches on
+        mode: 'merge' (stage + MERGE, idempotent) or 'append'; defaults to UPLOAD_MODE
+        table_schema: [{'name', 'type'}] used only when the table does not exist yet
+
+    Returns:
+        Number of rows written. Raises on BigQuery errors.
+    """
+    mode = mode or UPLOAD_MODE
+    client = get_bigquery_client()
+    target = table_path(table_name, dataset)
+    try:
+        schema = client.get_table(target).schema
+    except NotFound:
+        # First write creates the table; there is nothing to merge into yet
+        schema, mode = None, "append"
+    if schema is not None:
+        df = df[[field.name for field in schema if field.name in df.columns]]
+    if df.empty:
+        return 0
+    if mode == "append":
+        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
+        if schema is None and table_schema:
+            job_config.schema = [bigquery.SchemaField(field['name'], field['type']) for field in table_schema]
+        client.load_table_from_dataframe(df, target, job_config=job_config).result()
+        return len(df)
+
+    # MERGE needs at most one source row per key; the latest record for a test wins
+    df = df.drop_duplicates(subset=[key], keep="last")
+    staging = table_path(f"{table_name}__staging_{uuid.uuid4().hex[:12]}", dataset)
+    columns = list(df.columns)
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_TRUNCATE",
+        schema=[field for field in schema if field.name in columns],
+    )
+    try:
+        client.load_table_from_dataframe(df, staging, job_config=job_config).result()
+        updates = ", ".join(f"T.`{col}` = S.`{col}`" for col in columns if col != key)
+        column_list = ", ".join(f"`{col}`" for col in columns)
+        source_list = ", ".join(f"S.`{col}`" for col in columns)
+        merge_sql = f"""
+        MERGE `{target}` T
+        USING `{staging}` S
+        ON T.`{key}` = S.`{key}`
+        WHEN MATCHED THEN UPDATE SET {updates}
+        WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES ({source_list})
+        """
+        client.query(merge_sql).result()
+    finally:
+        client.delete_table(staging, not_found_ok=True)
+    log.info(f"Merged {len(df)} rows into {target}")
+    return len(df)
@@ -0,0 +1,168 @@
+"""
+Background micro-batch writer for BigQuery results tables.
+Pipelines put one record per test on a bounded queue as soon as it is built; a
+writer thread flushes to the table (bq_client.write_results, so MERGE on result_id
+by default) every MAX_BATCH_ROWS records or MAX_BATCH_SECONDS, whichever comes first. Memory stays bounded (put() blocks
+when the queue is full) and a crash loses at most the unflushed batch.
+
+An on_flush callback hears about every batch outcome, so callers keep their
+per-test progress in job_state.py: a re-run after a crash skips the tests whose
+batch was acknowledged, so the resume is exact even though the sync watermark
+did not advance.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+import pandas as pd
+from bq_client import write_results
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+MAX_BATCH_ROWS = 500  # Flush once this many records are waiting
+MAX_BATCH_SECONDS = 30  # ...or once the oldest waiting record is this old
+QUEUE_SIZE = 2000  # Records buffered before put() blocks the producer
+MAX_ATTEMPTS = 3  # Write attempts per batch
+BACKOFF_BASE = 2.0  # Seconds; doubled on every retry
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Queue-fed writer thread that writes micro-batches to one BigQuery table.
+
+    Use as a context manager (or start()/close()): records put() before close() are
+    all flushed, or reported in failed_ids(), by the time it returns.
+    """
+
+    def __init__(self, table_name, prepare=None, on_flush=None, max_rows=MAX_BATCH_ROWS,
+                 max_seconds=MAX_BATCH_SECONDS, queue_size=QUEUE_SIZE):
+        """
+        Args:
+            table_name: Results table in the default dataset, e.g. 'cmj_results'
+            prepare: Callable turning a list of records into the DataFrame to load
+                (defaults to concatenating one-row DataFrames / building from dicts)
+            on_flush: Called from the writer thread as on_flush(test_ids, error) after each
+                batch; error is None when the batch was acknowledged
+        """
+        self.table_name = table_name
+        self.prepare = prepare or _records_to_frame
+        self.on_flush = on_flush
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name=f"bq-writer-{table_name}", daemon=True)
+        self._failed = set()
+        self.rows_written = 0
+        self.batches_written = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def start(self):
+        """Start the writer thread (the context manager does this for you)."""
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def put(self, test_id, modified_date, record):
+        """Queue one test's record; blocks while the queue is full."""
+        self._queue.put((test_id, modified_date, record))
+
+    def close(self):
+        """Flush what is queued and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def failed_ids(self):
+        """testIds whose batch could not be loaded; retry them next run."""
+        return set(self._failed)
+
+    def summary(self):
+        return {"rows": self.rows_written, "batches": self.batches_written, "failed": len(self._failed)}
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush_safely(batch)
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.max_seconds
+                batch.append(item)
+            if batch and (len(batch) >= self.max_rows or time.monotonic() >= deadline):
+                self._flush_safely(batch)
+                batch = []
+
+    def _flush_safely(self, batch):
+        """Flush one batch; an unexpected error fails that batch only and keeps the writer thread alive."""
+        try:
+            self._flush(batch)
+        except Exception as e:
+            log.exception(f"Unexpected error flushing a {len(batch)}-row batch to {self.table_name}: {e}")
+            test_ids = [test_id for test_id, _, _ in batch]
+            self._failed.update(test_ids)
+            self._notify([(test_id, None) for test_id in test_ids], e)
+
+    def _flush(self, batch):
+        """Load one batch with retries and report the outcome to on_flush; failed batches are remembered by testId."""
+        if not batch:
+            return
+        keys = [(test_id, modified) for test_id, modified, _ in batch]
+        try:
+            df = self.prepare([record for _, _, record in batch])
+        except Exception as e:
+            log.error(f"Could not prepare a {len(batch)}-row batch for {self.table_name}: {e}")
+            self._failed.update(test_id for test_id, _ in keys)
+            self._notify(keys, e)
+            return
+        if df is None or df.empty:
+            self._notify(keys, None)
+            return
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                write_results(df, self.table_name)
+                break
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    log.error(f"Batch of {len(df)} rows to {self.table_name} failed after {MAX_ATTEMPTS} attempts: {e}")
+                    self._failed.update(test_id for test_id, _ in keys)
+                    self._notify(keys, e)
+                    return
+                wait_time = BACKOFF_BASE * (2 ** attempt)
+                log.warning(f"Batch load to {self.table_name} failed: {e}. Retrying in {wait_time:.1f}s...")
+                time.sleep(wait_time)
+        self.rows_written += len(df)
+        self.batches_written += 1
+        log.info(f"Loaded {len(df)} rows into {self.table_name} (batch {self.batches_written})")
+        self._notify(keys, None)
+
+    def _notify(self, keys, error):
+        if self.on_flush is None:
+            return
+        try:
+            self.on_flush([test_id for test_id, _ in keys], error)
+        except Exception as e:
+            log.error(f"on_flush callback failed for {self.table_name}: {e}")
+
+
+def _records_to_frame(records):
+    if records and isinstance(records[0], pd.DataFrame):
+        return pd.concat(records, ignore_index=True)
+    return pd.DataFrame(records)
@@ -11,15 +11,13 @@ import uuid
 import json
 
 import pandas_gbq
-from google.oauth2 import service_account
-from google.cloud import bigquery
+from bq_client import get_credentials, get_bigquery_client, CREDENTIALS_FILE
 
 # =================================================================================
 # CONFIGURATION - Make sure to set your new Project ID here
 # =================================================================================
 PROJECT_ID = "vald-ref-data"
 DATASET_ID = "athlete_performance_db"
-CREDENTIALS_FILE = 'gcp_credentials.json'
 
 # =================================================================================
 # LOAD CREDENTIALS
@@ -29,8 +27,8 @@ try:
         creds_json = json.load(f)
         print(f"Attempting to use credentials for: {creds_json.get('client_email')}")
 
-    credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-    bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    credentials = get_credentials()
+    bq_client = get_bigquery_client(PROJECT_ID)
     print("Successfully loaded GCP credentials and BigQuery client.")
 except Exception as e:
     print(f"ERROR: Could not load credentials. {e}")
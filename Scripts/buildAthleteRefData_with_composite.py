@@ -11,12 +11,10 @@ import uuid
 from datetime import datetime
 from VALDapiHelpers import get_access_token, get_profiles, FD_Tests_by_Profile, get_FD_results
 import pandas_gbq
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from bq_client import get_credentials
 from CompositeScore import calculate_composite_score
 
 # Configuration
-CREDENTIALS_FILE = 'gcp_credentials.json'
 PROJECT_ID = 'your-project-id'  # Replace with your actual project ID
 DATASET_ID = 'vald_data'
 
@@ -51,7 +49,7 @@ METRICS_OF_INTEREST = {
 def upload_to_bigquery(df, table_name, table_schema=None):
     """Upload DataFrame to BigQuery with proper error handling."""
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
+        credentials = get_credentials()
         pandas_gbq.to_gbq(
             df,
             destination_table=f"{DATASET_ID}.{table_name}",
@@ -0,0 +1,392 @@
+"""
+Incremental global statistics for CMJ composite scoring.
+Keeps running per-metric mean/variance (Welford's algorithm, merged a test at a
+time) over every CMJ trial ingested so far, plus the composite-score range used
+for the 50-100 normalization, and persists them between runs. A pipeline loads
+the saved state at startup and only feeds it the trials of newly synced tests,
+instead of re-fetching the tenant's whole CMJ history and holding every pivot in
+memory to recompute mean/std.
+
+On every save the scoring inputs (means, stds, score range) are also published as
+a versioned snapshot (SNAPSHOT_FILE, with created_at and sample size). The
+automation server keeps the latest snapshot in memory (get_stats_snapshot) and
+hot-reloads it when the batch pipeline publishes a new version.
+
+Outliers: once every metric has WARMUP_TRIALS samples, a trial with any metric
+more than OUTLIER_SIGMA standard deviations from the running mean is rejected
+(the streaming counterpart of the old 3-sigma filter over the full frame). As in
+that filter, trials missing any composite metric are not counted.
+
+Every counted testId is recorded in a sqlite file next to the state file
+(seen_path), so a test is counted once however often it is fed in: by the
+bootstrap pass and again by the same run's processing (watermarks still at the
+start date), by a retry, or after the watermarks were reset. Ids counted since
+the last save are held in memory and written to the file by save(), so the file
+never claims tests whose moments were not saved. Lookups are indexed and the
+JSON state stays small.
+"""
+
+import os
+import json
+import sqlite3
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from filelock import FileLock
+
+from newcompositescore import CMJ_weights, score_trials_batch
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+STATS_FILE = os.getenv("CMJ_STATS_PATH", ".cmj_stats.json")
+OUTLIER_SIGMA = 3.0  # Trials further than this from the running mean are not counted
+WARMUP_TRIALS = 30  # Trials accepted unfiltered before the outlier check starts
+SNAPSHOT_FILE = os.getenv("CMJ_STATS_SNAPSHOT_PATH", "cmj_stats_snapshot.json")
+SNAPSHOT_CHECK_INTERVAL = 30  # Seconds between checks for a newer snapshot
+
+log = logging.getLogger(__name__)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def normalize_scores(scores, score_min, score_max):
+    """Map raw composite scores (Series) onto 50-100 given the score range; 100 when the range is empty."""
+    if score_min is None or score_max is None or score_max == score_min:
+        return pd.Series(100.0, index=scores.index)
+    return 50 + (scores - score_min) / (score_max - score_min) * 50
+
+
+class CMJStats:
+    """Running per-metric moments and composite-score bounds, persisted as JSON."""
+
+    def __init__(self, metrics=None, path=STATS_FILE):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.metrics = list(metrics) if metrics is not None else list(CMJ_weights.keys())
+        self.count = 0
+        self.mean = np.zeros(len(self.metrics))
+        self.m2 = np.zeros(len(self.metrics))
+        self.rejected = 0
+        self.score_min = None
+        self.score_max = None
+        self.tests = 0  # Tests counted in total
+        self.seen_path = f"{os.path.splitext(path)[0]}_seen.sqlite"
+        self.updated_at = None
+        self._pending_tests = set()  # Counted since the last save, not yet in seen_path
+        self._lock = threading.Lock()
+        self._seen = sqlite3.connect(self.seen_path, check_same_thread=False, isolation_level=None)
+        self._seen.execute("PRAGMA journal_mode=WAL")
+        self._seen.execute("CREATE TABLE IF NOT EXISTS seen_tests (test_id TEXT PRIMARY KEY)")
+
+    # -----------------------------------------------------------------------------
+    # Persistence
+    # -----------------------------------------------------------------------------
+    @classmethod
+    def load(cls, path=STATS_FILE):
+        """Load saved stats, or return an empty instance when there is no (usable) state file."""
+        stats = cls(path=path)
+        state = _read_json(path)
+        if state is None:
+            stats._forget_seen()
+            return stats
+        if state.get("metrics") != stats.metrics:
+            log.warning(f"CMJ stats in {path} were built for a different metric set; starting over")
+            stats._forget_seen()
+            return stats
+        stats.count = state["count"]
+        stats.mean = np.asarray(state["mean"], dtype=float)
+        stats.m2 = np.asarray(state["m2"], dtype=float)
+        stats.rejected = state.get("rejected", 0)
+        stats.score_min = state.get("score_min")
+        stats.score_max = state.get("score_max")
+        legacy_seen = state.get("seen_tests", ())  # State files from before seen_path existed
+        if legacy_seen:
+            stats._seen.executemany("INSERT OR IGNORE INTO seen_tests (test_id) VALUES (?)",
+                                    [(str(test_id),) for test_id in legacy_seen])
+        stats.tests = state.get("tests", len(legacy_seen))
+        stats.updated_at = state.get("updated_at")
+        return stats
+
+    def save(self):
+        """Write the state file atomically and publish the matching snapshot."""
+        with self._lock:
+            self.updated_at = datetime.now(timezone.utc).isoformat()
+            state = {
+                "metrics": self.metrics,
+                "count": self.count,
+                "mean": self.mean.tolist(),
+                "m2": self.m2.tolist(),
+                "rejected": self.rejected,
+                "score_min": self.score_min,
+                "score_max": self.score_max,
+                "tests": self.tests,
+                "updated_at": self.updated_at,
+            }
+            pending = list(self._pending_tests)
+        with FileLock(self.lock_path, timeout=10):
+            # Seen ids first: a crash in between leaves tests uncounted, never counted twice
+            with self._lock:
+                self._seen.executemany("INSERT OR IGNORE INTO seen_tests (test_id) VALUES (?)",
+                                       [(test_id,) for test_id in pending])
+                self._pending_tests.difference_update(pending)
+            _write_json(self.path, state)
+        log.info(f"Saved CMJ stats ({self.count} trials) to {self.path}")
+        self.publish_snapshot()
+
+    def publish_snapshot(self, path=SNAPSHOT_FILE):
+        """Write the scoring inputs as the next snapshot version. Returns the version, or None when there is nothing to publish."""
+        means, stds = self.means(), self.stds()
+        if means is None or stds is None:
+            return None
+        with FileLock(f"{path}.lock", timeout=10):
+            previous = _read_json(path)
+            version = (previous or {}).get("version", 0) + 1
+            _write_json(path, {
+                "version": version,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "sample_size": self.count,
+                "tests": self.tests,
+                "means": means.to_dict(),
+                "stds": stds.to_dict(),
+                "score_min": self.score_min,
+                "score_max": self.score_max,
+            })
+        log.info(f"Published CMJ stats snapshot v{version} to {path}")
+        return version
+
+    # -----------------------------------------------------------------------------
+    # Updates
+    # -----------------------------------------------------------------------------
+    @property
+    def is_empty(self):
+        return self.count == 0
+
+    def trial_matrix(self, raw_data):
+        """(n_trials, n_metrics) matrix of the composite metrics from a get_FD_results-style DataFrame."""
+        if raw_data is None or raw_data.empty or 'metric_id' not in raw_data:
+            return None
+        trial_cols = [col for col in raw_data.columns if 'trial' in col.lower()]
+        if not trial_cols:
+            return None
+        cmj_data = raw_data[raw_data['metric_id'].isin(self.metrics)].drop_duplicates('metric_id')
+        if cmj_data.empty:
+            return None
+        pivot = cmj_data.set_index('metric_id')[trial_cols].reindex(self.metrics)
+        return pivot.to_numpy(dtype=float).T
+
+    def update(self, values):
+        """
+        Merge a block of trials into the running moments.
+
+        Args:
+            values: Array of shape (n_trials, n_metrics), columns in self.metrics order
+
+        Returns:
+            Number of trials counted
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values).any(axis=1)]
+        if values.size == 0:
+            return 0
+        with self._lock:
+            if self.count >= WARMUP_TRIALS:
+                std = np.sqrt(self.m2 / (self.count - 1))
+                inliers = (np.abs(values - self.mean) <= OUTLIER_SIGMA * std).all(axis=1)
+                self.rejected += int((~inliers).sum())
+                values = values[inliers]
+                if values.size == 0:
+                    return 0
+            # Chan et al. pairwise merge of the block into the running (count, mean, M2)
+            n_b = len(values)
+            mean_b = values.mean(axis=0)
+            m2_b = ((values - mean_b) ** 2).sum(axis=0)
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * n_b / n
+            self.m2 = self.m2 + m2_b + delta ** 2 * self.count * n_b / n
+            self.count = n
+        return n_b
+
+    def _is_seen(self, test_id):
+        return self._seen.execute("SELECT 1 FROM seen_tests WHERE test_id = ?", (test_id,)).fetchone() is not None
+
+    def _forget_seen(self):
+        """Start the seen record over along with the moments (no usable state file)."""
+        self._seen.execute("DELETE FROM seen_tests")
+
+    def update_from_raw(self, test_id, raw_data):
+        """Count one test's trials (a test already counted is ignored). Returns the number of trials counted."""
+        with self._lock:
+            test_id = str(test_id)
+            if test_id in self._pending_tests or self._is_seen(test_id):
+                return 0
+            self._pending_tests.add(test_id)
+            self.tests += 1
+        values = self.trial_matrix(raw_data)
+        if values is None:
+            return 0
+        return self.update(values)
+
+    def fit_score_bounds(self, trial_matrices):
+        """
+        Set the composite-score range from the best-trial scores of a set of tests.
+
+        Used when bootstrapping, so the first run normalizes every batch against the
+        same range instead of one that grows as results stream in.
+
+        Args:
+            trial_matrices: Iterable of (n_trials, n_metrics) arrays as returned by trial_matrix()
+        """
+        means, stds = self.means(), self.stds()
+        matrices = [m for m in trial_matrices if m is not None and len(m)]
+        if means is None or stds is None or not matrices:
+            return
+        values = np.full((len(matrices), max(len(m) for m in matrices), len(self.metrics)), np.nan)
+        for i, matrix in enumerate(matrices):
+            values[i, :len(matrix)] = matrix
+        weights = {metric: CMJ_weights.get(metric, 0.0) for metric in self.metrics}
+        _, _, best_scores = score_trials_batch(values, means, stds, weights)
+        with self._lock:
+            self.score_min = self.score_max = None
+        self.update_score_bounds(best_scores)
+
+    def update_score_bounds(self, scores):
+        """Widen the composite-score range with this run's raw scores."""
+        scores = pd.Series(scores, dtype=float).dropna()
+        if scores.empty:
+            return
+        with self._lock:
+            low, high = float(scores.min()), float(scores.max())
+            self.score_min = low if self.score_min is None else min(self.score_min, low)
+            self.score_max = high if self.score_max is None else max(self.score_max, high)
+
+    # -----------------------------------------------------------------------------
+    # Reads
+    # -----------------------------------------------------------------------------
+    def means(self):
+        """Per-metric means as a Series, or None before any trial was counted."""
+        if self.count == 0:
+            return None
+        return pd.Series(self.mean, index=self.metrics)
+
+    def stds(self):
+        """Per-metric sample standard deviations (ddof=1, as pandas), or None with fewer than two trials."""
+        if self.count < 2:
+            return None
+        return pd.Series(np.sqrt(self.m2 / (self.count - 1)), index=self.metrics)
+
+    def normalize_scores(self, scores):
+        """Map raw composite scores onto 50-100 using the persisted score range."""
+        return normalize_scores(scores, self.score_min, self.score_max)
+
+    def summary(self):
+        return {"trials": self.count, "rejected": self.rejected, "tests": self.tests,
+                "score_range": (self.score_min, self.score_max), "updated_at": self.updated_at}
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_cmj_stats():
+    """Process-wide CMJStats, loaded from STATS_FILE on first use."""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = CMJStats.load()
+        return _stats
+
+
+# =================================================================================
+# Published snapshots (read side, used by the automation server)
+# =================================================================================
+class StatsSnapshot:
+    """One published version of the CMJ scoring inputs."""
+
+    __slots__ = ("version", "created_at", "sample_size", "means", "stds", "score_min", "score_max")
+
+    def __init__(self, data):
+        self.version = data["version"]
+        self.created_at = data["created_at"]
+        self.sample_size = data["sample_size"]
+        self.means = pd.Series(data["means"], dtype=float)
+        self.stds = pd.Series(data["stds"], dtype=float)
+        self.score_min = data.get("score_min")
+        self.score_max = data.get("score_max")
+
+    def normalize_score(self, score):
+        """Map one raw composite score onto the 50-100 scale the batch pipeline uploads."""
+        return float(normalize_scores(pd.Series([score], dtype=float), self.score_min, self.score_max).iloc[0])
+
+    def info(self):
+        return {"version": self.version, "created_at": self.created_at, "sample_size": self.sample_size}
+
+
+class SnapshotLoader:
+    """Keeps the latest snapshot in memory; re-reads the file only when its mtime changes."""
+
+    def __init__(self, path=SNAPSHOT_FILE, check_interval=SNAPSHOT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """
+        The latest published snapshot.
+
+        Returns:
+            StatsSnapshot, or None when the batch pipeline has not published one yet
+        """
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return self._snapshot
+            if mtime == self._mtime:
+                return self._snapshot
+            data = _read_json(self.path)
+            if data is None:
+                return self._snapshot
+            if self._snapshot is None or data["version"] != self._snapshot.version:
+                self._snapshot = StatsSnapshot(data)
+                log.info(f"Loaded CMJ stats snapshot v{self._snapshot.version} "
+                         f"({self._snapshot.sample_size} trials, created {self._snapshot.created_at})")
+            self._mtime = mtime
+            return self._snapshot
+
+
+_snapshot_loader = None
+
+
+def get_stats_snapshot():
+    """Latest published CMJ stats snapshot for this process (None until one is published)."""
+    global _snapshot_loader
+    with _stats_lock:
+        if _snapshot_loader is None:
+            _snapshot_loader = SnapshotLoader()
+    return _snapshot_loader.current()
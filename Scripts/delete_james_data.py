@@ -3,20 +3,17 @@
 Script to delete incorrect James McArthur data from BigQuery
 """
 
-from google.oauth2 import service_account
-from google.cloud import bigquery
+from bq_client import get_bigquery_client
 
 # Configuration
 PROJECT_ID = "vald-ref-data"
 DATASET_ID = "athlete_performance_db"
 TABLE_ID = "cmj_results"
-CREDENTIALS_FILE = 'gcp_credentials.json'
 
 def delete_james_data():
     """Delete James McArthur data from BigQuery"""
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+        client = get_bigquery_client(PROJECT_ID)
         
         # Delete query
         delete_query = f"""
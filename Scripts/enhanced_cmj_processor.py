@@ -6,138 +6,45 @@ This script integrates composite scoring into the existing GCP pipeline for CMJ
 import pandas as pd
 import numpy as np
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 from newcompositescore import calculate_composite_score_per_trial, get_best_trial, CMJ_weights
 from VALDapiHelpers import get_access_token, get_profiles, FD_Tests_by_Profile, get_FD_results
-import pandas_gbq
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from sync_watermarks import WatermarkStore, start_date_for
+from trial_cache import get_trial_cache
+from cmj_stats import get_cmj_stats, normalize_scores
+from athlete_directory import get_athlete_directory
+from bq_writer import BatchWriter
+from job_state import get_job_state, FETCHED, SCORED, UPLOADED, SKIPPED, FAILED
+from bq_client import get_credentials, write_results, result_id_for, CREDENTIALS_FILE
 import os
 # Add import for deepcopy
 from copy import deepcopy
 import logging
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import threading
 import random
-import requests
-import json
 
 # Configuration
-CREDENTIALS_FILE = 'gcp_credentials.json'
 PROJECT_ID = 'vald-ref-data'  # Replace with your actual project ID
 DATASET_ID = 'athlete_performance_db'
 TABLE_ID = 'cmj_results'
 ATHLETES_TABLE_ID = 'athletes'
+PIPELINE = 'CMJ'  # Watermark key for incremental syncs
 
-# Rate limiting configuration - Optimized for better throughput
-MIN_REQUEST_INTERVAL = 0.5  # Reduced from 1.5s to 0.5s (still conservative)
-MAX_CONCURRENT_REQUESTS = 2  # Increased from 1 to 2 concurrent requests
+# Worker pool size for test listings and trial fetches. One pool drains the (athlete, test)
+# work of every athlete; actual request rate and in-flight count are governed by the shared
+# adaptive limiter in rate_limiter.py, so this is only a ceiling.
+MAX_WORKERS = int(os.getenv('CMJ_MAX_WORKERS', '8'))
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
-# Shared token and lock for thread-safe refresh
-shared_token = {'token': None}
-token_lock = threading.Lock()
-
-# Athlete ID cache to reduce BigQuery lookups
-athlete_id_cache = {}
-cache_lock = threading.Lock()
-
-# Progress tracking and checkpointing
-processed_athletes_file = 'processed_athletes.txt'
-failed_athletes_file = 'failed_athletes.txt'
-last_token_refresh = 0
-TOKEN_REFRESH_INTERVAL = 1800  # Refresh token every 30 minutes (1800 seconds)
-
-# Rate limiting
-rate_limit_lock = threading.Lock()
-last_request_time = 0
-api_semaphore = threading.Semaphore(MAX_CONCURRENT_REQUESTS)  # Only allow 1 concurrent API call
-
-def rate_limited_request():
-    """Ensure minimum time between API requests to avoid 429 errors."""
-    global last_request_time
-    with api_semaphore:
-        with rate_limit_lock:
-            current_time = time.time()
-            time_since_last = current_time - last_request_time
-            if time_since_last < MIN_REQUEST_INTERVAL:
-                sleep_time = MIN_REQUEST_INTERVAL - time_since_last
-                time.sleep(sleep_time)
-            last_request_time = time.time()
-
-def force_refresh_token():
-    """Force refresh token regardless of cache"""
-    global last_token_refresh
-    logging.info("Force refreshing access token...")
-    
-    payload = {
-        "grant_type": "client_credentials",
-        "client_id": os.getenv('CLIENT_ID'),
-        "client_secret": os.getenv('CLIENT_SECRET')
-    }
-
-    response = requests.post(os.getenv('AUTH_URL'), data=payload)
-    if response.status_code == 200:
-        token = response.json()['access_token']
-        expires_in = response.json().get('expires_in', 7200)
-        expires_at = (datetime.now() + timedelta(seconds=expires_in - 60)).isoformat()
-
-        # Update cache file
-        with open('.token_cache.json', "w") as f:
-            json.dump({"access_token": token, "expires_at": expires_at}, f)
-
-        last_token_refresh = time.time()
-        logging.info("Access token force refreshed successfully.")
-        return token
-    else:
-        logging.error(f"Force token refresh failed: {response.status_code} - {response.text}")
-        raise Exception(f"Auth failed: {response.status_code} - {response.text}")
-
-def periodic_token_refresh():
-    """Check if token needs periodic refresh"""
-    global last_token_refresh, shared_token
-    current_time = time.time()
-    
-    if current_time - last_token_refresh > TOKEN_REFRESH_INTERVAL:
-        try:
-            new_token = force_refresh_token()
-            with token_lock:
-                shared_token['token'] = new_token
-            logging.info("Periodic token refresh completed")
-        except Exception as e:
-            logging.error(f"Periodic token refresh failed: {e}")
-
-def load_processed_athletes():
-    """Load list of already processed athletes"""
-    processed = set()
-    if os.path.exists(processed_athletes_file):
-        with open(processed_athletes_file, 'r') as f:
-            processed = set(line.strip() for line in f)
-    return processed
-
-def save_processed_athlete(athlete_name):
-    """Save processed athlete to checkpoint file"""
-    with open(processed_athletes_file, 'a') as f:
-        f.write(f"{athlete_name}\n")
-
-def save_failed_athlete(athlete_name, error_message):
-    """Save failed athlete with error details"""
-    with open(failed_athletes_file, 'a') as f:
-        f.write(f"{athlete_name}: {error_message}\n")
-
-def clear_checkpoints():
-    """Clear checkpoint files to start fresh"""
-    for file in [processed_athletes_file, failed_athletes_file]:
-        if os.path.exists(file):
-            os.remove(file)
-            print(f"Cleared checkpoint file: {file}")
-    print("Checkpoints cleared - will process all athletes from the beginning")
+# Access tokens come from the shared provider in token_generator.py: held in memory, refreshed
+# single-flight on a 401 and renewed in the background before expiry
 
 def get_athlete_id_from_profile(profile_id):
     """
-    Fetch athlete_ID from athletes table using profileId with caching.
+    Look up athlete_ID for a profileId in the shared athlete directory.
     
     Args:
         profile_id: VALD profile ID
@@ -145,95 +52,46 @@ def get_athlete_id_from_profile(profile_id):
     Returns:
         athlete_ID string or None if not found
     """
-    # Check cache first
-    with cache_lock:
-        if profile_id in athlete_id_cache:
-            return athlete_id_cache[profile_id]
-    
-    try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-        
-        query = f"""
-        SELECT athlete_ID 
-        FROM `{PROJECT_ID}.{DATASET_ID}.{ATHLETES_TABLE_ID}` 
-        WHERE profileId = '{profile_id}'
-        LIMIT 1
-        """
-        
-        result = client.query(query).to_dataframe()
-        if not result.empty:
-            athlete_id = result.iloc[0]['athlete_ID']
-            # Cache the result
-            with cache_lock:
-                athlete_id_cache[profile_id] = athlete_id
-            return athlete_id
-        else:
-            logging.warning(f"No athlete_ID found for profileId: {profile_id}")
-            # Cache None result to avoid repeated lookups
-            with cache_lock:
-                athlete_id_cache[profile_id] = None
-            return None
-    except Exception as e:
-        logging.error(f"Error fetching athlete_ID for profileId {profile_id}: {e}")
-        return None
+    return get_athlete_directory().get(profile_id)
 
 def upload_to_bigquery(df, table_name, table_schema=None):
-    """Upload DataFrame to BigQuery with proper error handling."""
+    """Upsert DataFrame rows into BigQuery on result_id, with proper error handling."""
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        pandas_gbq.to_gbq(
-            df,
-            destination_table=f"{DATASET_ID}.{table_name}",
-            project_id=PROJECT_ID,
-            credentials=credentials,
-            if_exists='append',
-            table_schema=table_schema
-        )
+        write_results(df, table_name, table_schema=table_schema)
         print(f"Successfully uploaded {len(df)} rows to {table_name}")
         return True
     except Exception as e:
         print(f"Error uploading to BigQuery: {e}")
         return False
 
-def get_FD_results_with_logging_and_retry(test_id, token, max_retries=5):
-    for attempt in range(max_retries):
-        start_time = time.time()
-        try:
-            # Apply rate limiting
-            rate_limited_request()
-            result = get_FD_results(test_id, token)
-            elapsed = time.time() - start_time
-            logging.info(f"API call: get_FD_results({test_id}) took {elapsed:.2f}s")
-            return result
-        except Exception as e:
-            elapsed = time.time() - start_time
-            # Check for 429 Too Many Requests
-            if hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 429:
-                # Exponential backoff with jitter
-                base_wait = 2 ** attempt
-                jitter = random.uniform(0, 0.1 * base_wait)
-                wait_time = base_wait + jitter
-                logging.warning(f"429 Too Many Requests for test {test_id}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                logging.error(f"API call failed: get_FD_results({test_id}) after {elapsed:.2f}s: {e}")
-                if attempt == max_retries - 1:
-                    break
-                # For other errors, wait a bit before retrying
-                time.sleep(1)
+def get_FD_results_with_logging_and_retry(test_id, token, modified_date=None, timeout=None):
+    """Fetch trial results with timing logs. Rate limiting, timeouts and 429/5xx retries happen inside the shared VALD client."""
+    start_time = time.time()
+    try:
+        result = get_FD_results(test_id, token, modified_date, timeout=timeout)
+        elapsed = time.time() - start_time
+        logging.info(f"API call: get_FD_results({test_id}) took {elapsed:.2f}s")
+        return result
+    except Exception as e:
+        elapsed = time.time() - start_time
+        # Let 401s through so the caller can refresh the token
+        if hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 401:
+            raise
+        logging.error(f"API call failed: get_FD_results({test_id}) after {elapsed:.2f}s: {e}")
     return None
 
-def get_FD_results_with_auto_refresh(test_id, max_retries=2, timeout=20):
-    global shared_token
+def get_FD_results_with_auto_refresh(test_id, max_retries=2, timeout=20, modified_date=None):
+    """
+    Fetch trial results, force-refreshing the shared token on a 401.
+
+    timeout is the per-attempt HTTP read timeout; the VALD client enforces it (plus its
+    connect timeout) on the socket, so the call runs in the calling thread and a stalled
+    request is abandoned rather than left running. Returns None when the fetch fails.
+    """
     for attempt in range(max_retries):
-        with token_lock:
-            token = shared_token['token']
+        token = get_access_token()
         try:
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(get_FD_results_with_logging_and_retry, test_id, token)
-                return future.result(timeout=timeout)
+            return get_FD_results_with_logging_and_retry(test_id, token, modified_date, timeout=timeout)
         except Exception as e:
             # Detect 401 Unauthorized
             if hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 401:
@@ -241,25 +99,17 @@ def get_FD_results_with_auto_refresh(test_id, max_retries=2, timeout=20):
                     logging.critical(f"401 Unauthorized for test {test_id} even after token refresh. Stopping script.")
                     raise SystemExit("Critical: Unable to authenticate with VALD API. Check credentials.")
                 logging.warning(f"401 Unauthorized for test {test_id}, force refreshing token and retrying...")
-                with token_lock:
-                    shared_token['token'] = get_access_token()
+                get_access_token(force_refresh=True, rejected_token=token)
                 continue  # Retry with new token
-            elif isinstance(e, TimeoutError):
-                logging.warning(f"Timeout fetching test {test_id}, skipping.")
-                return None
             else:
                 logging.error(f"API call failed: get_FD_results({test_id}): {e}")
                 return None
     return None
 
 def FD_Tests_by_Profile_with_auto_refresh(start_date, profile_id, max_retries=3):
-    global shared_token
     for attempt in range(max_retries):
-        with token_lock:
-            token = shared_token['token']
+        token = get_access_token()
         try:
-            # Apply rate limiting
-            rate_limited_request()
             return FD_Tests_by_Profile(start_date, profile_id, token)
         except Exception as e:
             if hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 401:
@@ -268,33 +118,11 @@ def FD_Tests_by_Profile_with_auto_refresh(start_date, profile_id, max_retries=3)
                     return None  # Return None instead of stopping script
                 logging.warning(f"401 Unauthorized for profile {profile_id}, force refreshing token and retrying...")
                 try:
-                    new_token = force_refresh_token()
-                    with token_lock:
-                        shared_token['token'] = new_token
+                    get_access_token(force_refresh=True, rejected_token=token)
                 except Exception as refresh_error:
                     logging.error(f"Token refresh failed: {refresh_error}. Skipping athlete.")
                     return None
                 continue
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 204:
-                # 204 No Content is normal - profile has no tests
-                logging.info(f"204 No Content for profile {profile_id} - no tests found")
-                return pd.DataFrame()
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 503:
-                # 503 Service Unavailable - API temporarily down
-                base_wait = 2 ** attempt
-                jitter = random.uniform(0, 0.1 * base_wait)
-                wait_time = base_wait + jitter
-                logging.warning(f"503 Service Unavailable for profile {profile_id}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code') and e.response.status_code == 429:
-                # Exponential backoff with jitter for 429 errors
-                base_wait = 2 ** attempt
-                jitter = random.uniform(0, 0.1 * base_wait)
-                wait_time = base_wait + jitter
-                logging.warning(f"429 Too Many Requests for profile {profile_id}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
             else:
                 logging.error(f"API call failed: FD_Tests_by_Profile({profile_id}): {e}")
                 if attempt == max_retries - 1:
@@ -412,7 +240,7 @@ def process_cmj_test_with_composite(test_id, token, assessment_id, global_means,
         else:
             upload_dict[bq_col] = float('nan')
     gcp_data = pd.DataFrame([upload_dict])
-    gcp_data['result_id'] = str(uuid.uuid4())
+    gcp_data['result_id'] = result_id_for(PIPELINE, test_id)
     gcp_data['assessment_id'] = assessment_id
     gcp_data['cmj_composite_score'] = best_score
     gcp_data.reset_index(drop=True, inplace=True)
@@ -521,7 +349,7 @@ def process_cmj_test_with_composite_parallel(test_id, token, assessment_id, glob
         else:
             upload_dict[bq_col] = float('nan')
     gcp_data = pd.DataFrame([upload_dict])
-    gcp_data['result_id'] = str(uuid.uuid4())
+    gcp_data['result_id'] = result_id_for(PIPELINE, test_id)
     gcp_data['assessment_id'] = assessment_id
     gcp_data['cmj_composite_score'] = best_score
     gcp_data.reset_index(drop=True, inplace=True)
@@ -540,9 +368,10 @@ def process_cmj_test_with_composite_parallel(test_id, token, assessment_id, glob
     ]
     return gcp_data, gcp_schema
 
-def process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id, global_means, global_stds):
-    logging.info(f"Fetching CMJ data for test {test_id}...")
-    raw_data = get_FD_results_with_auto_refresh(test_id, timeout=20)
+def process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id, global_means, global_stds, raw_data=None):
+    if raw_data is None:
+        logging.info(f"Fetching CMJ data for test {test_id}...")
+        raw_data = get_FD_results_with_auto_refresh(test_id, timeout=20)
     if raw_data is None or raw_data.empty:
         logging.warning(f"No data found for test {test_id}")
         return None, None
@@ -635,7 +464,7 @@ def process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id
         else:
             upload_dict[bq_col] = float('nan')
     gcp_data = pd.DataFrame([upload_dict])
-    gcp_data['result_id'] = str(uuid.uuid4())
+    gcp_data['result_id'] = result_id_for(PIPELINE, test_id)
     gcp_data['assessment_id'] = assessment_id
     gcp_data['cmj_composite_score'] = best_score
     gcp_data.reset_index(drop=True, inplace=True)
@@ -651,71 +480,17 @@ def process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id
     ]
     return gcp_data, gcp_schema
 
-def process_all_cmj_tests_for_athlete(profile_id: str, token: str, assessment_id: str, athlete_name: str, athlete_dob=None, global_means=None, global_stds=None) -> list[pd.DataFrame]:
+def build_cmj_record(test_row, raw_data, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id):
     """
-    Process all CMJ tests for a given athlete and upload to GCP.
-    
+    Score one CMJ test's trials and attach the athlete fields.
+
     Args:
-        profile_id: VALD profile ID
-        token: Access token
-        assessment_id: Assessment ID for GCP
-        athlete_name: Athlete's full name
-        athlete_dob: Athlete's date of birth (datetime.date or None)
-    
+        test_row: Test metadata row (testId, modifiedDateUtc)
+        raw_data: get_FD_results-style DataFrame of the test's trials
+
     Returns:
-        List of processed test results
+        One-row DataFrame ready for cmj_results, or None when the test has nothing to upload
     """
-    
-    # Fetch all tests for the athlete
-    start_date = "2021-1-1 00:00:00"
-    tests_df = FD_Tests_by_Profile_with_auto_refresh(start_date, profile_id)
-    
-    if tests_df is None or tests_df.empty:
-        print(f"No tests found for profile {profile_id}")
-        return []
-    
-    # Filter for CMJ tests
-    cmj_tests = tests_df[tests_df['testType']== 'CMJ']
-    
-    if cmj_tests.empty:
-        print(f"No CMJ tests found for profile {profile_id}")
-        return []
-    
-    print(f"Found {len(cmj_tests)} CMJ tests for profile {profile_id}")
-    
-    processed_results = []
-    
-    for _, test_row in cmj_tests.iterrows():
-        test_id = test_row['testId']
-        test_date = pd.to_datetime(test_row['modifiedDateUtc']).date()
-        # Calculate age_at_test using athlete_dob from profile
-        age_at_test = None
-        if athlete_dob is not None and not pd.isnull(athlete_dob):
-            dob = pd.to_datetime(athlete_dob).date() if not isinstance(athlete_dob, (datetime, pd.Timestamp)) else athlete_dob
-            age_at_test = test_date.year - dob.year - ((test_date.month, test_date.day) < (dob.month, dob.day))
-
-        print(f"Processing CMJ test {test_id} from {test_date}...")
-
-        # Process the test, pass global_means and global_stds
-        gcp_data, gcp_schema = process_cmj_test_with_composite_parallel(test_id, token, assessment_id, global_means, global_stds)
-
-        # Only append if gcp_data is a valid, non-empty DataFrame
-        if isinstance(gcp_data, pd.DataFrame) and not gcp_data.empty:
-            # Get athlete_ID from athletes table
-            athlete_id = get_athlete_id_from_profile(profile_id)
-            
-            gcp_data['athlete_id'] = athlete_id
-            gcp_data['athlete_name'] = athlete_name
-            gcp_data['test_date'] = test_date
-            gcp_data['age_at_test'] = age_at_test
-            processed_results.append(gcp_data)
-            print(f"Successfully processed test {test_id}")
-        else:
-            print(f"Failed to process test {test_id}")
-    
-    return processed_results
-
-def fetch_and_process_test(test_row, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id):
     test_id = test_row['testId']
     test_date = pd.to_datetime(test_row['modifiedDateUtc']).date()
     age_at_test = None
@@ -723,10 +498,7 @@ def fetch_and_process_test(test_row, assessment_id, global_means, global_stds, a
         dob = pd.to_datetime(athlete_dob).date() if not isinstance(athlete_dob, (datetime, pd.Timestamp)) else athlete_dob
         age_at_test = test_date.year - dob.year - ((test_date.month, test_date.day) < (dob.month, dob.day))
     
-    # Add small delay to avoid overwhelming the API
-    time.sleep(0.5)
-    
-    gcp_data, gcp_schema = process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id, global_means, global_stds)
+    gcp_data, gcp_schema = process_cmj_test_with_composite_parallel_with_timeout(test_id, assessment_id, global_means, global_stds, raw_data=raw_data)
     if isinstance(gcp_data, pd.DataFrame) and not gcp_data.empty:
         # Get athlete_ID from athletes table
         athlete_id = get_athlete_id_from_profile(profile_id)
@@ -738,30 +510,147 @@ def fetch_and_process_test(test_row, assessment_id, global_means, global_stds, a
         return gcp_data
     return None
 
-def process_all_cmj_tests_for_athlete_parallel(profile_id, token, assessment_id, athlete_name, athlete_dob, global_means, global_stds):
-    start_date = "2021-1-1 00:00:00"
-    tests_df = FD_Tests_by_Profile_with_auto_refresh(start_date, profile_id)
+def fetch_and_process_test(test_row, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id, stats=None, job_state=None):
+    """
+    Fetch and score one CMJ test, counting its trials into stats when given.
+
+    Each step is recorded in job_state (fetched, then scored or skipped; failed with the
+    error class when the fetch or scoring fails).
+
+    Returns:
+        (gcp_data, fetch_failed): gcp_data is None when there is nothing to upload;
+        fetch_failed is True when the test must be retried
+    """
+    job_state = job_state or get_job_state()
+    test_id = test_row['testId']
+    modified_date = test_row['modifiedDateUtc']
+    logging.info(f"Fetching CMJ data for test {test_id}...")
+    raw_data = get_FD_results_with_auto_refresh(test_id, timeout=20, modified_date=modified_date)
+    if raw_data is None:
+        job_state.mark(PIPELINE, test_id, FAILED, modified_date, profile_id,
+                       error="Trial fetch failed or timed out", error_class="FetchError")
+        return None, True
+    job_state.mark(PIPELINE, test_id, FETCHED, modified_date, profile_id)
+    if stats is not None:
+        stats.update_from_raw(test_id, raw_data)
+    try:
+        record = build_cmj_record(test_row, raw_data, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id)
+    except Exception as e:
+        logging.error(f"Scoring failed for CMJ test {test_id}: {e}")
+        job_state.mark(PIPELINE, test_id, FAILED, error=e)
+        return None, True
+    job_state.mark(PIPELINE, test_id, SCORED if record is not None else SKIPPED)
+    return record, False
+
+def list_pending_cmj_tests(profile_id, watermarks=None, job_state=None):
+    """
+    List the athlete's CMJ tests modified since their last successful sync.
+
+    Tests job_state already has as uploaded or skipped (finished by an interrupted
+    earlier run) are left out of pending_tests; everything else, including failed tests, is kept.
+
+    Returns:
+        (cmj_tests, pending_tests): every new CMJ test (for the watermark; None when the
+        listing failed) and the subset still to fetch
+    """
+    watermarks = watermarks or WatermarkStore()
+    tests_df = FD_Tests_by_Profile_with_auto_refresh(watermarks.get(PIPELINE, profile_id), profile_id)
     if tests_df is None or tests_df.empty:
-        logging.warning(f"No tests found for profile {profile_id}")
-        return []
-    cmj_tests = tests_df[tests_df['testType'] == 'CMJ']
+        logging.warning(f"No new tests found for profile {profile_id}")
+        return None, pd.DataFrame()
+    cmj_tests = watermarks.new_tests(PIPELINE, profile_id, tests_df[tests_df['testType'] == 'CMJ'])
     if cmj_tests.empty:
-        logging.warning(f"No CMJ tests found for profile {profile_id}")
-        return []
-    logging.info(f"Found {len(cmj_tests)} CMJ tests for profile {profile_id}")
+        logging.warning(f"No new CMJ tests found for profile {profile_id}")
+        return cmj_tests, cmj_tests
+    logging.info(f"Found {len(cmj_tests)} new CMJ tests for profile {profile_id}")
+    job_state = job_state or get_job_state()
+    finished = cmj_tests.apply(lambda test_row: job_state.is_finished(PIPELINE, test_row['testId'], test_row['modifiedDateUtc']), axis=1)
+    if finished.any():
+        logging.info(f"Skipping {int(finished.sum())} CMJ tests already finished for profile {profile_id}")
+    return cmj_tests, cmj_tests[~finished]
+
+def process_all_cmj_tests_for_athlete_parallel(profile_id, token, assessment_id, athlete_name, athlete_dob, global_means, global_stds, watermarks=None, stats=None, job_state=None):
+    """
+    Process one athlete's pending CMJ tests (see list_pending_cmj_tests) in its own worker pool.
+
+    main_pipeline schedules all athletes' tests on one shared pool instead; this is for
+    processing a single athlete.
+
+    Returns:
+        (processed_results, cmj_tests, failed_test_ids): processed_results is a list of
+        (test_row, record) pairs; cmj_tests and failed_test_ids let the caller advance the
+        watermark once the results are uploaded
+    """
+    cmj_tests, pending_tests = list_pending_cmj_tests(profile_id, watermarks, job_state)
     processed_results = []
-    with ThreadPoolExecutor(max_workers=2) as executor:  # Optimized from 1 to 2 workers
-        futures = [
+    failed_test_ids = set()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
             executor.submit(
-                fetch_and_process_test, test_row, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id
-            )
-            for _, test_row in cmj_tests.iterrows()
-        ]
+                fetch_and_process_test, test_row, assessment_id, global_means, global_stds, athlete_name, athlete_dob, profile_id, stats, job_state
+            ): test_row
+            for _, test_row in pending_tests.iterrows()
+        }
         for future in as_completed(futures):
-            result = future.result()
-            if result is not None:
-                processed_results.append(result)
-    return processed_results
+            result, fetch_failed = future.result()
+            if fetch_failed:
+                failed_test_ids.add(futures[future]['testId'])
+            elif result is not None:
+                processed_results.append((futures[future], result))
+    return processed_results, cmj_tests, failed_test_ids
+
+def compute_global_stats(raw_results, stats=None, fit_score_range=False):
+    """
+    Fold raw trial data into the incremental CMJ stats and return the z-scoring mean/std.
+
+    Args:
+        raw_results: Iterable of (test_id, get_FD_results-style DataFrame) pairs (None/empty frames are skipped)
+        stats: CMJStats to update (defaults to the process-wide instance)
+        fit_score_range: Also set the 50-100 score range from these tests' best-trial scores
+            (bootstrap), so results are normalized against a fixed range from the first batch on
+
+    Returns:
+        (global_means, global_stds) as Series, or (None, None) when there was no CMJ trial data
+    """
+    stats = stats if stats is not None else get_cmj_stats()
+    skipped_tests = 0
+    trial_matrices = []
+    for test_id, raw_data in raw_results:
+        if fit_score_range:
+            trial_matrices.append(stats.trial_matrix(raw_data))
+        if not stats.update_from_raw(test_id, raw_data):
+            skipped_tests += 1
+            logging.debug(f"[DEBUG] No CMJ trials counted in global stats for test {test_id}")
+    if fit_score_range:
+        stats.fit_score_bounds(trial_matrices)
+    print(f"[DEBUG] Total CMJ tests skipped (missing data/trials/already counted): {skipped_tests}")
+    logging.info(f"CMJ stats: {stats.summary()}")
+    return stats.means(), stats.stds()
+
+def finalize_cmj_results(all_results, stats=None, score_range=None):
+    """
+    Combine per-test CMJ rows, normalize composite scores to 50-100 and apply BigQuery-safe column names.
+
+    Args:
+        score_range: (score_min, score_max) to normalize against. main_pipeline fixes it at the
+            start of the run, so every micro-batch uses the same scale; defaults to the range
+            in stats. This run's raw scores widen the range in stats for the next run either way.
+    """
+    stats = stats if stats is not None else get_cmj_stats()
+    combined_df = pd.concat(all_results, ignore_index=True)
+    stats.update_score_bounds(combined_df['cmj_composite_score'])
+    if score_range is None:
+        score_range = (stats.score_min, stats.score_max)
+    combined_df['cmj_composite_score'] = normalize_scores(combined_df['cmj_composite_score'], *score_range)
+    # Rename columns to BigQuery-safe names
+    rename_map = {
+        'ECCENTRIC_BRAKING_RFD_Trial_N/s': 'ECCENTRIC_BRAKING_RFD_Trial_N_s',
+        'BODYMASS_RELATIVE_TAKEOFF_POWER_Trial_W/kg': 'BODYMASS_RELATIVE_TAKEOFF_POWER_Trial_W_kg',
+    'CONCENTRIC_RFD_Trial_N_s': 'CONCENTRIC_RFD_Trial_N_s',
+        'CONCENTRIC_DURATION_Trial/ms': 'CONCENTRIC_DURATION_Trial_ms',
+    }
+    combined_df.rename(columns=rename_map, inplace=True)
+    return combined_df
 
 def main_pipeline():
     """
@@ -770,187 +659,174 @@ def main_pipeline():
     
     # Authentication
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
+        get_credentials()
         print("Successfully loaded GCP credentials.")
     except Exception as e:
         print(f"ERROR: Could not load credentials. {e}")
         return
 
-    # Always fetch a fresh token at the start
-    with token_lock:
-        shared_token['token'] = get_access_token()
-        logging.info("Access token refreshed at script start.")
-    
     # Fetch all athlete profiles
     print("Fetching athlete profiles...")
-    profiles = get_profiles(shared_token['token'])
+    profiles = get_profiles(get_access_token())
     if profiles.empty:
         print("No profiles found. Exiting.")
         return
     
     print(f"Found {len(profiles)} athlete profiles")
 
-    # Gather CMJ trial data for global stats (all athletes)
-    print("Gathering CMJ trial data for global mean/std calculation (all athletes)...")
-    all_cmj_trials = []
-    skipped_tests = 0
-    total_tests_found = 0
-    all_test_ids = []
-    profiles_subset_for_stats = profiles  # Use all athletes for stats calculation
-    
-    for index, athlete in profiles_subset_for_stats.iterrows():
-        profile_id = str(athlete['profileId'])
-        start_date = "2021-1-1 00:00:00"
-        tests_df = FD_Tests_by_Profile_with_auto_refresh(start_date, profile_id)
-        if tests_df is not None and not tests_df.empty:
-            cmj_tests = tests_df[tests_df['testType'] == 'CMJ']
-            for _, test_row in cmj_tests.iterrows():
-                total_tests_found += 1
-                all_test_ids.append(test_row['testId'])
-        else:
-            print(f"[DEBUG] No tests found for profile {profile_id}")
-    print(f"[DEBUG] Total CMJ tests found: {total_tests_found}")
-
-    # Parallel fetch all test results
-    def fetch_trial_data_for_stats(test_id):
-        # Add small delay to avoid overwhelming the API
-        time.sleep(0.5)
-        return get_FD_results_with_auto_refresh(test_id, timeout=20)
-    parallel_cmj_trials = []
-    skipped_tests = 0
-    with ThreadPoolExecutor(max_workers=3) as executor:  # Optimized to 3 workers
-        futures = [executor.submit(fetch_trial_data_for_stats, test_id) for test_id in all_test_ids]
-        for future in as_completed(futures):
-            raw_data = future.result()
-            if raw_data is not None and not raw_data.empty:
-                cmj_metrics = list(CMJ_weights.keys())
-                cmj_data = raw_data[raw_data['metric_id'].isin(cmj_metrics)]
-                trial_cols = [col for col in cmj_data.columns if 'trial' in col.lower()]
-                if trial_cols:
-                    pivot_data = cmj_data.set_index('metric_id')[trial_cols]
-                    parallel_cmj_trials.append(pivot_data)
-                else:
-                    skipped_tests += 1
-                    logging.debug(f"[DEBUG] Skipping test in global stats: No trial columns found.")
+    # Resolve athlete_IDs from one athletes-table query instead of a query per profile
+    try:
+        print(f"Loaded {len(get_athlete_directory().load())} athletes from the athletes table")
+    except Exception as e:
+        print(f"WARNING: Could not preload the athletes table; lookups will retry. {e}")
+
+    # Global stats are loaded from the persisted incremental state; the full-history scan
+    # only runs to bootstrap it (first run, or after the state file was removed)
+    stats = get_cmj_stats()
+    if stats.is_empty:
+        print("No saved CMJ stats found. Bootstrapping from all CMJ tests (all athletes)...")
+        all_test_ids = []
+        for index, athlete in profiles.iterrows():
+            profile_id = str(athlete['profileId'])
+            tests_df = FD_Tests_by_Profile_with_auto_refresh(start_date_for(PIPELINE), profile_id)
+            if tests_df is not None and not tests_df.empty:
+                cmj_tests = tests_df[tests_df['testType'] == 'CMJ']
+                all_test_ids.extend(zip(cmj_tests['testId'], cmj_tests['modifiedDateUtc']))
             else:
-                skipped_tests += 1
-                logging.debug(f"[DEBUG] Skipping test in global stats: No raw data found.")
-    print(f"[DEBUG] Total CMJ tests skipped (missing data/trials): {skipped_tests}")
-    # Concatenate all trials into one DataFrame
-    if parallel_cmj_trials:
-        all_trials_df = pd.concat([df for df in parallel_cmj_trials if not df.empty], axis=1).T
-        metrics = list(CMJ_weights.keys())
-        # Outlier filtering: remove values outside 3 std from mean for each metric
-        for metric in metrics:
-            if metric in all_trials_df:
-                mean = all_trials_df[metric].mean()
-                std = all_trials_df[metric].std()
-                before_count = len(all_trials_df)
-                all_trials_df = all_trials_df[(all_trials_df[metric] >= mean - 3*std) & (all_trials_df[metric] <= mean + 3*std)]
-                after_count = len(all_trials_df)
-                if before_count != after_count:
-                    print(f"[DEBUG] Outlier filtering for {metric}: removed {before_count - after_count} rows")
-        global_means = all_trials_df[metrics].mean()
-        global_stds = all_trials_df[metrics].std()
+                print(f"[DEBUG] No tests found for profile {profile_id}")
+        print(f"[DEBUG] Total CMJ tests found: {len(all_test_ids)}")
+
+        # Parallel fetch all test results (served from the trial cache for tests already seen)
+        def fetch_trial_data_for_stats(test_id, modified_date):
+            return test_id, get_FD_results_with_auto_refresh(test_id, timeout=20, modified_date=modified_date)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(fetch_trial_data_for_stats, test_id, modified_date) for test_id, modified_date in all_test_ids]
+            compute_global_stats((future.result() for future in as_completed(futures)), stats, fit_score_range=True)
+        stats.save()
     else:
+        print(f"Loaded CMJ stats: {stats.summary()}")
+    # Score and normalize this run against the stats as loaded; new trials and scores are
+    # folded in for the next run
+    global_means, global_stds = stats.means(), stats.stds()
+    score_range = (stats.score_min, stats.score_max)
+    if global_means is None or global_stds is None:
         print("No CMJ trial data found for global stats. Exiting.")
         return
 
     # Process all athletes
-    all_results = []
+    composite_scores = []
     processed_tests = 0
     skipped_tests_processing = 0
     profiles_subset = profiles  # Process all athletes
     print(f"Processing all {len(profiles_subset)} athletes")
     
-    # Don't clear checkpoints - allow resuming from where we left off
-    # clear_checkpoints()  # Commented out to allow resuming
-    
-    # Load already processed athletes to resume from where we left off
-    processed_athletes = load_processed_athletes()
-    logging.info(f"Loaded {len(processed_athletes)} already processed athletes from checkpoint")
-    
-    # Initialize token refresh timer
-    global last_token_refresh
-    last_token_refresh = time.time()
-    
-    for index, athlete in profiles_subset.iterrows():
-        profile_id = str(athlete['profileId'])
-        athlete_name = str(athlete['fullName'])
-        athlete_dob = athlete['dateOfBirth'] if 'dateOfBirth' in athlete else None
-        
-        # Skip if already processed
-        if athlete_name in processed_athletes:
-            logging.info(f"Skipping already processed athlete: {athlete_name}")
-            continue
-            
-        print(f"\nProcessing athlete {index + 1}/{len(profiles_subset)}: {athlete_name}")
-        
-        # Periodic token refresh (every 30 minutes)
-        periodic_token_refresh()
-        
-        assessment_id = str(uuid.uuid4())
-        
-        try:
-            # Use parallelized version with bulletproof error handling
-            athlete_results = process_all_cmj_tests_for_athlete_parallel(profile_id, shared_token['token'], assessment_id, athlete_name, athlete_dob, global_means, global_stds)
-            
-            if athlete_results:
-                all_results.extend(athlete_results)
-                processed_tests += len(athlete_results)
-                print(f"Processed {len(athlete_results)} CMJ tests for {athlete_name}")
-                save_processed_athlete(athlete_name)  # Save checkpoint
-            else:
-                skipped_tests_processing += 1
-                print(f"No CMJ tests processed for {athlete_name}")
-                save_processed_athlete(athlete_name)  # Still save to avoid re-processing
-                
-        except Exception as e:
-            # Catch any remaining errors and continue processing
-            error_msg = f"Unexpected error processing {athlete_name}: {str(e)}"
-            logging.error(error_msg)
-            save_failed_athlete(athlete_name, str(e))
-            skipped_tests_processing += 1
-            print(f"Error processing {athlete_name}, skipping and continuing...")
-            
-        if index < len(profiles_subset) - 1:
-            print("Waiting 1 second before next athlete...")
-            time.sleep(1)  # Reduced from 3 seconds to 1
+    # Per-test progress from earlier (possibly interrupted) runs: finished tests are skipped,
+    # failed ones retried
+    job_state = get_job_state()
+    print(f"Job state from earlier runs: {job_state.summary(PIPELINE)}")
+    
+    # Per-profile watermarks: only tests modified since the last successful upload are processed
+    watermarks = WatermarkStore()
+    listed_cmj_tests = {}
+    failed_test_ids = set()
+    
+    # Results stream to BigQuery in micro-batches as tests finish; every batch is normalized
+    # against the score range fixed above, and its tests are marked uploaded once it is acknowledged
+    def record_batch(test_ids, error):
+        job_state.mark_many(PIPELINE, test_ids, FAILED if error else UPLOADED, error=error)
+    with BatchWriter(TABLE_ID, prepare=lambda records: finalize_cmj_results(records, stats, score_range), on_flush=record_batch) as writer:
+        # Two-level scheduling: every athlete's test listing, then every (athlete, test) unit it
+        # yields, goes onto one worker pool, so fetches from all athletes share the rate limiter
+        # instead of athletes being processed one at a time. Per-athlete bookkeeping is kept in
+        # athletes and closed out when the athlete's last test completes.
+        athletes = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            listings = {
+                executor.submit(list_pending_cmj_tests, str(athlete['profileId']), watermarks, job_state): athlete
+                for _, athlete in profiles_subset.iterrows()
+            }
+            units = {}
+            in_flight = set(listings)
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in listings:
+                        athlete = listings.pop(future)
+                        profile_id = str(athlete['profileId'])
+                        athlete_name = str(athlete['fullName'])
+                        try:
+                            athlete_tests, pending_tests = future.result()
+                        except Exception as e:
+                            logging.error(f"Unexpected error listing tests for {athlete_name}: {str(e)}")
+                            skipped_tests_processing += 1
+                            continue
+                        if athlete_tests is not None and not athlete_tests.empty:
+                            listed_cmj_tests[profile_id] = athlete_tests
+                        if pending_tests.empty:
+                            skipped_tests_processing += 1
+                            print(f"No CMJ tests to process for {athlete_name}")
+                            continue
+                        book = athletes[profile_id] = {
+                            'name': athlete_name,
+                            'assessment_id': str(uuid.uuid4()),
+                            'remaining': len(pending_tests),
+                            'processed': 0,
+                        }
+                        athlete_dob = athlete['dateOfBirth'] if 'dateOfBirth' in athlete else None
+                        print(f"Queued {len(pending_tests)} CMJ tests for {athlete_name}")
+                        for _, test_row in pending_tests.iterrows():
+                            unit = executor.submit(
+                                fetch_and_process_test, test_row, book['assessment_id'], global_means, global_stds,
+                                athlete_name, athlete_dob, profile_id, stats, job_state
+                            )
+                            units[unit] = (profile_id, test_row)
+                            in_flight.add(unit)
+                        continue
+
+                    profile_id, test_row = units.pop(future)
+                    book = athletes[profile_id]
+                    try:
+                        record, fetch_failed = future.result()
+                    except Exception as e:
+                        # Catch any remaining errors and continue processing
+                        logging.error(f"Unexpected error processing test {test_row['testId']} for {book['name']}: {str(e)}")
+                        job_state.mark(PIPELINE, test_row['testId'], FAILED, error=e)
+                        record, fetch_failed = None, True
+                    if fetch_failed:
+                        failed_test_ids.add(test_row['testId'])
+                    elif record is not None:
+                        writer.put(test_row['testId'], test_row['modifiedDateUtc'], record)
+                        composite_scores.append(float(record['cmj_composite_score'].iloc[0]))
+                        book['processed'] += 1
+                        processed_tests += 1
+                    book['remaining'] -= 1
+                    if book['remaining'] == 0:
+                        if book['processed']:
+                            print(f"Processed {book['processed']} CMJ tests for {book['name']}")
+                        else:
+                            skipped_tests_processing += 1
+                            print(f"No CMJ tests processed for {book['name']}")
+    # Leaving the with block waited for the last micro-batch (and flushes what was queued if
+    # scheduling raised); tests in failed batches are retried next run
     print(f"[DEBUG] Total processed tests: {processed_tests}")
     print(f"[DEBUG] Total athletes with no processed tests: {skipped_tests_processing}")
-    
-    # After collecting all_results and before upload
-    if all_results:
-        print(f"\nUploading {len(all_results)} total CMJ results to BigQuery...")
-        combined_df = pd.concat(all_results, ignore_index=True)
-        # Normalize composite scores to 50-100 scale
-        min_score = combined_df['cmj_composite_score'].min()
-        max_score = combined_df['cmj_composite_score'].max()
-        if max_score != min_score:
-            combined_df['cmj_composite_score'] = 50 + (combined_df['cmj_composite_score'] - min_score) / (max_score - min_score) * 50
-        else:
-            combined_df['cmj_composite_score'] = 100
-        # Rename columns to BigQuery-safe names
-        rename_map = {
-            'ECCENTRIC_BRAKING_RFD_Trial_N/s': 'ECCENTRIC_BRAKING_RFD_Trial_N_s',
-            'BODYMASS_RELATIVE_TAKEOFF_POWER_Trial_W/kg': 'BODYMASS_RELATIVE_TAKEOFF_POWER_Trial_W_kg',
-        'CONCENTRIC_RFD_Trial_N_s': 'CONCENTRIC_RFD_Trial_N_s',
-            'CONCENTRIC_DURATION_Trial/ms': 'CONCENTRIC_DURATION_Trial_ms',
-        }
-        combined_df.rename(columns=rename_map, inplace=True)
-        # Print debug info before upload
-        print("[DEBUG] Columns in combined_df before upload:", combined_df.columns.tolist())
-        print("[DEBUG] First 5 rows of combined_df:")
-        print(combined_df.head())
-        # Upload all columns (including metrics and composite score)
-        upload_to_bigquery(combined_df, TABLE_ID)
-        
+    failed_test_ids |= writer.failed_ids()
+    print(f"Upload summary: {writer.summary()}")
+    print(f"Job state: {job_state.summary(PIPELINE)}")
+    for test_id, attempts, error_class, error in job_state.failed(PIPELINE):
+        logging.warning(f"CMJ test {test_id} failed ({error_class}, {attempts} attempts): {error}")
+    watermarks.commit_run(PIPELINE, listed_cmj_tests, failed_test_ids)
+    stats.save()
+    print(f"Advanced sync watermarks for {len(listed_cmj_tests)} profiles ({len(failed_test_ids)} failed tests will be retried).")
+    
+    if composite_scores:
+        normalized_scores = normalize_scores(pd.Series(composite_scores), *score_range)
         # Print summary statistics
         print("\nSummary Statistics:")
-        print(f"Average Composite Score: {combined_df['cmj_composite_score'].mean():.3f}")
-        print(f"Best Composite Score: {combined_df['cmj_composite_score'].max():.3f}")
-        # print(f"Number of athletes with data: {combined_df['profile_id'].nunique()}")  # Removed, not in schema
-        print(f"Total tests processed: {len(combined_df)}")
+        print(f"Average Composite Score: {normalized_scores.mean():.3f}")
+        print(f"Best Composite Score: {normalized_scores.max():.3f}")
+        print(f"Total tests processed: {len(normalized_scores)}")
+        print(f"Trial cache: {get_trial_cache().stats()}")
     else:
         print("No CMJ results to upload")
 
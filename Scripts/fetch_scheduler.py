@@ -0,0 +1,96 @@
+"""
+Sliding-window async scheduler for per-test fetches.
+Keeps up to N fetches in flight at all times and streams each result downstream
+the moment it completes, instead of gathering fixed batches (where one slow test
+holds up the rest) and sleeping between them. Each attempt gets its own timeout;
+timeouts, connection errors and FetchErrors are retried with backoff.
+Request pacing is still the shared rate limiter's job (rate_limiter.py).
+"""
+
+import asyncio
+import logging
+
+import aiohttp
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+CONCURRENT_REQUESTS = 10  # Fetches kept in flight
+REQUEST_TIMEOUT = 60  # Seconds per attempt, including time queued behind the rate limiter
+MAX_ATTEMPTS = 3  # Attempts per item before it is reported as failed
+BACKOFF_BASE = 1.0  # Seconds; doubled on every retry
+
+RETRYABLE_ERRORS = (asyncio.TimeoutError, aiohttp.ClientError)
+
+log = logging.getLogger(__name__)
+
+
+class FetchError(Exception):
+    """Raised by a fetch worker for a response worth retrying (e.g. an unexpected status)."""
+
+
+class FetchScheduler:
+    """Bounded-concurrency worker pool that yields (item, result, error) as items complete."""
+
+    def __init__(self, concurrency=CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+
+    async def _run_one(self, item, worker, label):
+        """Run worker(item) with a per-attempt timeout and retries. Returns (result, error)."""
+        error = None
+        for attempt in range(self.max_attempts):
+            try:
+                return await asyncio.wait_for(worker(item), self.timeout), None
+            except RETRYABLE_ERRORS + (FetchError,) as e:
+                error = e
+                if attempt < self.max_attempts - 1:
+                    wait_time = self.backoff_base * (2 ** attempt)
+                    log.warning(f"{type(e).__name__} for {label(item)}: {e}. Retrying in {wait_time:.1f}s... "
+                                f"(attempt {attempt + 1}/{self.max_attempts})")
+                    await asyncio.sleep(wait_time)
+            except Exception as e:
+                # Not a transport problem; retrying will not help
+                return None, e
+        return None, error
+
+    async def stream(self, items, worker, label=repr):
+        """
+        Run worker over every item, keeping self.concurrency calls in flight.
+
+        Args:
+            items: Iterable of work items
+            worker: Async callable taking one item
+            label: Callable naming an item in retry logs
+
+        Yields:
+            (item, result, error) in completion order; error is None on success
+        """
+        pending = asyncio.Queue()
+        for item in items:
+            pending.put_nowait(item)
+        total = pending.qsize()
+        if total == 0:
+            return
+        completed = asyncio.Queue()
+
+        async def run_worker():
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                result, error = await self._run_one(item, worker, label)
+                await completed.put((item, result, error))
+
+        workers = [asyncio.create_task(run_worker()) for _ in range(min(self.concurrency, total))]
+        try:
+            for _ in range(total):
+                yield await completed.get()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
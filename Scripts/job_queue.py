@@ -0,0 +1,333 @@
+"""
+Durable webhook job queue for the automation server (sqlite).
+Each test-completion webhook becomes one row keyed by test_id, so a repeated
+webhook for a test that is queued, processing or done is absorbed instead of
+processed twice. Workers claim the next job by priority (per test type) and age;
+failed jobs are retried with backoff up to MAX_ATTEMPTS. The backlog is bounded
+(enqueue raises QueueFull past MAX_BACKLOG), and because the queue and each job's
+status live on disk, a restart resumes where it stopped: jobs that were
+processing when the server died are re-queued.
+
+Jobs are coalesced per athlete: a testing session fires CMJ, PPU, HJ and IMTP
+webhooks within minutes, so a new job waits DEBOUNCE_SECONDS and every further
+webhook for the same athlete pushes the whole group back again (never past
+MAX_COALESCE_WAIT after the group's first job). claim_session() then hands the
+group to one worker, which processes it as a single assessment.
+
+The jobs table doubles as the server's processing-status store. Finished jobs
+(completed or failed) are evicted once older than STATUS_TTL or beyond the newest
+MAX_FINISHED_JOBS, and list_jobs() answers filtered queries (by athlete, status,
+test type and time) from indexes, so it stays fast with a large history.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".webhook_jobs.sqlite")
+MAX_BACKLOG = int(os.getenv("JOB_QUEUE_MAX_BACKLOG", "1000"))  # Queued jobs before webhooks are refused
+MAX_ATTEMPTS = 3  # Processing attempts per job
+RETRY_BACKOFF = 30  # Seconds before the first retry; doubled on every further retry
+PRIORITIES = {'CMJ': 0, 'IMTP': 1, 'PPU': 2, 'HJ': 2}  # Lower runs first
+DEFAULT_PRIORITY = 3
+DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "90"))  # Quiet period before an athlete's jobs run
+MAX_COALESCE_WAIT = float(os.getenv("WEBHOOK_MAX_COALESCE_WAIT", "600"))  # Longest a job waits for more of the session
+STATUS_TTL = float(os.getenv("JOB_STATUS_TTL", str(30 * 24 * 3600)))  # Seconds finished jobs are kept
+MAX_FINISHED_JOBS = int(os.getenv("JOB_STATUS_MAX_FINISHED", "500000"))  # Finished jobs kept at most
+MAX_LIST_LIMIT = 1000  # Rows list_jobs() returns at most
+
+# Job statuses
+QUEUED = "queued"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    test_id TEXT PRIMARY KEY,
+    athlete_id TEXT NOT NULL,
+    test_type TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    report_url TEXT,
+    payload TEXT,
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (status, priority, available_at, enqueued_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_athlete ON jobs (athlete_id, status);
+CREATE INDEX IF NOT EXISTS idx_jobs_athlete_time ON jobs (athlete_id, updated_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_time ON jobs (status, updated_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_type_time ON jobs (test_type, updated_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_time ON jobs (updated_at);
+"""
+
+
+class QueueFull(Exception):
+    """Raised by enqueue when MAX_BACKLOG jobs are already waiting."""
+
+
+class JobQueue:
+    """sqlite-backed priority queue of webhook jobs with persisted status."""
+
+    def __init__(self, path=JOB_QUEUE_PATH, max_backlog=MAX_BACKLOG, max_attempts=MAX_ATTEMPTS,
+                 debounce=DEBOUNCE_SECONDS, max_wait=MAX_COALESCE_WAIT,
+                 status_ttl=STATUS_TTL, max_finished=MAX_FINISHED_JOBS):
+        self.path = path
+        self.max_backlog = max_backlog
+        self.max_attempts = max_attempts
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.status_ttl = status_ttl
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def recover(self):
+        """Re-queue jobs left processing by a previous process. Returns how many."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, updated_at = ?, message = ? WHERE status = ?",
+                (QUEUED, now, now, "Re-queued after restart", PROCESSING),
+            )
+        if cursor.rowcount:
+            log.info(f"Re-queued {cursor.rowcount} jobs interrupted by a restart")
+        return cursor.rowcount
+
+    def enqueue(self, test_id, athlete_id, test_type, payload=None):
+        """
+        Queue a job for a test.
+
+        A test that is already queued, processing or completed is not queued again;
+        a failed test is re-queued with a fresh attempt budget. The athlete's waiting
+        jobs (this one included) become ready after the debounce window.
+
+        Returns:
+            (job, created): the job's row as a dict and whether this call queued it
+
+        Raises:
+            QueueFull: When the backlog is at max_backlog
+        """
+        now = time.time()
+        priority = PRIORITIES.get(test_type, DEFAULT_PRIORITY)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._conn.execute("SELECT * FROM jobs WHERE test_id = ?", (test_id,)).fetchone()
+                if existing is not None and existing['status'] != FAILED:
+                    self._conn.execute("COMMIT")
+                    return dict(existing), False
+                backlog = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+                if backlog >= self.max_backlog:
+                    raise QueueFull(f"{backlog} jobs already queued")
+                # Debounce: the athlete's group runs once no webhook has arrived for self.debounce
+                # seconds, but no later than self.max_wait after its first job. Jobs waiting out a
+                # retry backoff (attempts > 0) are not part of the group and keep their own schedule
+                first_enqueued = self._conn.execute(
+                    "SELECT MIN(enqueued_at) FROM jobs WHERE athlete_id = ? AND status = ? AND attempts = 0 AND available_at > ?",
+                    (athlete_id, QUEUED, now),
+                ).fetchone()[0]
+                available_at = min(now + self.debounce, (first_enqueued or now) + self.max_wait)
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO jobs (test_id, athlete_id, test_type, priority, status, attempts,
+                                                 message, report_url, payload, enqueued_at, available_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, 0, ?, NULL, ?, ?, ?, ?)
+                    """,
+                    (test_id, athlete_id, test_type, priority, QUEUED, "Test queued for processing",
+                     json.dumps(payload) if payload is not None else None, now, available_at, now),
+                )
+                self._conn.execute(
+                    "UPDATE jobs SET available_at = ? WHERE athlete_id = ? AND status = ? AND attempts = 0 AND available_at > ?",
+                    (available_at, athlete_id, QUEUED, now),
+                )
+                job = self._conn.execute("SELECT * FROM jobs WHERE test_id = ?", (test_id,)).fetchone()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(job), True
+
+    def claim_session(self):
+        """
+        Take the next ready job (lowest priority value, then oldest) together with every
+        other ready job for the same athlete, and mark them all processing.
+
+        Returns:
+            List of jobs (dicts) for one athlete, highest priority first; empty when nothing is ready
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                first = self._conn.execute(
+                    """
+                    SELECT athlete_id FROM jobs WHERE status = ? AND available_at <= ?
+                    ORDER BY priority, available_at, enqueued_at LIMIT 1
+                    """,
+                    (QUEUED, now),
+                ).fetchone()
+                jobs = []
+                if first is not None:
+                    jobs = self._conn.execute(
+                        """
+                        SELECT * FROM jobs WHERE athlete_id = ? AND status = ? AND available_at <= ?
+                        ORDER BY priority, enqueued_at
+                        """,
+                        (first['athlete_id'], QUEUED, now),
+                    ).fetchall()
+                    self._conn.executemany(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, message = ?, updated_at = ? WHERE test_id = ?",
+                        [(PROCESSING, "Test processing started", now, job['test_id']) for job in jobs],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        claimed = []
+        for job in jobs:
+            job = dict(job)
+            job['status'] = PROCESSING
+            job['attempts'] += 1
+            claimed.append(job)
+        return claimed
+
+    def complete(self, test_id, message, report_url=None):
+        """Mark a job completed."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, message = ?, report_url = ?, updated_at = ? WHERE test_id = ?",
+                (COMPLETED, message, report_url, time.time(), test_id),
+            )
+
+    def fail(self, test_id, message):
+        """
+        Record a failed attempt: the job is retried after a backoff, or marked failed
+        once it has used max_attempts.
+
+        Returns:
+            True when the job will be retried
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE test_id = ?", (test_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row['attempts']
+            retry = attempts < self.max_attempts
+            if retry:
+                delay = RETRY_BACKOFF * (2 ** (attempts - 1))
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, message = ?, available_at = ?, updated_at = ? WHERE test_id = ?",
+                    (QUEUED, f"{message} (retrying in {delay}s)", now + delay, now, test_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, message = ?, updated_at = ? WHERE test_id = ?",
+                    (FAILED, message, now, test_id),
+                )
+        return retry
+
+    def get(self, test_id):
+        """The job's row as a dict, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE test_id = ?", (test_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list_jobs(self, status=None, athlete_id=None, test_type=None, since=None, until=None, limit=100):
+        """
+        Jobs matching every given filter, most recently updated first.
+
+        Args:
+            status: e.g. 'failed'
+            athlete_id: VALD profileId
+            test_type: e.g. 'CMJ'
+            since, until: Epoch seconds bounding updated_at
+            limit: Rows to return (capped at MAX_LIST_LIMIT)
+
+        Returns:
+            List of job rows as dicts
+        """
+        clauses, params = [], []
+        for column, value in (("status", status), ("athlete_id", athlete_id), ("test_type", test_type)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("updated_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("updated_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(max(1, min(int(limit), MAX_LIST_LIMIT)))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM jobs {where} ORDER BY updated_at DESC LIMIT ?", params
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def evict(self):
+        """
+        Drop finished jobs older than status_ttl, then the oldest beyond max_finished.
+        Queued and processing jobs are never evicted. A webhook for an evicted test is
+        processed again.
+
+        Returns:
+            Number of jobs removed
+        """
+        cutoff = time.time() - self.status_ttl
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (COMPLETED, FAILED, cutoff)
+            ).rowcount
+            removed += self._conn.execute(
+                """
+                DELETE FROM jobs WHERE test_id IN (
+                    SELECT test_id FROM jobs WHERE status IN (?, ?)
+                    ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (COMPLETED, FAILED, self.max_finished),
+            ).rowcount
+        if removed:
+            log.info(f"Evicted {removed} finished jobs")
+        return removed
+
+    def counts(self):
+        """Number of jobs per status, e.g. {'queued': 12, 'completed': 480}."""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the process-wide JobQueue, opening it on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
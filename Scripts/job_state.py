@@ -0,0 +1,157 @@
+"""
+Per-test progress store for pipeline runs (sqlite).
+Each (pipeline, testId) row records how far the test got - fetched, scored,
+uploaded - for which modifiedDateUtc, how many attempts it has taken and, when
+it failed, the error class and message. A resumed run skips exactly the tests
+that finished (uploaded, or skipped for having no usable data) and retries the
+rest. Replaces the processed_athletes.txt / failed_athletes.txt checkpoints,
+which tracked athlete names and were written before the upload happened.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from sync_watermarks import format_utc
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+JOB_STATE_PATH = os.getenv("JOB_STATE_PATH", ".job_state.sqlite")
+
+# Test statuses, in pipeline order
+FETCHED = "fetched"  # Trials retrieved
+SCORED = "scored"  # Record built, waiting for upload
+UPLOADED = "uploaded"  # Record acknowledged by BigQuery
+SKIPPED = "skipped"  # Fetched, but nothing to upload (no trials / no usable metrics)
+FAILED = "failed"  # Last attempt failed; retried next run
+FINISHED = (UPLOADED, SKIPPED)
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    pipeline TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    modified_date_utc TEXT,
+    profile_id TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error_class TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (pipeline, test_id)
+);
+CREATE INDEX IF NOT EXISTS idx_tests_status ON tests (pipeline, status);
+"""
+
+
+class JobState:
+    """sqlite-backed per-test status store, safe to share between threads."""
+
+    def __init__(self, path=JOB_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def mark(self, pipeline, test_id, status, modified_date=None, profile_id=None, error=None, error_class=None):
+        """
+        Record a status transition for one test.
+
+        A fetch attempt ends in FETCHED or FAILED, so those transitions count an attempt.
+        A new modifiedDateUtc resets the attempt count (the test was re-analysed).
+
+        Args:
+            error: The exception (or message) behind a FAILED status
+            error_class: Overrides the class recorded for error (defaults to type(error).__name__)
+        """
+        modified = format_utc(modified_date) if modified_date is not None else None
+        if error_class is None and error:
+            error_class = type(error).__name__ if isinstance(error, BaseException) else "Error"
+        attempt = 1 if status in (FETCHED, FAILED) else 0
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO tests (pipeline, test_id, modified_date_utc, profile_id, status, attempts, error_class, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pipeline, test_id) DO UPDATE SET
+                    attempts = CASE WHEN excluded.modified_date_utc IS NOT NULL
+                                         AND excluded.modified_date_utc IS NOT tests.modified_date_utc
+                                    THEN excluded.attempts ELSE tests.attempts + excluded.attempts END,
+                    modified_date_utc = COALESCE(excluded.modified_date_utc, tests.modified_date_utc),
+                    profile_id = COALESCE(excluded.profile_id, tests.profile_id),
+                    status = excluded.status,
+                    error_class = excluded.error_class,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+                """,
+                (pipeline, str(test_id), modified, profile_id, status, attempt, error_class,
+                 str(error) if error else None, time.time()),
+            )
+
+    def mark_many(self, pipeline, test_ids, status, error=None, error_class=None):
+        """Record the same transition for several tests (e.g. every test in an uploaded batch)."""
+        for test_id in test_ids:
+            self.mark(pipeline, test_id, status, error=error, error_class=error_class)
+
+    def is_finished(self, pipeline, test_id, modified_date):
+        """True when this version of the test was already uploaded or skipped."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, modified_date_utc FROM tests WHERE pipeline = ? AND test_id = ?",
+                (pipeline, str(test_id)),
+            ).fetchone()
+        return row is not None and row[0] in FINISHED and row[1] == format_utc(modified_date)
+
+    def get(self, pipeline, test_id):
+        """The test's row as a dict, or None."""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM tests WHERE pipeline = ? AND test_id = ?", (pipeline, str(test_id)))
+            row = cursor.fetchone()
+            columns = [description[0] for description in cursor.description]
+        return dict(zip(columns, row)) if row is not None else None
+
+    def failed(self, pipeline):
+        """[(test_id, attempts, error_class, error)] for tests whose last attempt failed."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT test_id, attempts, error_class, error FROM tests WHERE pipeline = ? AND status = ? ORDER BY updated_at",
+                (pipeline, FAILED),
+            ).fetchall()
+
+    def summary(self, pipeline):
+        """Count of tests per status, e.g. {'uploaded': 812, 'failed': 3}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM tests WHERE pipeline = ? GROUP BY status", (pipeline,)
+            ).fetchall()
+        return dict(rows)
+
+    def reset(self, pipeline=None):
+        """Forget progress so the next run redoes everything (one pipeline or all)."""
+        with self._lock:
+            if pipeline is None:
+                self._conn.execute("DELETE FROM tests")
+            else:
+                self._conn.execute("DELETE FROM tests WHERE pipeline = ?", (pipeline,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_job_state = None
+_job_state_lock = threading.Lock()
+
+
+def get_job_state():
+    """Return the process-wide JobState, opening it on first use."""
+    global _job_state
+    with _job_state_lock:
+        if _job_state is None:
+            _job_state = JobState()
+        return _job_state
@@ -15,17 +15,122 @@ CMJ_weights = {
 invert_metrics = set()
 
 
+def _metric_vector(stats, metrics):
+    """Align a per-metric Series/dict (means, stds, weights) to the metric order; missing metrics become NaN."""
+    return pd.Series(stats, dtype=float).reindex(list(metrics)).to_numpy(dtype=float)
+
+
+def score_trials_batch(values, global_means, global_stds, weights=None, renormalize=False):
+    """
+    Score every trial of many tests in one vectorized pass.
+
+    Args:
+        values: Array of shape (n_tests, n_trials, n_metrics), metrics in weights order; NaN for
+            missing values and for padding when tests have fewer trials
+        global_means, global_stds: Per-metric Series/dicts used for z-scoring
+        weights: {metric: weight}; defaults to CMJ_weights
+        renormalize: When False (default) a trial missing any weighted metric scores NaN, as in
+            calculate_composite_score_per_trial. When True the available metrics are used and
+            their weights rescaled to the full weight total
+
+    Returns:
+        (composites, best_index, best_scores): composites is (n_tests, n_trials); best_index is the
+        0-based best trial per test (-1 when no trial could be scored); best_scores is NaN in that case
+    """
+    weights = CMJ_weights if weights is None else weights
+    metrics = list(weights.keys())
+    values = np.asarray(values, dtype=float)
+    weight_vector = _metric_vector(weights, metrics)
+    z_scores = (values - _metric_vector(global_means, metrics)) / _metric_vector(global_stds, metrics)
+
+    if renormalize:
+        available = ~np.isnan(z_scores)
+        weighted = np.where(available, z_scores, 0.0) @ weight_vector
+        available_weight = available @ weight_vector
+        with np.errstate(invalid='ignore', divide='ignore'):
+            composites = np.where(available_weight > 0, weighted * (weight_vector.sum() / available_weight), np.nan)
+    else:
+        composites = z_scores @ weight_vector
+
+    n_tests, n_trials = composites.shape
+    if n_tests == 0 or n_trials == 0:
+        # Nothing to pick from (no tests, or no trial columns): every test is unscorable
+        return composites, np.full(n_tests, -1), np.full(n_tests, np.nan)
+
+    scorable = ~np.isnan(composites)
+    has_score = scorable.any(axis=1)
+    best_index = np.where(has_score, np.argmax(np.where(scorable, composites, -np.inf), axis=1), -1)
+    best_scores = np.where(has_score, composites[np.arange(len(composites)), np.maximum(best_index, 0)], np.nan)
+    return composites, best_index, best_scores
+
+
+def trials_to_tensor(trial_frames, metrics=None):
+    """
+    Stack per-test trial DataFrames (rows metrics, columns trials) into a NaN-padded tensor.
+
+    Args:
+        trial_frames: {test_id: DataFrame} or list of (test_id, DataFrame)
+        metrics: Metric order for the last axis; defaults to CMJ_weights order
+
+    Returns:
+        (test_ids, trial_columns, values): trial_columns[i] lists test i's trial labels and
+        values has shape (n_tests, max_trials, n_metrics)
+    """
+    metrics = list(CMJ_weights.keys()) if metrics is None else list(metrics)
+    items = list(trial_frames.items()) if isinstance(trial_frames, dict) else list(trial_frames)
+    max_trials = max((frame.shape[1] for _, frame in items), default=0)
+    values = np.full((len(items), max_trials, len(metrics)), np.nan)
+    test_ids, trial_columns = [], []
+    for i, (test_id, frame) in enumerate(items):
+        aligned = frame.reindex(metrics).to_numpy(dtype=float).T  # (n_trials, n_metrics)
+        values[i, :aligned.shape[0]] = aligned
+        test_ids.append(test_id)
+        trial_columns.append(list(frame.columns))
+    return test_ids, trial_columns, values
+
+
+def long_to_tensor(long_df, metrics=None, test_col='test_id', trial_col='trial', metric_col='metric_id', value_col='value'):
+    """
+    Build the (tests x trials x metrics) tensor from a long-format frame with one row per value.
+
+    Returns:
+        (test_ids, trials, values): test_ids and trials are the sorted axis labels, values is NaN-padded
+    """
+    metrics = list(CMJ_weights.keys()) if metrics is None else list(metrics)
+    rows = long_df[long_df[metric_col].isin(metrics)]
+    test_codes, test_ids = pd.factorize(rows[test_col], sort=True)
+    trial_codes, trials = pd.factorize(rows[trial_col], sort=True)
+    metric_codes = pd.Categorical(rows[metric_col], categories=metrics).codes
+    values = np.full((len(test_ids), len(trials), len(metrics)), np.nan)
+    values[test_codes, trial_codes, metric_codes] = rows[value_col].to_numpy(dtype=float)
+    return list(test_ids), list(trials), values
+
+
+def score_tests(trial_frames, global_means, global_stds, weights=None, renormalize=False):
+    """
+    Best trial and score for many tests at once (e.g. rescoring history after a weight change).
+
+    Args:
+        trial_frames: {test_id: DataFrame} with rows metrics and columns trials, as passed to get_best_trial
+
+    Returns:
+        DataFrame with test_id, best_trial (column label, None when unscorable) and best_score
+    """
+    weights = CMJ_weights if weights is None else weights
+    test_ids, trial_columns, values = trials_to_tensor(trial_frames, metrics=weights.keys())
+    _, best_index, best_scores = score_trials_batch(values, global_means, global_stds, weights, renormalize)
+    best_trials = [columns[i] if i >= 0 else None for columns, i in zip(trial_columns, best_index)]
+    return pd.DataFrame({'test_id': test_ids, 'best_trial': best_trials, 'best_score': best_scores})
+
+
 def calculate_composite_score_per_trial(trial_df: pd.DataFrame, global_means, global_stds) -> pd.Series:
     """
     Given a DataFrame where rows are metrics and columns are trials, calculate the composite score for each trial.
     Returns a Series with composite scores for each trial.
     """
-    # Transpose so trials are rows, metrics are columns
-    trial_df = trial_df.T  # Now shape: (n_trials, n_metrics)
-    z_scores = (trial_df - global_means) / global_stds
-    z_scores = z_scores.reindex(columns=CMJ_weights.keys(), fill_value=np.nan)
-    composite_scores = z_scores.dot(pd.Series(CMJ_weights))
-    return composite_scores
+    _, _, values = trials_to_tensor([(None, trial_df)])
+    composites, _, _ = score_trials_batch(values, global_means, global_stds)
+    return pd.Series(composites[0], index=trial_df.columns)
 
 
 def get_best_trial(trial_df: pd.DataFrame, global_means, global_stds) -> tuple:
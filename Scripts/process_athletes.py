@@ -1,48 +1,29 @@
 import pandas as pd
 import os
 from VALDapiHelpers import get_access_token, get_profiles
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from athlete_directory import AthleteDirectory
 
 # Configuration
-CREDENTIALS_FILE = 'gcp_credentials.json'
 PROJECT_ID = 'vald-ref-data'
 DATASET_ID = 'athlete_performance_db'
 TABLE_ID = 'athletes'
 
-# Helper to zero-pad athlete_ID
-def format_athlete_id(n):
-    return f"{n:07d}"
-
 def main():
     # Authenticate with GCP
+    directory = AthleteDirectory(f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}")
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+        bq_client = directory.client
         print("Successfully loaded GCP credentials.")
     except Exception as e:
         print(f"ERROR: Could not load credentials. {e}")
         return
 
-    # Read current athletes table
+    # Read current athletes table (one query; the directory holds profileId -> athlete_ID)
     try:
-        query = f"SELECT athlete_ID, profileId FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`"
-        existing_athletes = bq_client.query(query).to_dataframe()
-        print(f"Loaded {len(existing_athletes)} existing athletes from BigQuery.")
+        directory.load()
+        print(f"Loaded {len(directory)} existing athletes from BigQuery.")
     except Exception as e:
         print(f"WARNING: Could not read athletes table. Assuming empty. {e}")
-        existing_athletes = pd.DataFrame(columns=["athlete_ID", "profileId"])
-
-    # Build mapping: profileId -> athlete_ID
-    profile_to_id = dict(zip(existing_athletes['profileId'], existing_athletes['athlete_ID']))
-    used_ids = set(existing_athletes['athlete_ID'])
-
-    # Get next available athlete_ID
-    def get_next_id():
-        if not used_ids:
-            return format_athlete_id(1)
-        max_id = max(int(aid) for aid in used_ids)
-        return format_athlete_id(max_id + 1)
 
     # Fetch all profiles from VALD API
     token = get_access_token()
@@ -54,11 +35,10 @@ def main():
     new_athletes = []
     for _, row in profiles.iterrows():
         profileId = str(row['profileId'])
-        if profileId in profile_to_id:
+        if profileId in directory:
             continue  # Already in table
-        athlete_ID = get_next_id()
-        used_ids.add(athlete_ID)
-        profile_to_id[profileId] = athlete_ID
+        athlete_ID = directory.next_id()
+        directory.add(profileId, athlete_ID)
         new_athletes.append({
             'athlete_ID': athlete_ID,
             'profileId': profileId,
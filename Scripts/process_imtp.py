@@ -1,16 +1,16 @@
 import pandas as pd
 import numpy as np
-import pandas_gbq
-from google.oauth2 import service_account
-from google.cloud import bigquery
-import uuid
+from bq_client import get_credentials, write_results, result_id_for
 from datetime import datetime
 import asyncio
-import aiohttp
 
 # Import your existing helper functions
 from token_generator import get_access_token
-from VALDapiHelpers import get_profiles, FD_Tests_by_Profile, get_FD_results, FORCEDECKS_URL, TENANT_ID
+from VALDapiHelpers import get_profiles, FD_Tests_by_Profile, trials_json_to_df
+from vald_client import get_client
+from sync_watermarks import WatermarkStore
+from work_registry import WorkRegistry, DONE, SKIPPED, FAILED
+from fetch_scheduler import FetchScheduler, FetchError
 
 # =================================================================================
 # CONFIGURATION
@@ -18,8 +18,8 @@ from VALDapiHelpers import get_profiles, FD_Tests_by_Profile, get_FD_results, FO
 PROJECT_ID = "vald-ref-data"
 DATASET_ID = "athlete_performance_db"
 TABLE_ID = "imtp_results"
-CREDENTIALS_FILE = 'gcp_credentials.json'
 CONCURRENT_REQUESTS = 10 # Number of API calls to make at the same time
+PIPELINE = "IMTP"  # Watermark key for incremental syncs
 
 # =================================================================================
 # REVISED: Define the schema to include the new columns
@@ -35,25 +35,91 @@ IMTP_RESULTS_SCHEMA = [
 ]
 
 # =================================================================================
-# Asynchronous function to fetch a single test result
+# BigQuery upload
 # =================================================================================
-async def fetch_single_test_result(session, test_id, token):
-    """Asynchronously fetches results for a single test ID."""
-    url = f"{FORCEDECKS_URL}/v2019q3/teams/{TENANT_ID}/tests/{test_id}/trials"
-    headers = {"Authorization": f"Bearer {token}"}
+def upload_imtp_results(records):
+    """Upsert IMTP records into the imtp_results table on result_id. Returns True on success."""
+    final_df = pd.DataFrame(records)
+
+    print(f"\nUploading {len(final_df)} total best trials to BigQuery table '{TABLE_ID}'...")
     try:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                # Note: This part calls your original synchronous function.
-                # For maximum performance, this could be rewritten to be fully async.
-                pivoted_df = get_FD_results(test_id, token)
-                return test_id, pivoted_df
-            else:
-                print(f"    Error fetching test {test_id}: Status {response.status}")
-                return test_id, None
+        write_results(final_df, TABLE_ID, dataset=DATASET_ID, table_schema=IMTP_RESULTS_SCHEMA)
+        print("Upload successful!")
+        return True
     except Exception as e:
-        print(f"    Exception fetching test {test_id}: {e}")
-        return test_id, None
+        print(f"An error occurred during the BigQuery upload: {e}")
+        return False
+
+# =================================================================================
+# Per-test record builder (shared with the all-test-types orchestrator)
+# =================================================================================
+def build_imtp_record(athlete_info, test_info, pivoted_trials_df):
+    """
+    Build the imtp_results row for one test from its get_FD_results-style pivot
+    (best trial by peak vertical force).
+
+    Returns:
+        The record dict, or None when the test has no peak vertical force
+    """
+    test_id = test_info['testId']
+    pivoted_trials_df.set_index('metric_id', inplace=True)
+
+    try:
+        peak_force_row = pivoted_trials_df.loc['PEAK_VERTICAL_FORCE_Trial_N']
+    except KeyError:
+        return None
+
+    trial_columns = [col for col in peak_force_row.index if 'trial' in col]
+    peak_force_values = pd.to_numeric(peak_force_row[trial_columns], errors='coerce')
+
+    if peak_force_values.isnull().all():
+        return None
+
+    best_trial_col_name = peak_force_values.idxmax()
+    best_trial_series = pivoted_trials_df[best_trial_col_name]
+
+    # --- REVISED: Calculate age at test safely ---
+    test_date = pd.to_datetime(test_info['modifiedDateUtc']).date()
+    age_at_test = None  # Default to None (which will become NULL in BigQuery)
+
+    # Check if the dateOfBirth from the API is valid before calculating age
+    if pd.notna(athlete_info['dateOfBirth']):
+        dob = pd.to_datetime(athlete_info['dateOfBirth']).date()
+        age_at_test = test_date.year - dob.year - ((test_date.month, test_date.day) < (dob.month, dob.day))
+
+    final_record = {
+        'result_id': result_id_for(PIPELINE, test_id),
+        'assessment_id': test_id,
+        'athlete_name': athlete_info['fullName'],
+        'test_date': test_date,
+        'age_at_test': age_at_test,
+        'ISO_BM_REL_FORCE_PEAK_Trial_N_kg': pd.to_numeric(best_trial_series.get('ISO_BM_REL_FORCE_PEAK_Trial_N_kg'), errors='coerce'),
+        'PEAK_VERTICAL_FORCE_Trial_N': pd.to_numeric(best_trial_series.get('PEAK_VERTICAL_FORCE_Trial_N'), errors='coerce')
+    }
+    return final_record
+
+# =================================================================================
+# HELPER FUNCTION to process the raw JSON from the API
+# =================================================================================
+def process_json_to_pivoted_df(test_data_json):
+    """Takes the raw JSON from a test result and pivots it into a DataFrame (get_FD_results metric ids)."""
+    return trials_json_to_df(test_data_json)
+
+# =================================================================================
+# Asynchronous function to fetch and process a single test result
+# =================================================================================
+async def fetch_and_process_single_test(client, entry):
+    """
+    Asynchronously fetches results for a single test over the shared client and processes the JSON.
+    Returns the pivoted DataFrame (empty when the test has no trials); raises FetchError so the scheduler retries.
+    """
+    status, json_data = await client.get_trials_async(entry.test_id, modified_date=entry.modified_date)
+    if status == 200:
+        pivoted_df = process_json_to_pivoted_df(json_data)
+        return pivoted_df if pivoted_df is not None else pd.DataFrame()
+    elif status == 204:
+        return pd.DataFrame()
+    raise FetchError(f"Status {status}")
 
 # =================================================================================
 # Main processing logic to use asyncio
@@ -65,7 +131,7 @@ async def process_and_upload_all_best_imtp():
     """
     # --- Step 1: Authentication and Setup (Synchronous) ---
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
+        get_credentials()
         print("Successfully loaded GCP credentials.")
     except Exception as e:
         print(f"ERROR: Could not load credentials. {e}")
@@ -80,102 +146,61 @@ async def process_and_upload_all_best_imtp():
         print("No profiles found. Exiting.")
         return
 
-    # --- Step 2: Collect all IMTP test sessions from all athletes (Synchronous) ---
-    all_imtp_test_sessions = []
+    # --- Step 2: Collect IMTP test sessions modified since each profile's last successful sync (Synchronous) ---
+    watermarks = WatermarkStore()
+    listed_imtp_tests = {}
+
+    registry = WorkRegistry()
     for index, athlete in profiles.iterrows():
         # We need the full athlete object to get DOB later
-        tests_df = FD_Tests_by_Profile("2020-01-01T00:00:00Z", athlete['profileId'], token)
+        profile_id = athlete['profileId']
+        tests_df = FD_Tests_by_Profile(watermarks.get(PIPELINE, profile_id), profile_id, get_access_token())
         if tests_df is not None and not tests_df.empty:
-            imtp_tests = tests_df[tests_df['testType'] == 'IMTP']
+            imtp_tests = watermarks.new_tests(PIPELINE, profile_id, tests_df[tests_df['testType'] == 'IMTP'])
+            listed_imtp_tests[profile_id] = imtp_tests
             for _, test_session in imtp_tests.iterrows():
                 # Store the full athlete and test info together
-                all_imtp_test_sessions.append({'athlete': athlete, 'test': test_session})
+                registry.add(athlete, test_session)
     
-    if not all_imtp_test_sessions:
-        print("No IMTP tests found across all profiles.")
+    if not registry:
+        print("No new IMTP tests found across all profiles.")
         return
         
-    print(f"\nFound a total of {len(all_imtp_test_sessions)} IMTP tests to process.")
+    print(f"\nFound a total of {len(registry)} IMTP tests to process.")
 
     # --- Step 3: Fetch all test results concurrently (Asynchronous) ---
     all_best_trials_for_upload = []
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_single_test_result(session, session_info['test']['testId'], token) for session_info in all_imtp_test_sessions]
-        
-        for i in range(0, len(tasks), CONCURRENT_REQUESTS):
-            batch_tasks = tasks[i:i+CONCURRENT_REQUESTS]
-            results = await asyncio.gather(*batch_tasks)
-            
-            # --- Step 4: Process the results from the completed batch ---
-            for test_id, pivoted_trials_df in results:
-                if pivoted_trials_df is None or pivoted_trials_df.empty:
-                    continue
-
-                # Find the original session info that corresponds to this result
-                session_info = next((s for s in all_imtp_test_sessions if s['test']['testId'] == test_id), None)
-                if not session_info:
-                    continue
-
-                athlete_info = session_info['athlete']
-                test_info = session_info['test']
-
-                pivoted_trials_df.set_index('metric_id', inplace=True)
-                
-                try:
-                    peak_force_row = pivoted_trials_df.loc['PEAK_VERTICAL_FORCE_Trial_N']
-                except KeyError:
-                    continue
-
-                trial_columns = [col for col in peak_force_row.index if 'trial' in col]
-                peak_force_values = pd.to_numeric(peak_force_row[trial_columns], errors='coerce')
-                
-                if peak_force_values.isnull().all():
-                    continue
-
-                best_trial_col_name = peak_force_values.idxmax()
-                best_trial_series = pivoted_trials_df[best_trial_col_name]
-                
-                # --- REVISED: Calculate age at test safely ---
-                test_date = pd.to_datetime(test_info['modifiedDateUtc']).date()
-                age_at_test = None  # Default to None (which will become NULL in BigQuery)
-
-                # Check if the dateOfBirth from the API is valid before calculating age
-                if pd.notna(athlete_info['dateOfBirth']):
-                    dob = pd.to_datetime(athlete_info['dateOfBirth']).date()
-                    age_at_test = test_date.year - dob.year - ((test_date.month, test_date.day) < (dob.month, dob.day))
-
-                final_record = {
-                    'result_id': str(uuid.uuid4()),
-                    'assessment_id': test_id,
-                    'athlete_name': athlete_info['fullName'],
-                    'test_date': test_date,
-                    'age_at_test': age_at_test,
-                    'ISO_BM_REL_FORCE_PEAK_Trial_N_kg': pd.to_numeric(best_trial_series.get('ISO_BM_REL_FORCE_PEAK_Trial_N/kg'), errors='coerce'),
-                    'PEAK_VERTICAL_FORCE_Trial_N': pd.to_numeric(best_trial_series.get('PEAK_VERTICAL_FORCE_Trial_N'), errors='coerce')
-                }
-                all_best_trials_for_upload.append(final_record)
-                print(f"  Processed best trial for {athlete_info['fullName']} on {test_date}.")
-
+    scheduler = FetchScheduler(concurrency=CONCURRENT_REQUESTS)
+    async with get_client() as client:
+        # Results stream in as each fetch completes; CONCURRENT_REQUESTS fetches stay in flight
+        async for entry, pivoted_trials_df, error in scheduler.stream(registry, lambda entry: fetch_and_process_single_test(client, entry)):
+            if error is not None:
+                print(f"    Error fetching test {entry.test_id}: {error}")
+                registry.mark(entry.test_id, FAILED, error=str(error))
+                continue
+            if pivoted_trials_df is None or pivoted_trials_df.empty:
+                registry.mark(entry.test_id, SKIPPED)
+                continue
+
+            final_record = build_imtp_record(entry.athlete, entry.test, pivoted_trials_df)
+            if final_record is None:
+                registry.mark(entry.test_id, SKIPPED)
+                continue
+            registry.mark(entry.test_id, DONE)
+            all_best_trials_for_upload.append(final_record)
+            print(f"  Processed best trial for {final_record['athlete_name']} on {final_record['test_date']}.")
+
+    print(f"\nTest status summary: {registry.summary()}")
     # --- Step 5: Upload all results at once (Synchronous) ---
     if not all_best_trials_for_upload:
         print("\nNo valid best trials found to upload.")
+        watermarks.commit_run(PIPELINE, listed_imtp_tests, registry.failed_ids())
         return
 
-    final_df = pd.DataFrame(all_best_trials_for_upload)
-
-    print(f"\nUploading {len(final_df)} total best trials to BigQuery table '{TABLE_ID}'...")
-    try:
-        pandas_gbq.to_gbq(
-            final_df,
-            destination_table=f"{DATASET_ID}.{TABLE_ID}",
-            project_id=PROJECT_ID,
-            credentials=credentials,
-            if_exists='append',
-            table_schema=IMTP_RESULTS_SCHEMA
-        )
-        print("Upload successful!")
-    except Exception as e:
-        print(f"An error occurred during the BigQuery upload: {e}")
+    # Only move watermarks once the rows are in
+    if upload_imtp_results(all_best_trials_for_upload):
+        watermarks.commit_run(PIPELINE, listed_imtp_tests, registry.failed_ids())
+        print(f"Advanced sync watermarks for {len(listed_imtp_tests)} profiles ({len(registry.failed_ids())} failed tests will be retried).")
 
 # =================================================================================
 # MAIN EXECUTION
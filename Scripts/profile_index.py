@@ -0,0 +1,112 @@
+"""
+In-process index of the tenant's VALD profiles (profileId -> profile row).
+The full roster is downloaded once and then reloaded at most every REFRESH_INTERVAL;
+in between, lookups are dict reads. A profileId the index has not seen (an athlete
+created after the last load) is fetched on its own from the single-profile endpoint,
+and unknown ids are remembered for MISS_TTL so a bad id cannot trigger a fetch per
+webhook. Lookup cost is independent of roster size.
+"""
+
+import time
+import logging
+import threading
+
+from VALDapiHelpers import get_profiles, get_profile
+from token_generator import get_access_token
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+REFRESH_INTERVAL = 900  # Seconds before a lookup triggers a full roster reload
+MISS_TTL = 60  # Seconds an id the API does not know is answered as missing without asking again
+
+log = logging.getLogger(__name__)
+
+
+class ProfileIndex:
+    """profileId -> profile Series (givenName, familyName, fullName, dateOfBirth, age, ...)."""
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._profiles = {}
+        self._missing = {}  # profileId -> monotonic time it was found missing
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def load(self):
+        """Download the whole roster (one request). Raises when the roster cannot be fetched."""
+        profiles = get_profiles(get_access_token())
+        if profiles.empty:
+            raise RuntimeError("Profiles API returned no profiles")
+        with self._lock:
+            self._profiles = {str(row['profileId']): row for _, row in profiles.iterrows()}
+            self._missing = {}
+            self._loaded_at = time.monotonic()
+        log.info(f"Loaded {len(self._profiles)} profiles")
+        return self
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval
+
+    def _reload_if_stale(self):
+        # One reload at a time; threads that waited re-check before downloading again
+        with self._refresh_lock:
+            if not self._is_stale():
+                return
+            try:
+                self.load()
+            except Exception as e:
+                log.error(f"Error reloading profiles: {e}")
+                if self._loaded_at is not None:
+                    # Keep serving the old roster; try again after another interval
+                    self._loaded_at = time.monotonic()
+                else:
+                    # Never loaded: serve single-profile fetches and retry the roster after MISS_TTL
+                    self._loaded_at = time.monotonic() - self.refresh_interval + MISS_TTL
+
+    def get(self, profile_id):
+        """
+        Look up a profile.
+
+        Returns:
+            The profile row (pd.Series), or None when VALD does not know the profileId
+        """
+        profile_id = str(profile_id)
+        if self._is_stale():
+            self._reload_if_stale()
+        profile = self._profiles.get(profile_id)
+        if profile is not None:
+            return profile
+        missing_since = self._missing.get(profile_id)
+        if missing_since is not None and time.monotonic() - missing_since < MISS_TTL:
+            return None
+        profile = get_profile(profile_id, get_access_token())
+        with self._lock:
+            if profile is None:
+                self._missing[profile_id] = time.monotonic()
+            else:
+                self._profiles[profile_id] = profile
+                self._missing.pop(profile_id, None)
+        if profile is None:
+            log.warning(f"Profile {profile_id} not found")
+        return profile
+
+    def __contains__(self, profile_id):
+        return str(profile_id) in self._profiles
+
+    def __len__(self):
+        return len(self._profiles)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_profile_index():
+    """Process-wide ProfileIndex (loaded on first lookup)."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ProfileIndex()
+        return _index
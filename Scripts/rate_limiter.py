@@ -0,0 +1,187 @@
+"""
+Adaptive rate limiter for the VALD API.
+A token bucket (requests per second) plus a concurrency limit, both tuned from
+server feedback: 429s and Retry-After halve the rate and pause the bucket,
+runs of successful responses raise it again (AIMD). Safe to share between
+worker threads and asyncio tasks.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+INITIAL_RATE = 5.0  # Requests per second to start with
+MIN_RATE = 0.5  # Never throttle below this
+MAX_RATE = 25.0  # Never ramp above this
+BURST = 5  # Bucket capacity (requests that may go out back to back)
+INITIAL_CONCURRENCY = 4  # Requests allowed in flight to start with
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+RATE_STEP = 0.5  # Additive increase applied after a clean run
+INCREASE_AFTER = 20  # Consecutive successes needed before ramping up
+DECREASE_FACTOR = 0.5  # Multiplicative decrease applied on a 429
+DECREASE_COOLDOWN = 2.0  # Seconds; a burst of 429s inside this window counts as one
+ASYNC_POLL_INTERVAL = 0.02  # Seconds between concurrency-slot checks for asyncio callers
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """Token bucket with an adaptive concurrency limit, driven by server responses."""
+
+    def __init__(self, rate=INITIAL_RATE, burst=BURST, concurrency=INITIAL_CONCURRENCY,
+                 min_rate=MIN_RATE, max_rate=MAX_RATE,
+                 min_concurrency=MIN_CONCURRENCY, max_concurrency=MAX_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._throttled = 0
+        self._total = 0
+
+        self._lock = threading.Lock()
+        self._slot_available = threading.Condition(self._lock)
+
+    # -----------------------------------------------------------------------------
+    # Bucket internals (call with self._lock held)
+    # -----------------------------------------------------------------------------
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def _reserve(self):
+        """Take one token (the balance may go negative) and return how long to wait for it."""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+        return max(wait, self._blocked_until - now)
+
+    def _try_take_slot(self):
+        if self._in_flight < self.concurrency:
+            self._in_flight += 1
+            return True
+        return False
+
+    # -----------------------------------------------------------------------------
+    # Acquire / release
+    # -----------------------------------------------------------------------------
+    def acquire(self):
+        """Block the calling thread until a concurrency slot and a token are available."""
+        with self._slot_available:
+            while not self._try_take_slot():
+                self._slot_available.wait()
+            wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a concurrency slot and a token are available."""
+        while True:
+            with self._lock:
+                if self._try_take_slot():
+                    wait = self._reserve()
+                    break
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                # Cancelled (e.g. a per-attempt timeout) while holding the slot: give it back
+                self.release()
+                raise
+
+    def release(self):
+        """Give back the concurrency slot taken by acquire()/acquire_async()."""
+        with self._slot_available:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._slot_available.notify()
+
+    # -----------------------------------------------------------------------------
+    # Server feedback
+    # -----------------------------------------------------------------------------
+    def on_response(self, status, retry_after=None):
+        """
+        Feed one response back into the limiter.
+
+        Args:
+            status: HTTP status code of the response
+            retry_after: Raw Retry-After header value, if the server sent one
+        """
+        with self._slot_available:
+            self._total += 1
+            if status == 429:
+                self._throttled += 1
+                self._successes = 0
+                now = time.monotonic()
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self._last_decrease = now
+                    self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+                    self.concurrency = max(self.min_concurrency, int(self.concurrency * DECREASE_FACTOR))
+                pause = self._parse_retry_after(retry_after)
+                if pause is None:
+                    pause = 1.0 / self.rate
+                self._blocked_until = max(self._blocked_until, now + pause)
+                self._tokens = min(self._tokens, 0.0)
+                log.warning(f"Rate limited by VALD: now {self.rate:.2f} req/s, {self.concurrency} in flight, paused {pause:.2f}s "
+                            f"({self._throttled}/{self._total} responses throttled)")
+            elif 200 <= status < 300 or status == 204:
+                self._successes += 1
+                if self._successes >= INCREASE_AFTER:
+                    self._successes = 0
+                    self.rate = min(self.max_rate, self.rate + RATE_STEP)
+                    if self.concurrency < self.max_concurrency:
+                        self.concurrency += 1
+                        self._slot_available.notify()
+                    log.debug(f"Rate limiter ramped up to {self.rate:.2f} req/s, {self.concurrency} in flight")
+
+    @staticmethod
+    def _parse_retry_after(retry_after):
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except (TypeError, ValueError):
+            return None
+
+    def stats(self):
+        """Snapshot of the limiter state for logging."""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "concurrency": self.concurrency,
+                "in_flight": self._in_flight,
+                "throttled": self._throttled,
+                "total": self._total,
+            }
+
+
+# =================================================================================
+# Process-wide shared limiter
+# =================================================================================
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide limiter shared by every VALD client in this process."""
+    global _default_limiter
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = AdaptiveRateLimiter()
+        return _default_limiter
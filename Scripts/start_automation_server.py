@@ -18,6 +18,8 @@ def main():
     # Check if required files exist
     required_files = [
         "test_automation_server.py",
+        "job_queue.py",
+        "profile_index.py",
         "token_generator.py",
         "VALDapiHelpers.py",
         "enhanced_cmj_processor.py",
@@ -0,0 +1,264 @@
+"""
+Single-pass sync of every ForceDecks test type.
+Lists each profile's tests once, then dispatches CMJ/PPU/HJ/IMTP tests to their
+type-specific record builders through one shared fetch pool and one worker pool,
+and writes every results table in the same run. Replaces running
+enhanced_cmj_processor.py, process_ppu.py, process_hj.py and process_imtp.py
+back to back (four profile scans returning the same test list).
+"""
+
+import uuid
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from token_generator import get_access_token
+from bq_client import get_credentials
+from VALDapiHelpers import get_profiles, FD_Tests_by_Profile, trials_json_to_df
+from vald_client import get_client
+from sync_watermarks import WatermarkStore, start_date_for, to_utc
+from fetch_scheduler import FetchScheduler, FetchError
+from cmj_stats import get_cmj_stats
+from athlete_directory import get_athlete_directory
+import enhanced_cmj_processor as cmj
+import process_ppu as ppu
+import process_hj as hj
+import process_imtp as imtp
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+CONCURRENT_REQUESTS = 10  # Trial fetches in flight (the shared rate limiter still applies)
+MAX_WORKERS = 8  # Threads for the pandas-heavy record builders
+TEST_TYPES = ('CMJ', 'PPU', 'HJ', 'IMTP')
+
+log = logging.getLogger(__name__)
+
+
+# =================================================================================
+# Type-specific handlers: raw trials JSON -> results-table record
+# =================================================================================
+def _handle_cmj(athlete, test_row, trials_json, run):
+    raw_data = trials_json_to_df(trials_json)
+    if raw_data is None or raw_data.empty or run['global_means'] is None:
+        return None
+    run['cmj_stats'].update_from_raw(test_row['testId'], raw_data)
+    profile_id = str(athlete['profileId'])
+    return cmj.build_cmj_record(
+        test_row, raw_data, run['assessment_ids'][profile_id], run['global_means'], run['global_stds'],
+        str(athlete['fullName']), athlete.get('dateOfBirth'), profile_id
+    )
+
+def _handle_ppu(athlete, test_row, trials_json, run):
+    pivoted_trials_df = ppu.process_json_to_pivoted_df(trials_json)
+    if pivoted_trials_df is None or pivoted_trials_df.empty:
+        return None
+    return ppu.build_ppu_record(athlete, test_row, pivoted_trials_df)
+
+def _handle_hj(athlete, test_row, trials_json, run):
+    pivoted_trials_df = hj.process_json_to_pivoted_df(trials_json)
+    if pivoted_trials_df is None or pivoted_trials_df.empty:
+        return None
+    return hj.build_hj_record(athlete, test_row, pivoted_trials_df)
+
+def _handle_imtp(athlete, test_row, trials_json, run):
+    pivoted_trials_df = imtp.process_json_to_pivoted_df(trials_json)
+    if pivoted_trials_df is None or pivoted_trials_df.empty:
+        return None
+    return imtp.build_imtp_record(athlete, test_row, pivoted_trials_df)
+
+HANDLERS = {
+    'CMJ': _handle_cmj,
+    'PPU': _handle_ppu,
+    'HJ': _handle_hj,
+    'IMTP': _handle_imtp,
+}
+
+
+def _upload(test_type, records, run):
+    """Write one test type's records to its results table. Returns True on success."""
+    if test_type == 'CMJ':
+        return cmj.upload_to_bigquery(cmj.finalize_cmj_results(records, run['cmj_stats']), cmj.TABLE_ID)
+    if test_type == 'PPU':
+        return ppu.upload_ppu_results(records)
+    if test_type == 'HJ':
+        return hj.upload_hj_results(records)
+    return imtp.upload_imtp_results(records)
+
+
+# =================================================================================
+# Shared fetch pool
+# =================================================================================
+async def fetch_trials(client, test_row):
+    """
+    Fetch one test's raw trials JSON (through the trial cache).
+
+    Returns:
+        The trial list ([] for a test with no trials); raises FetchError so the scheduler retries
+    """
+    status, body = await client.get_trials_async(test_row['testId'], modified_date=test_row['modifiedDateUtc'])
+    if status == 200:
+        return body
+    if status == 204:
+        return []
+    raise FetchError(f"Status {status}")
+
+
+def _count_cmj_trials(stats, test_id, trials_json):
+    stats.update_from_raw(test_id, trials_json_to_df(trials_json))
+
+
+async def bootstrap_cmj_stats(client, scheduler, cmj_history, executor, stats):
+    """Build the incremental CMJ stats from every listed CMJ test (only needed when no state was saved)."""
+    loop = asyncio.get_running_loop()
+    failed = 0
+    async for test_row, trials_json, error in scheduler.stream(cmj_history, lambda test_row: fetch_trials(client, test_row),
+                                                            label=lambda test_row: test_row['testId']):
+        if error is None and trials_json:
+            try:
+                await loop.run_in_executor(executor, _count_cmj_trials, stats, test_row['testId'], trials_json)
+            except Exception as e:
+                error = e
+        if error is not None:
+            failed += 1
+            print(f"    Error reading CMJ test {test_row['testId']} for the stats bootstrap: {error}")
+    stats.save()
+    print(f"CMJ stats: {stats.summary()}")
+    if failed:
+        print(f"WARNING: {failed} of {len(cmj_history)} CMJ tests could not be read and are missing from the bootstrap stats.")
+
+
+async def process_test(client, executor, work_item, run):
+    """
+    Fetch one test and hand it to its type's builder.
+
+    Returns:
+        The record, or None when there is nothing to upload. Builder errors propagate, so the
+        scheduler reports the test as failed and its watermark is held back for a retry
+    """
+    test_type, athlete, test_row = work_item
+    trials_json = await fetch_trials(client, test_row)
+    if not trials_json:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, HANDLERS[test_type], athlete, test_row, trials_json, run)
+
+
+# =================================================================================
+# Main pipeline
+# =================================================================================
+async def main_pipeline(test_types=TEST_TYPES):
+    """List every profile's tests once, process all requested test types, and upload each results table."""
+    try:
+        get_credentials()
+        print("Successfully loaded GCP credentials.")
+    except Exception as e:
+        print(f"ERROR: Could not load credentials. {e}")
+        return
+
+    token = get_access_token()
+    print("Fetching all athlete profiles...")
+    profiles = get_profiles(token)
+    if profiles is None or profiles.empty:
+        print("No profiles found. Exiting.")
+        return
+    if 'CMJ' in test_types:
+        try:
+            print(f"Loaded {len(get_athlete_directory().load())} athletes from the athletes table")
+        except Exception as e:
+            print(f"WARNING: Could not preload the athletes table; lookups will retry. {e}")
+
+    # --- One listing per profile, split by test type ---
+    # The listing starts at the profile's oldest watermark across the requested types, and each
+    # type keeps only the tests past its own. Bootstrapping the CMJ stats needs the full CMJ
+    # history, so that run lists from the CMJ start date at the latest.
+    watermarks = WatermarkStore()
+    cmj_stats = get_cmj_stats()
+    bootstrap_stats = 'CMJ' in test_types and cmj_stats.is_empty
+    listed_tests = {test_type: {} for test_type in test_types}
+    work_items = []
+    cmj_history = []
+    for index, athlete in profiles.iterrows():
+        profile_id = str(athlete['profileId'])
+        start_date = watermarks.earliest(test_types, profile_id)
+        if bootstrap_stats:
+            start_date = min(start_date, start_date_for('CMJ'), key=to_utc)
+        tests_df = FD_Tests_by_Profile(start_date, profile_id, get_access_token())
+        if tests_df is None or tests_df.empty:
+            continue
+        for test_type in test_types:
+            type_tests = tests_df[tests_df['testType'] == test_type]
+            if bootstrap_stats and test_type == 'CMJ':
+                history = type_tests[to_utc(type_tests['modifiedDateUtc']) >= to_utc(start_date_for('CMJ'))]
+                cmj_history.extend(test_row for _, test_row in history.iterrows())
+            new_tests = watermarks.new_tests(test_type, profile_id, type_tests)
+            if new_tests.empty:
+                continue
+            listed_tests[test_type][profile_id] = new_tests
+            work_items.extend((test_type, athlete, test_row) for _, test_row in new_tests.iterrows())
+
+    if not work_items:
+        print("No new tests found for any test type.")
+        return
+    counts = pd.Series([item[0] for item in work_items]).value_counts().to_dict()
+    print(f"\nFound {len(work_items)} new tests to process: {counts}")
+
+    # --- Fetch and build every record through the shared pools ---
+    run = {
+        'global_means': None,
+        'global_stds': None,
+        'cmj_stats': cmj_stats,
+        'assessment_ids': {str(profile_id): str(uuid.uuid4()) for profile_id in profiles['profileId']},
+    }
+    records = {test_type: [] for test_type in test_types}
+    failed_test_ids = {test_type: set() for test_type in test_types}
+    scheduler = FetchScheduler(concurrency=CONCURRENT_REQUESTS)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        async with get_client() as client:
+            if 'CMJ' in test_types and listed_tests['CMJ']:
+                if bootstrap_stats:
+                    print(f"No saved CMJ stats found. Bootstrapping over {len(cmj_history)} tests...")
+                    await bootstrap_cmj_stats(client, scheduler, cmj_history, executor, cmj_stats)
+                # Score this run against the stats as loaded; new trials are folded in for the next run
+                run['global_means'], run['global_stds'] = cmj_stats.means(), cmj_stats.stds()
+                if run['global_means'] is None or run['global_stds'] is None:
+                    print("No CMJ trial data found for global stats. Skipping CMJ this run.")
+                    del listed_tests['CMJ']
+                    work_items = [item for item in work_items if item[0] != 'CMJ']
+
+            done = 0
+            async for (test_type, athlete, test_row), record, error in scheduler.stream(
+                    work_items, lambda work_item: process_test(client, executor, work_item, run),
+                    label=lambda work_item: f"{work_item[0]} test {work_item[2]['testId']}"):
+                done += 1
+                if error is not None:
+                    print(f"    Error processing {test_type} test {test_row['testId']}: {error}")
+                    failed_test_ids[test_type].add(test_row['testId'])
+                elif record is not None:
+                    records[test_type].append(record)
+                if done % 100 == 0:
+                    print(f"  Processed {done}/{len(work_items)} tests...")
+
+    # --- Upload each results table and advance its watermarks ---
+    for test_type in listed_tests:
+        if records[test_type]:
+            print(f"\nUploading {len(records[test_type])} {test_type} results...")
+            if not _upload(test_type, records[test_type], run):
+                print(f"{test_type} upload failed; its watermarks were not advanced.")
+                continue
+        else:
+            print(f"\nNo valid {test_type} results to upload.")
+        watermarks.commit_run(test_type, listed_tests[test_type], failed_test_ids[test_type])
+        if test_type == 'CMJ':
+            cmj_stats.save()
+        print(f"Advanced {test_type} sync watermarks for {len(listed_tests[test_type])} profiles "
+              f"({len(failed_test_ids[test_type])} failed tests will be retried).")
+
+
+# =================================================================================
+# MAIN EXECUTION
+# =================================================================================
+if __name__ == "__main__":
+    asyncio.run(main_pipeline())
@@ -0,0 +1,167 @@
+"""
+Persisted sync watermarks for incremental VALD pulls.
+Each pipeline (CMJ, PPU, HJ, IMTP) keeps, per profile, the modifiedDateUtc of the
+newest test it has fully processed and uploaded. The next run passes that value
+as ModifiedFromUtc so only new or re-analysed tests are fetched.
+"""
+
+import os
+import json
+import logging
+
+import pandas as pd
+from filelock import FileLock
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+WATERMARK_FILE = os.getenv("SYNC_WATERMARK_PATH", ".sync_watermarks.json")
+DEFAULT_START_DATE = "2020-01-01T00:00:00Z"  # Used for profiles that have never synced
+PIPELINE_START_DATES = {"CMJ": "2021-01-01T00:00:00Z"}  # Pipelines whose history starts later than DEFAULT_START_DATE
+
+log = logging.getLogger(__name__)
+
+
+def to_utc(value):
+    """Parse a VALD timestamp (or watermark string) into a tz-aware UTC Timestamp."""
+    return pd.to_datetime(value, utc=True)
+
+
+def start_date_for(pipeline):
+    """Where a pipeline's history starts for a profile that has never synced."""
+    return PIPELINE_START_DATES.get(pipeline, DEFAULT_START_DATE)
+
+
+def format_utc(ts):
+    """
+    Format a timestamp the way the VALD tests endpoint expects it (no '+' to escape in the URL).
+
+    Keeps 7 fractional digits (100 ns, the precision of VALD's modifiedDateUtc), so a
+    watermark taken from a test compares equal to it rather than just before it.
+    """
+    ts = to_utc(ts)
+    ticks = (ts.microsecond * 1000 + ts.nanosecond) // 100
+    return f"{ts.strftime('%Y-%m-%dT%H:%M:%S')}.{ticks:07d}Z"
+
+
+def safe_watermark(tests_df, failed_test_ids, current=None):
+    """
+    Work out how far a profile's watermark may move after a run.
+
+    The watermark advances to the newest modifiedDateUtc that has no failed test at
+    or before it, so a test that failed to fetch is picked up again next run.
+
+    Args:
+        tests_df: DataFrame of listed tests with 'testId' and 'modifiedDateUtc'
+        failed_test_ids: Test IDs whose fetch/processing failed and must be retried
+        current: The watermark the run started from
+
+    Returns:
+        Watermark string, or current when nothing can be advanced
+    """
+    if tests_df is None or tests_df.empty:
+        return current
+    modified = to_utc(tests_df['modifiedDateUtc'])
+    failed_mask = tests_df['testId'].isin(set(failed_test_ids))
+    if failed_mask.any():
+        first_failure = modified[failed_mask].min()
+        modified = modified[modified < first_failure]
+    if modified.empty:
+        return current
+    newest = modified.max()
+    if current is not None and newest <= to_utc(current):
+        return current
+    return format_utc(newest)
+
+
+class WatermarkStore:
+    """JSON-backed {pipeline: {profileId: watermark}} store, safe across processes."""
+
+    def __init__(self, path=WATERMARK_FILE):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self._data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, pipeline, profile_id, default=None):
+        """Return the ModifiedFromUtc to request for this pipeline/profile (the pipeline's start date if it never synced)."""
+        return self._data.get(pipeline, {}).get(str(profile_id), default or start_date_for(pipeline))
+
+    def new_tests(self, pipeline, profile_id, tests_df):
+        """
+        Drop tests at or before the watermark (ModifiedFromUtc is inclusive on the API side).
+
+        A profile that never synced keeps the tests from the pipeline's start date on, since a
+        listing shared with other pipelines may reach further back.
+        """
+        if tests_df is None or tests_df.empty:
+            return tests_df
+        modified = to_utc(tests_df['modifiedDateUtc'])
+        watermark = self._data.get(pipeline, {}).get(str(profile_id))
+        if watermark is None:
+            return tests_df[modified >= to_utc(start_date_for(pipeline))]
+        return tests_df[modified > to_utc(watermark)]
+
+    def earliest(self, pipelines, profile_id):
+        """Oldest watermark of a profile across pipelines (a never-synced pipeline counts as its start date)."""
+        marks = [self.get(pipeline, profile_id) for pipeline in pipelines]
+        return min(marks, key=to_utc)
+
+    def advance(self, pipeline, profile_id, watermark):
+        """Move a profile's watermark forward (never backwards). Call save() to persist."""
+        if watermark is None:
+            return
+        profile_marks = self._data.setdefault(pipeline, {})
+        current = profile_marks.get(str(profile_id))
+        if current is None or to_utc(watermark) > to_utc(current):
+            profile_marks[str(profile_id)] = watermark
+
+    def commit_run(self, pipeline, listed_tests, failed_test_ids):
+        """
+        Advance every profile seen in a run and persist. Call only after the upload succeeded.
+
+        Args:
+            pipeline: Pipeline key, e.g. 'CMJ'
+            listed_tests: {profileId: DataFrame of that profile's tests handled this run}
+            failed_test_ids: Test IDs to retry next run
+        """
+        for profile_id, tests_df in listed_tests.items():
+            current = self._data.get(pipeline, {}).get(str(profile_id))
+            self.advance(pipeline, profile_id, safe_watermark(tests_df, failed_test_ids, current))
+        self.save()
+
+    def reset(self, pipeline=None):
+        """Forget watermarks on disk so the next run re-pulls everything (one pipeline or all)."""
+        with FileLock(self.lock_path, timeout=10):
+            on_disk = self._read()
+            if pipeline is None:
+                on_disk = {}
+            else:
+                on_disk.pop(pipeline, None)
+            self._write(on_disk)
+            self._data = on_disk
+
+    def _write(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        """Merge this run's watermarks into the file atomically."""
+        with FileLock(self.lock_path, timeout=10):
+            on_disk = self._read()
+            for pipeline, marks in self._data.items():
+                merged = on_disk.setdefault(pipeline, {})
+                for profile_id, watermark in marks.items():
+                    if profile_id not in merged or to_utc(watermark) > to_utc(merged[profile_id]):
+                        merged[profile_id] = watermark
+            self._write(on_disk)
+            self._data = on_disk
+        log.info(f"Saved sync watermarks to {self.path}")
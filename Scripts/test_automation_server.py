@@ -2,25 +2,31 @@ import asyncio
 import json
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import pandas as pd
 import uuid
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import uvicorn
 import subprocess
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 # Import existing modules
-from token_generator import get_access_token
-from VALDapiHelpers import get_profiles, FD_Tests_by_Profile, get_FD_results
-from enhanced_cmj_processor import process_cmj_test_with_composite
+from VALDapiHelpers import FD_Tests_by_Profile, get_FD_results, trials_json_to_df
+from vald_client import get_client
+from newcompositescore import get_best_trial
+from cmj_stats import get_stats_snapshot
+from athlete_directory import get_athlete_directory
+from profile_index import get_profile_index
+from job_queue import get_job_queue, QueueFull
 from process_ppu import process_json_to_pivoted_df
 from process_hj import process_json_to_pivoted_df as process_hj_json
-from process_imtp import get_FD_results as get_imtp_results
+from process_imtp import process_json_to_pivoted_df as process_imtp_json
 
 # Configure logging
 logging.basicConfig(
@@ -33,6 +39,89 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+# Nothing blocking runs on the event loop: pandas pivoting and scoring go to the CPU pool,
+# file I/O and BigQuery/VALD lookups made through synchronous clients go to the I/O pool.
+# Both are bounded, so a burst of webhooks queues instead of spawning threads.
+CPU_WORKERS = int(os.getenv('SERVER_CPU_WORKERS', str(os.cpu_count() or 2)))
+IO_WORKERS = int(os.getenv('SERVER_IO_WORKERS', '8'))
+
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='server-cpu')
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='server-io')
+
+# Webhooks are queued durably (job_queue.py) and drained by this many concurrent workers,
+# so a burst after a testing session is processed at a controlled rate
+JOB_WORKERS = int(os.getenv('SERVER_JOB_WORKERS', '4'))
+JOB_POLL_INTERVAL = 5  # Seconds an idle worker waits before re-checking for retries that became due
+QUEUE_FULL_RETRY_AFTER = 60  # Retry-After (seconds) sent when the backlog is full
+STATUS_EVICT_INTERVAL = 600  # Seconds between evictions of old finished jobs from the status store
+
+async def run_cpu(func, *args, **kwargs):
+    """Run a CPU-bound call (pandas, scoring) on the bounded CPU pool."""
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, partial(func, *args, **kwargs))
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking I/O call (files, synchronous API/BigQuery clients) on the bounded I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, partial(func, *args, **kwargs))
+
+def score_cmj_trials(json_data, snapshot):
+    """Flatten a CMJ test's trials and pick the best trial by composite score against the snapshot."""
+    raw_data = trials_json_to_df(json_data)
+    if raw_data is None or raw_data.empty:
+        raise ValueError("No CMJ data found for processing")
+    trial_cols = [col for col in raw_data.columns if 'trial' in col.lower()]
+    pivot_data = raw_data.set_index('metric_id')[trial_cols]
+    best_trial_col, best_score, composite_scores, best_metrics = get_best_trial(pivot_data, snapshot.means, snapshot.stds)
+    if best_trial_col is None:
+        raise ValueError("No valid composite scores for CMJ test")
+    return best_trial_col, best_score, best_metrics
+
+def summarize_best_values(pivoted_df):
+    """Best, all and count of trial values per metric (PPU, IMTP)."""
+    metrics = {}
+    for _, row in pivoted_df.iterrows():
+        metric_id = row['metric_id']
+        trial_values = [row[col] for col in row.index if 'trial' in col and pd.notna(row[col])]
+        if trial_values:
+            metrics[metric_id] = {
+                "best_value": max(trial_values),
+                "all_values": trial_values,
+                "num_trials": len(trial_values)
+            }
+    return metrics
+
+def summarize_rsi(pivoted_df):
+    """Average of the best 5 trials for every RSI metric (HJ)."""
+    rsi_metrics = {}
+    for _, row in pivoted_df.iterrows():
+        metric_id = row['metric_id']
+        if 'RSI' in metric_id:
+            trial_values = [row[col] for col in row.index if 'trial' in col and pd.notna(row[col])]
+            if trial_values:
+                # Get best 5 RSI values
+                best_5 = sorted(trial_values, reverse=True)[:5]
+                avg_rsi = sum(best_5) / len(best_5)
+                rsi_metrics[metric_id] = {
+                    "best_5_avg": avg_rsi,
+                    "all_values": trial_values,
+                    "best_5_values": best_5
+                }
+    return rsi_metrics
+
+def write_report(report_filename, report):
+    os.makedirs(os.path.dirname(report_filename), exist_ok=True)
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+def session_report_path(assessment_id):
+    return f"reports/sessions/{assessment_id}_report.json"
+
+def read_report(report_filename):
+    with open(report_filename, 'r') as f:
+        return json.load(f)
+
 # FastAPI app
 app = FastAPI(title="VALD Test Automation Server", version="1.0.0")
 
@@ -50,15 +139,29 @@ class ProcessingStatus(BaseModel):
     message: str
     timestamp: str
     report_url: Optional[str] = None
+    athlete_id: Optional[str] = None
+    test_type: Optional[str] = None
+
+# Processing status is persisted with each job in the job queue; see job_status()
+job_workers: List[asyncio.Task] = []
+jobs_available = asyncio.Event()
 
-# Global storage for processing status (in production, use a database)
-processing_status: Dict[str, ProcessingStatus] = {}
+def job_status(job: Dict) -> ProcessingStatus:
+    """ProcessingStatus view of a job-queue row"""
+    return ProcessingStatus(
+        test_id=job['test_id'],
+        status=job['status'],
+        message=job['message'] or "",
+        timestamp=datetime.fromtimestamp(job['updated_at']).isoformat(),
+        report_url=job['report_url'],
+        athlete_id=job['athlete_id'],
+        test_type=job['test_type']
+    )
 
 class TestProcessor:
     """Handles automatic processing of different test types"""
     
     def __init__(self):
-        self.token = get_access_token()
         self.test_processors = {
             'CMJ': self.process_cmj_test,
             'PPU': self.process_ppu_test,
@@ -66,208 +169,211 @@ class TestProcessor:
             'IMTP': self.process_imtp_test
         }
     
-    async def process_test(self, test_id: str, athlete_id: str, test_type: str) -> Dict:
-        """Main method to process any test type"""
-        logger.info(f"Starting processing for test {test_id} (type: {test_type})")
-        
-        if test_type not in self.test_processors:
-            raise ValueError(f"Unsupported test type: {test_type}")
+    async def process_session(self, athlete_id: str, tests: List[Tuple[str, str]]) -> Dict:
+        """
+        Process one athlete's coalesced tests as a single assessment: one profile lookup,
+        one shared assessment_id, concurrent fetches and one combined report.
+
+        Args:
+            athlete_id: VALD profileId
+            tests: (test_id, test_type) pairs
+
+        Returns:
+            Dict with assessment_id, per-test results ({test_id: {"success", ...}}) and the report
+        """
+        logger.info(f"Starting session processing for athlete {athlete_id}: {[test_id for test_id, _ in tests]}")
+        assessment_id = str(uuid.uuid4())
         
         try:
-            # Get athlete info
-            profiles = get_profiles(self.token)
-            athlete_info = profiles[profiles['profileId'] == athlete_id].iloc[0] if not profiles.empty else None
-            
+            # Get athlete info from the in-process profile index (dict lookup; a miss fetches one profile)
+            athlete_info = await run_io(get_profile_index().get, athlete_id)
             if athlete_info is None:
                 raise ValueError(f"Athlete {athlete_id} not found")
-            
-            # Process the test
-            result = await self.test_processors[test_type](test_id, athlete_info)
-            
-            # Generate report
-            report_data = await self.generate_report(test_id, test_type, athlete_info, result)
-            
-            return {
-                "success": True,
-                "test_id": test_id,
-                "test_type": test_type,
-                "athlete_name": athlete_info['fullName'],
-                "processed_data": result,
-                "report": report_data
-            }
-            
         except Exception as e:
-            logger.error(f"Error processing test {test_id}: {str(e)}")
+            logger.error(f"Error looking up athlete {athlete_id}: {str(e)}")
             return {
                 "success": False,
-                "test_id": test_id,
-                "error": str(e)
+                "assessment_id": assessment_id,
+                "results": {test_id: {"success": False, "test_type": test_type, "error": str(e)} for test_id, test_type in tests}
             }
+        
+        # Fetch and process every test of the session concurrently
+        outcomes = await asyncio.gather(
+            *(self.process_test(test_id, test_type, athlete_info, assessment_id) for test_id, test_type in tests)
+        )
+        results = dict(zip([test_id for test_id, _ in tests], outcomes))
+        
+        report_data = None
+        if any(result["success"] for result in results.values()):
+            report_data = await self.generate_session_report(assessment_id, athlete_info, results)
+        
+        return {
+            "success": report_data is not None,
+            "assessment_id": assessment_id,
+            "athlete_name": athlete_info['fullName'],
+            "results": results,
+            "report": report_data
+        }
+    
+    async def process_test(self, test_id: str, test_type: str, athlete_info: pd.Series, assessment_id: str) -> Dict:
+        """Process one test of a session"""
+        logger.info(f"Starting processing for test {test_id} (type: {test_type})")
+        try:
+            if test_type not in self.test_processors:
+                raise ValueError(f"Unsupported test type: {test_type}")
+            result = await self.test_processors[test_type](test_id, athlete_info, assessment_id)
+            return {"success": True, "test_type": test_type, "processed_data": result}
+        except Exception as e:
+            logger.error(f"Error processing test {test_id}: {str(e)}")
+            return {"success": False, "test_type": test_type, "error": str(e)}
     
-    async def process_cmj_test(self, test_id: str, athlete_info: pd.Series) -> Dict:
-        """Process CMJ test with composite scoring"""
+    async def process_cmj_test(self, test_id: str, athlete_info: pd.Series, assessment_id: str) -> Dict:
+        """Process CMJ test with composite scoring against the batch pipeline's published stats"""
         logger.info(f"Processing CMJ test {test_id}")
         
-        # Use the existing enhanced CMJ processor
-        assessment_id = str(uuid.uuid4())
-        result_df, composite_score = process_cmj_test_with_composite(test_id, self.token, assessment_id)
+        snapshot = await run_io(get_stats_snapshot)
+        if snapshot is None:
+            raise ValueError("No CMJ stats snapshot published yet; run the batch pipeline first")
         
-        if result_df is None:
-            raise ValueError("No CMJ data found for processing")
+        # Fetch raw data over the shared pooled client (async), score off the event loop
+        status, json_data = await get_client().get_trials_async(test_id)
+        if status != 200:
+            raise ValueError(f"Failed to fetch CMJ data: {status}")
+        
+        best_trial_col, best_score, best_metrics = await run_cpu(score_cmj_trials, json_data, snapshot)
         
         return {
             "assessment_id": assessment_id,
-            "composite_score": composite_score,
-            "metrics": result_df.to_dict('records'),
+            "composite_score": float(best_score),
+            "normalized_score": snapshot.normalize_score(best_score),
+            "best_trial": best_trial_col,
+            "metrics": best_metrics,
+            "stats_snapshot": snapshot.info(),
             "test_type": "CMJ"
         }
     
-    async def process_ppu_test(self, test_id: str, athlete_info: pd.Series) -> Dict:
+    async def process_ppu_test(self, test_id: str, athlete_info: pd.Series, assessment_id: str) -> Dict:
         """Process PPU test"""
         logger.info(f"Processing PPU test {test_id}")
         
-        # Fetch raw data
-        url = f"https://api.vald.com/v2019q3/teams/{os.getenv('TENANT_ID')}/tests/{test_id}/trials"
-        headers = {"Authorization": f"Bearer {self.token}"}
-        
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    raise ValueError(f"Failed to fetch PPU data: {response.status}")
-                
-                json_data = await response.json()
-                pivoted_df = process_json_to_pivoted_df(json_data)
-                
-                if pivoted_df is None or pivoted_df.empty:
-                    raise ValueError("No PPU data found for processing")
-                
-                # Extract key metrics
-                metrics = {}
-                for _, row in pivoted_df.iterrows():
-                    metric_id = row['metric_id']
-                    trial_values = [row[col] for col in row.index if 'trial' in col and pd.notna(row[col])]
-                    if trial_values:
-                        metrics[metric_id] = {
-                            "best_value": max(trial_values),
-                            "all_values": trial_values,
-                            "num_trials": len(trial_values)
-                        }
-                
-                return {
-                    "assessment_id": str(uuid.uuid4()),
-                    "metrics": metrics,
-                    "test_type": "PPU"
-                }
+        # Fetch raw data over the shared pooled client
+        status, json_data = await get_client().get_trials_async(test_id)
+        if status != 200:
+            raise ValueError(f"Failed to fetch PPU data: {status}")
+        
+        pivoted_df = await run_cpu(process_json_to_pivoted_df, json_data)
+        
+        if pivoted_df is None or pivoted_df.empty:
+            raise ValueError("No PPU data found for processing")
+        
+        # Extract key metrics
+        metrics = await run_cpu(summarize_best_values, pivoted_df)
+        
+        return {
+            "assessment_id": assessment_id,
+            "metrics": metrics,
+            "test_type": "PPU"
+        }
     
-    async def process_hj_test(self, test_id: str, athlete_info: pd.Series) -> Dict:
+    async def process_hj_test(self, test_id: str, athlete_info: pd.Series, assessment_id: str) -> Dict:
         """Process Horizontal Jump test"""
         logger.info(f"Processing HJ test {test_id}")
         
-        # Fetch raw data
-        url = f"https://api.vald.com/v2019q3/teams/{os.getenv('TENANT_ID')}/tests/{test_id}/trials"
-        headers = {"Authorization": f"Bearer {self.token}"}
-        
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    raise ValueError(f"Failed to fetch HJ data: {response.status}")
-                
-                json_data = await response.json()
-                pivoted_df = process_hj_json(json_data)
-                
-                if pivoted_df is None or pivoted_df.empty:
-                    raise ValueError("No HJ data found for processing")
-                
-                # Calculate RSI metrics
-                rsi_metrics = {}
-                for _, row in pivoted_df.iterrows():
-                    metric_id = row['metric_id']
-                    if 'RSI' in metric_id:
-                        trial_values = [row[col] for col in row.index if 'trial' in col and pd.notna(row[col])]
-                        if trial_values:
-                            # Get best 5 RSI values
-                            best_5 = sorted(trial_values, reverse=True)[:5]
-                            avg_rsi = sum(best_5) / len(best_5)
-                            rsi_metrics[metric_id] = {
-                                "best_5_avg": avg_rsi,
-                                "all_values": trial_values,
-                                "best_5_values": best_5
-                            }
-                
-                return {
-                    "assessment_id": str(uuid.uuid4()),
-                    "rsi_metrics": rsi_metrics,
-                    "test_type": "HJ"
-                }
+        # Fetch raw data over the shared pooled client
+        status, json_data = await get_client().get_trials_async(test_id)
+        if status != 200:
+            raise ValueError(f"Failed to fetch HJ data: {status}")
+        
+        pivoted_df = await run_cpu(process_hj_json, json_data)
+        
+        if pivoted_df is None or pivoted_df.empty:
+            raise ValueError("No HJ data found for processing")
+        
+        # Calculate RSI metrics
+        rsi_metrics = await run_cpu(summarize_rsi, pivoted_df)
+        
+        return {
+            "assessment_id": assessment_id,
+            "rsi_metrics": rsi_metrics,
+            "test_type": "HJ"
+        }
     
-    async def process_imtp_test(self, test_id: str, athlete_info: pd.Series) -> Dict:
+    async def process_imtp_test(self, test_id: str, athlete_info: pd.Series, assessment_id: str) -> Dict:
         """Process IMTP test"""
         logger.info(f"Processing IMTP test {test_id}")
         
-        # Use existing IMTP processor
-        result_df = get_imtp_results(test_id, self.token)
+        # Fetch raw data over the shared pooled client
+        status, json_data = await get_client().get_trials_async(test_id)
+        if status != 200:
+            raise ValueError(f"Failed to fetch IMTP data: {status}")
+        
+        result_df = await run_cpu(process_imtp_json, json_data)
         
         if result_df is None or result_df.empty:
             raise ValueError("No IMTP data found for processing")
         
         # Extract key metrics
-        metrics = {}
-        for _, row in result_df.iterrows():
-            metric_id = row['metric_id']
-            trial_values = [row[col] for col in row.index if 'trial' in col and pd.notna(row[col])]
-            if trial_values:
-                metrics[metric_id] = {
-                    "best_value": max(trial_values),
-                    "all_values": trial_values,
-                    "num_trials": len(trial_values)
-                }
+        metrics = await run_cpu(summarize_best_values, result_df)
         
         return {
-            "assessment_id": str(uuid.uuid4()),
+            "assessment_id": assessment_id,
             "metrics": metrics,
             "test_type": "IMTP"
         }
     
-    async def generate_report(self, test_id: str, test_type: str, athlete_info: pd.Series, result: Dict) -> Dict:
-        """Generate a comprehensive report for the processed test"""
-        logger.info(f"Generating report for test {test_id}")
+    async def generate_session_report(self, assessment_id: str, athlete_info: pd.Series, results: Dict[str, Dict]) -> Dict:
+        """Generate one combined report for every test processed in a session"""
+        logger.info(f"Generating session report {assessment_id} for {athlete_info['fullName']}")
         
         # Calculate athlete age
         test_date = datetime.now().date()
         dob = pd.to_datetime(athlete_info['dateOfBirth']).date()
         age = test_date.year - dob.year - ((test_date.month, test_date.day) < (dob.month, dob.day))
         
-        # Generate insights based on test type
-        insights = self.generate_insights(test_type, result)
-        
-        # Create performance summary
-        performance_summary = self.create_performance_summary(test_type, result)
+        tests = []
+        failed_tests = []
+        for test_id, outcome in results.items():
+            test_type = outcome["test_type"]
+            if not outcome["success"]:
+                failed_tests.append({"test_id": test_id, "test_type": test_type, "error": outcome["error"]})
+                continue
+            result = outcome["processed_data"]
+            # Generate insights based on test type
+            insights = self.generate_insights(test_type, result)
+            tests.append({
+                "test_info": {
+                    "test_id": test_id,
+                    "test_type": test_type,
+                    "test_date": test_date.isoformat()
+                },
+                "performance_summary": self.create_performance_summary(test_type, result),
+                "insights": insights,
+                "recommendations": self.generate_recommendations(test_type, result, insights)
+            })
+        
+        # The directory may refresh from BigQuery on a miss
+        athlete_id = await run_io(get_athlete_directory().get, athlete_info['profileId'])
         
         report = {
             "report_id": str(uuid.uuid4()),
+            "assessment_id": assessment_id,
             "generated_at": datetime.now().isoformat(),
             "athlete_info": {
+                "athlete_id": athlete_id,
                 "name": athlete_info['fullName'],
                 "age": age,
                 "profile_id": athlete_info['profileId']
             },
-            "test_info": {
-                "test_id": test_id,
-                "test_type": test_type,
-                "test_date": test_date.isoformat()
+            "session_info": {
+                "test_date": test_date.isoformat(),
+                "test_types": [test["test_info"]["test_type"] for test in tests]
             },
-            "performance_summary": performance_summary,
-            "insights": insights,
-            "recommendations": self.generate_recommendations(test_type, result, insights)
+            "tests": tests,
+            "failed_tests": failed_tests
         }
         
         # Save report to file
-        report_filename = f"reports/{test_id}_{test_type}_report.json"
-        os.makedirs("reports", exist_ok=True)
-        with open(report_filename, 'w') as f:
-            json.dump(report, f, indent=2, default=str)
+        await run_io(write_report, session_report_path(assessment_id), report)
         
         return report
     
@@ -359,84 +465,165 @@ class TestProcessor:
 # Initialize processor
 processor = TestProcessor()
 
+@app.on_event("startup")
+async def load_athlete_directory():
+    """Preload profileId -> athlete_ID so report lookups are in-memory"""
+    try:
+        await run_io(get_athlete_directory().load)
+    except Exception as e:
+        logger.warning(f"Could not preload the athletes table; lookups will retry: {e}")
+
+@app.on_event("startup")
+async def load_profile_index():
+    """Preload the VALD roster so webhook athlete lookups are in-memory"""
+    try:
+        await run_io(get_profile_index().load)
+    except Exception as e:
+        logger.warning(f"Could not preload VALD profiles; lookups will retry: {e}")
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Re-queue jobs interrupted by a restart and start the queue workers"""
+    await run_io(get_job_queue().recover)
+    job_workers.extend(asyncio.create_task(job_worker(i)) for i in range(JOB_WORKERS))
+    job_workers.append(asyncio.create_task(status_janitor()))
+    jobs_available.set()
+
+@app.on_event("shutdown")
+async def shutdown_executors():
+    """Stop the queue workers and the worker pools (queued calls are dropped; running ones finish)"""
+    for task in job_workers:
+        task.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    io_executor.shutdown(wait=False, cancel_futures=True)
+
 @app.post("/webhook/test-completion", response_model=ProcessingStatus)
-async def handle_test_completion(event: TestCompletionEvent, background_tasks: BackgroundTasks):
+async def handle_test_completion(event: TestCompletionEvent):
     """Webhook endpoint to handle test completion events"""
     logger.info(f"Received test completion event: {event.test_id} ({event.test_type})")
     
-    # Create initial status
-    status = ProcessingStatus(
-        test_id=event.test_id,
-        status="processing",
-        message="Test processing started",
-        timestamp=datetime.now().isoformat()
-    )
-    processing_status[event.test_id] = status
-    
-    # Add background task for processing
-    background_tasks.add_task(process_test_background, event)
+    # Queue the test durably; a repeated webhook for the same test returns the existing job
+    try:
+        job, created = await run_io(get_job_queue().enqueue, event.test_id, event.athlete_id, event.test_type, event.dict())
+    except QueueFull as e:
+        logger.warning(f"Job backlog full, refusing test {event.test_id}: {e}")
+        raise HTTPException(status_code=503, detail="Processing backlog is full; retry later",
+                            headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER)})
+    if created:
+        jobs_available.set()
+    else:
+        logger.info(f"Duplicate webhook for test {event.test_id} ignored (job is {job['status']})")
     
-    return status
+    return job_status(job)
+
+async def job_worker(worker_id: int):
+    """Claim and process athletes' coalesced jobs until cancelled"""
+    queue = get_job_queue()
+    while True:
+        try:
+            jobs = await run_io(queue.claim_session)
+        except Exception as e:
+            logger.error(f"Job worker {worker_id} could not claim jobs: {e}")
+            jobs = []
+        if not jobs:
+            # Sleep until a webhook arrives, or until debounced jobs and delayed retries may have become due
+            jobs_available.clear()
+            try:
+                await asyncio.wait_for(jobs_available.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await process_session_jobs(jobs)
+        except Exception as e:
+            # Keep the worker alive; jobs left processing are re-queued on the next restart
+            logger.exception(f"Job worker {worker_id} failed on jobs {[job['test_id'] for job in jobs]}: {e}")
 
-async def process_test_background(event: TestCompletionEvent):
-    """Background task to process the test"""
+async def process_session_jobs(jobs: List[Dict]):
+    """Process one athlete's claimed jobs as a session and record each job's outcome in the queue"""
+    queue = get_job_queue()
+    athlete_id = jobs[0]['athlete_id']
     try:
-        # Process the test
-        result = await processor.process_test(event.test_id, event.athlete_id, event.test_type)
-        
-        if result["success"]:
-            # Update status
-            processing_status[event.test_id] = ProcessingStatus(
-                test_id=event.test_id,
-                status="completed",
-                message=f"Successfully processed {event.test_type} test",
-                timestamp=datetime.now().isoformat(),
-                report_url=f"/reports/{event.test_id}_{event.test_type}_report.json"
-            )
-            logger.info(f"Successfully processed test {event.test_id}")
-        else:
-            # Update status with error
-            processing_status[event.test_id] = ProcessingStatus(
-                test_id=event.test_id,
-                status="failed",
-                message=f"Failed to process test: {result.get('error', 'Unknown error')}",
-                timestamp=datetime.now().isoformat()
-            )
-            logger.error(f"Failed to process test {event.test_id}: {result.get('error')}")
-    
+        session = await processor.process_session(athlete_id, [(job['test_id'], job['test_type']) for job in jobs])
+        results = session["results"]
     except Exception as e:
-        # Update status with exception
-        processing_status[event.test_id] = ProcessingStatus(
-            test_id=event.test_id,
-            status="failed",
-            message=f"Exception during processing: {str(e)}",
-            timestamp=datetime.now().isoformat()
-        )
-        logger.error(f"Exception processing test {event.test_id}: {str(e)}")
+        logger.error(f"Exception processing session for athlete {athlete_id}: {str(e)}")
+        results = {job['test_id']: {"success": False, "error": f"Exception during processing: {str(e)}"} for job in jobs}
+        session = None
+    
+    for job in jobs:
+        test_id, test_type = job['test_id'], job['test_type']
+        outcome = results.get(test_id, {"success": False, "error": "No result recorded for test"})
+        try:
+            if outcome["success"]:
+                await run_io(queue.complete, test_id, f"Successfully processed {test_type} test",
+                             f"/reports/sessions/{session['assessment_id']}")
+                logger.info(f"Successfully processed test {test_id} (assessment {session['assessment_id']})")
+                continue
+            message = f"Failed to process test: {outcome.get('error', 'Unknown error')}"
+            retrying = await run_io(queue.fail, test_id, message)
+            logger.error(f"{message} (test {test_id}, attempt {job['attempts']}{', will retry' if retrying else ''})")
+        except Exception as e:
+            # One job's outcome failing to save (e.g. sqlite busy) must not drop the rest of the session's
+            logger.exception(f"Could not record the outcome of test {test_id}: {e}")
+
+async def status_janitor():
+    """Periodically evict old finished jobs so the status store stays bounded"""
+    while True:
+        try:
+            await run_io(get_job_queue().evict)
+        except Exception as e:
+            logger.error(f"Could not evict finished jobs: {e}")
+        await asyncio.sleep(STATUS_EVICT_INTERVAL)
+
+@app.get("/status", response_model=List[ProcessingStatus])
+async def list_processing_status(status: Optional[str] = None, athlete_id: Optional[str] = None,
+                                 test_type: Optional[str] = None, since_minutes: Optional[float] = None,
+                                 limit: int = 100):
+    """List tests by status, athlete, test type and recency, newest first (e.g. ?status=failed&since_minutes=60)"""
+    since = datetime.now().timestamp() - since_minutes * 60 if since_minutes is not None else None
+    jobs = await run_io(get_job_queue().list_jobs, status=status, athlete_id=athlete_id,
+                        test_type=test_type, since=since, limit=limit)
+    return [job_status(job) for job in jobs]
 
 @app.get("/status/{test_id}", response_model=ProcessingStatus)
 async def get_processing_status(test_id: str):
     """Get the processing status of a test"""
-    if test_id not in processing_status:
+    job = await run_io(get_job_queue().get, test_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Test not found")
-    return processing_status[test_id]
+    return job_status(job)
 
 @app.get("/reports/{test_id}_{test_type}_report.json")
 async def get_test_report(test_id: str, test_type: str):
-    """Get the generated report for a test"""
-    report_filename = f"reports/{test_id}_{test_type}_report.json"
-    if not os.path.exists(report_filename):
+    """Get the report for a test: the combined report of the session it was processed in"""
+    job = await run_io(get_job_queue().get, test_id)
+    if job is None or job['test_type'] != test_type or not job['report_url']:
+        raise HTTPException(status_code=404, detail="Report not found")
+    assessment_id = job['report_url'].rsplit('/', 1)[-1]
+    return await get_session_report(assessment_id)
+
+@app.get("/reports/sessions/{assessment_id}")
+async def get_session_report(assessment_id: str):
+    """Get the combined report for a session (one athlete's coalesced tests)"""
+    try:
+        report_data = await run_io(read_report, session_report_path(assessment_id))
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Report not found")
-    
-    with open(report_filename, 'r') as f:
-        report_data = json.load(f)
     
     return JSONResponse(content=report_data)
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    snapshot = await run_io(get_stats_snapshot)
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "cmj_stats_snapshot": snapshot.info() if snapshot is not None else None,
+        "jobs": await run_io(get_job_queue().counts)
+    }
 
 if __name__ == "__main__":
     # Create reports directory
@@ -1,19 +1,16 @@
 """
 Quick test to check if athlete_id was properly uploaded to CMJ results
 """
-from google.cloud import bigquery
-from google.oauth2 import service_account
 import pandas as pd
+from bq_client import get_bigquery_client
 
 # Configuration
-CREDENTIALS_FILE = 'gcp_credentials.json'
 PROJECT_ID = 'vald-ref-data'
 DATASET_ID = 'athlete_performance_db'
 
 def check_cmj_results():
     try:
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+        client = get_bigquery_client(PROJECT_ID)
         
         # Check recent CMJ results with athlete_id
         query = f"""
@@ -5,8 +5,9 @@ This script will test the API calls with rate limiting to ensure we don't get 42
 
 import time
 import logging
-from enhanced_cmj_processor import rate_limited_request, get_FD_results_with_logging_and_retry, shared_token, token_lock
-from VALDapiHelpers import get_access_token
+from enhanced_cmj_processor import get_FD_results_with_logging_and_retry
+from rate_limiter import get_rate_limiter
+from token_generator import get_access_token
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
@@ -14,10 +15,6 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(mess
 def test_rate_limiting():
     """Test the rate limiting functionality."""
     
-    # Get a fresh token
-    with token_lock:
-        shared_token['token'] = get_access_token()
-    
     # Test a few API calls with rate limiting
     test_ids = [
         "58c89a10-72b6-41b6-88e5-e7dde01bb81c",
@@ -32,12 +29,13 @@ def test_rate_limiting():
         start_time = time.time()
         
         try:
-            result = get_FD_results_with_logging_and_retry(test_id, shared_token['token'])
+            result = get_FD_results_with_logging_and_retry(test_id, get_access_token())
             elapsed = time.time() - start_time
             
             if result is not None and not result.empty:
                 print(f"✓ Success: Got data in {elapsed:.2f}s")
                 print(f"  Data shape: {result.shape}")
+                print(f"  Limiter state: {get_rate_limiter().stats()}")
             else:
                 print(f"✗ No data returned for test {test_id}")
                 
@@ -1,42 +1,171 @@
 # token_manager.py
+"""
+The one VALD access-token provider for every script.
+Tokens are held in memory, so the hot path is an attribute read with no disk
+I/O. A refresh is single-flight: concurrent callers (e.g. a burst of 401s from
+worker threads) wait on one POST to AUTH_URL instead of each sending their own.
+Across processes .token_cache.json is shared under a FileLock, and a token
+another process already renewed is adopted instead of requesting a new one.
+A daemon thread renews the token RENEW_AHEAD seconds before it expires, so
+long runs do not stall on expiry.
+"""
+
 import os
+import time
+import logging
+import threading
 import requests
 import json
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from filelock import FileLock
 
 load_dotenv()
 
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 AUTH_URL = os.getenv("AUTH_URL")
-CACHE_FILE = ".token_cache.json"
-
-def get_access_token():
-    # Check cache
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            data = json.load(f)
-            if datetime.now() < datetime.fromisoformat(data["expires_at"]):
-                return data["access_token"]
-
-    # Generate new token
-    payload = {
-        "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET
-    }
-
-    response = requests.post(AUTH_URL, data=payload)
-    if response.status_code == 200:
-        token = response.json()['access_token']
-        expires_in = response.json().get('expires_in', 7200)
-        expires_at = (datetime.now() + timedelta(seconds=expires_in - 60)).isoformat()
-
-        with open(CACHE_FILE, "w") as f:
-            json.dump({"access_token": token, "expires_at": expires_at}, f)
-
-        print("Access token refreshed.")
-        return token
-    else:
-        raise Exception(f"Auth failed: {response.status_code} - {response.text}")
+CACHE_FILE = os.getenv("TOKEN_CACHE_PATH", ".token_cache.json")
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+EXPIRY_MARGIN = 60  # Seconds shaved off expires_in when the token is stored
+RENEW_AHEAD = 300  # Background renewal starts this many seconds before expires_at
+RETRY_INTERVAL = 30  # Seconds between background renewal attempts after a failure
+AUTH_TIMEOUT = 10  # Seconds for the token POST
+
+log = logging.getLogger(__name__)
+
+
+class TokenProvider:
+    """In-memory, single-flight, proactively renewed access token."""
+
+    def __init__(self, cache_file=CACHE_FILE, renew_ahead=RENEW_AHEAD):
+        self.cache_file = cache_file
+        self.lock_path = f"{cache_file}.lock"
+        self.renew_ahead = renew_ahead
+        self._token = None
+        self._expires_at = None
+        self._generation = 0  # Bumped on every new token; lets waiters see a refresh finished
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._renewer = None
+
+    def _is_valid(self, seconds_ahead=0):
+        return self._token is not None and datetime.now() + timedelta(seconds=seconds_ahead) < self._expires_at
+
+    def get(self, force_refresh=False, rejected_token=None):
+        """
+        Return a valid access token.
+
+        Args:
+            force_refresh: Get a new token even if the current one has not expired
+                (the server rejected it)
+            rejected_token: The token the server rejected; when the current token is
+                already a different one, it is returned without another refresh
+
+        Raises:
+            Exception: When the auth server refuses the credentials
+        """
+        generation = self._generation
+        if not force_refresh and self._is_valid():
+            return self._token
+        with self._lock:
+            if self._is_valid():
+                # Someone refreshed while we waited for the lock
+                if not force_refresh or self._generation != generation:
+                    return self._token
+                if rejected_token is not None and self._token != rejected_token:
+                    return self._token
+            self._refresh(force_refresh)
+            self._start_renewer()
+            return self._token
+
+    def _refresh(self, force_refresh):
+        """Adopt a newer token from the shared cache file, or POST for one. Caller holds self._lock."""
+        with FileLock(self.lock_path, timeout=AUTH_TIMEOUT * 3):
+            data = self._read_cache()
+            if data:
+                expires_at = datetime.fromisoformat(data["expires_at"])
+                usable = datetime.now() < expires_at
+                # A forced refresh only accepts a token other than the one that was rejected
+                if usable and (not force_refresh or data["access_token"] != self._token):
+                    self._set(data["access_token"], expires_at)
+                    return
+            payload = {
+                "grant_type": "client_credentials",
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET
+            }
+            response = requests.post(AUTH_URL, data=payload, timeout=AUTH_TIMEOUT)
+            if response.status_code != 200:
+                raise Exception(f"Auth failed: {response.status_code} - {response.text}")
+            body = response.json()
+            expires_at = datetime.now() + timedelta(seconds=body.get('expires_in', 7200) - EXPIRY_MARGIN)
+            self._write_cache(body['access_token'], expires_at)
+            self._set(body['access_token'], expires_at)
+            log.info("Access token refreshed.")
+
+    def _set(self, token, expires_at):
+        self._token = token
+        self._expires_at = expires_at
+        self._generation += 1
+        self._wake.set()
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                data = json.load(f)
+            return data if "access_token" in data and "expires_at" in data else None
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            return None
+
+    def _write_cache(self, token, expires_at):
+        tmp_path = f"{self.cache_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"access_token": token, "expires_at": expires_at.isoformat()}, f)
+        os.replace(tmp_path, self.cache_file)
+
+    def _start_renewer(self):
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_loop, name="token-renewer", daemon=True)
+            self._renewer.start()
+
+    def _renew_loop(self):
+        """Sleep until renew_ahead seconds before expiry, then renew (retrying on failure)."""
+        while True:
+            self._wake.clear()
+            delay = (self._expires_at - datetime.now()).total_seconds() - self.renew_ahead
+            if delay > 0:
+                # Woken early whenever a new token arrives, so the schedule follows it
+                self._wake.wait(delay)
+                continue
+            try:
+                with self._lock:
+                    if not self._is_valid(self.renew_ahead):
+                        self._refresh(force_refresh=False)
+                        if not self._is_valid(self.renew_ahead):
+                            # The cached token was still inside the window; replace it
+                            self._refresh(force_refresh=True)
+            except Exception as e:
+                log.error(f"Background token renewal failed: {e}")
+                time.sleep(RETRY_INTERVAL)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_token_provider():
+    """Return the process-wide TokenProvider."""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = TokenProvider()
+        return _provider
+
+
+def get_access_token(force_refresh=False, rejected_token=None):
+    """Return a valid access token from the shared provider (see TokenProvider.get)."""
+    return get_token_provider().get(force_refresh=force_refresh, rejected_token=rejected_token)
@@ -0,0 +1,192 @@
+"""
+On-disk cache of raw VALD trial JSON, keyed by testId.
+Analysed trials do not change unless the test's modifiedDateUtc moves, so every
+pipeline reads /tests/{testId}/trials through this cache and re-runs (and the
+CMJ global-stats pass) only hit the network for tests they have not seen.
+Entries are zlib-compressed in a sqlite file, tagged with a sha256 of the body,
+and evicted least-recently-used once the cache grows past CACHE_MAX_BYTES. The
+total size is kept in a meta row by triggers, so checking it on every put is a
+single-row read rather than a scan of the table.
+"""
+
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+import time
+
+import pandas as pd
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+CACHE_PATH = os.getenv("TRIAL_CACHE_PATH", ".trial_cache.sqlite")
+CACHE_MAX_BYTES = int(os.getenv("TRIAL_CACHE_MAX_BYTES", 512 * 1024 * 1024))  # Compressed bytes kept on disk
+COMPRESSION_LEVEL = 6
+EVICT_BATCH = 100  # Entries examined per eviction query
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    test_id TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    modified_date_utc TEXT,
+    content_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    fetched_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_trials_last_access ON trials (last_access);
+CREATE TABLE IF NOT EXISTS cache_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO cache_meta (key, value) SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM trials;
+CREATE TRIGGER IF NOT EXISTS trials_size_insert AFTER INSERT ON trials BEGIN
+    UPDATE cache_meta SET value = value + new.size WHERE key = 'total_bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS trials_size_update AFTER UPDATE OF size ON trials BEGIN
+    UPDATE cache_meta SET value = value + new.size - old.size WHERE key = 'total_bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS trials_size_delete AFTER DELETE ON trials BEGIN
+    UPDATE cache_meta SET value = value - old.size WHERE key = 'total_bytes';
+END;
+"""
+
+
+def _same_modified_date(cached, current):
+    """Compare two modifiedDateUtc values regardless of string formatting."""
+    if cached is None:
+        return False
+    return pd.to_datetime(cached, utc=True) == pd.to_datetime(current, utc=True)
+
+
+class TrialCache:
+    """sqlite-backed LRU cache of raw trial responses, safe to share between threads."""
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, test_id, modified_date=None):
+        """
+        Look up a cached response.
+
+        Args:
+            test_id: VALD testId
+            modified_date: The test's current modifiedDateUtc; a cached entry from a
+                different modifiedDateUtc is treated as stale and dropped. Without it the
+                entry cannot be shown to be current (the test may have been re-analysed),
+                so the lookup is a miss and the caller reads from the API
+
+        Returns:
+            (status, body) for a hit, or None for a miss
+        """
+        if modified_date is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, modified_date_utc, body FROM trials WHERE test_id = ?", (str(test_id),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, cached_modified, body = row
+            if not _same_modified_date(cached_modified, modified_date):
+                log.info(f"Trial cache entry for {test_id} is stale (modified {cached_modified} -> {modified_date})")
+                self._conn.execute("DELETE FROM trials WHERE test_id = ?", (str(test_id),))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE trials SET last_access = ? WHERE test_id = ?", (time.time(), str(test_id)))
+            self.hits += 1
+        return status, json.loads(zlib.decompress(body))
+
+    def put(self, test_id, status, body, modified_date=None):
+        """Store a 200 (trial list) or 204 (no trials) response, then evict down to max_bytes."""
+        raw = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+        now = time.time()
+        with self._lock:
+            # An upsert rather than INSERT OR REPLACE: REPLACE's implicit delete does not fire
+            # the size triggers
+            self._conn.execute(
+                "INSERT INTO trials (test_id, status, modified_date_utc, content_hash, size, body, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (test_id) DO UPDATE SET status = excluded.status, modified_date_utc = excluded.modified_date_utc, "
+                "content_hash = excluded.content_hash, size = excluded.size, body = excluded.body, "
+                "fetched_at = excluded.fetched_at, last_access = excluded.last_access",
+                (str(test_id), status, modified_date, hashlib.sha256(raw).hexdigest(), len(compressed), compressed, now, now),
+            )
+            self._evict()
+
+    def _total_bytes(self):
+        return self._conn.execute("SELECT value FROM cache_meta WHERE key = 'total_bytes'").fetchone()[0]
+
+    def _evict(self):
+        """Drop least-recently-used entries until the cache fits (call with self._lock held)."""
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        while total > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT test_id, size FROM trials ORDER BY last_access LIMIT ?", (EVICT_BATCH,)
+            ).fetchall()
+            if not oldest:
+                break
+            for test_id, size in oldest:
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM trials WHERE test_id = ?", (test_id,))
+                total -= size
+                evicted += 1
+        log.info(f"Trial cache evicted {evicted} entries ({total} bytes kept)")
+
+    def invalidate(self, test_id):
+        """Forget one test so its next read goes to the API."""
+        with self._lock:
+            self._conn.execute("DELETE FROM trials WHERE test_id = ?", (str(test_id),))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM trials")
+
+    def stats(self):
+        """Snapshot of cache size and hit rate for logging."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+            total = self._total_bytes()
+        return {"entries": entries, "bytes": total, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# =================================================================================
+# Process-wide shared cache
+# =================================================================================
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_trial_cache():
+    """Return the process-wide TrialCache, opening it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TrialCache()
+        return _default_cache
@@ -0,0 +1,121 @@
+"""
+Columnar flattener for raw VALD trial JSON, shared by every test type.
+Turns the /trials response into a canonical metric x trial matrix in one pass:
+results are collected into flat arrays, each distinct (result, limb, unit) is
+mapped to its metric id once, trial numbers come from a stable sort of the
+metric codes, and the values are scattered into a pre-allocated NaN matrix.
+No per-result dicts, no string concatenation per row, no groupby/pivot.
+
+Canonical metric ids follow get_FD_results: '<result>_<limb>_<unit>' with the
+short unit name, '/' replaced by '_' and trailing underscores removed, e.g.
+'JUMP_HEIGHT_IMP_MOM_Trial_cm', 'CONCENTRIC_RFD_Trial_N_s', 'MEAN_ECCENTRIC_FORCE_Asym_N'.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+UNIT_MAP = {
+    'Centimeter':                       'cm',
+    'Inch':                             'in',
+    'Joule':                            'J',
+    'Kilo':                             'kg',
+    'Meter Per Second':                 'm/s',
+    'Meter Per Second Per Second':      'm/s²',
+    'Millisecond':                      'ms',
+    'Second':                           's',
+    'Newton':                           'N',
+    'Newton Per Centimeter':            'N/cm',
+    'Newton Per Kilo':                  'N/kg',
+    'Newton Per Meter':                 'N/m',
+    'Newton Per Second':                'N/s',
+    'Newton Per Second Per Centimeter': 'N/s/cm',
+    'Newton Per Second Per Kilo':       'N/s/kg',
+    'Newton Second':                    'Ns',
+    'Newton Second Per Kilo':           'Ns/kg',
+    'Watt':                             'W',
+    'Watt Per Kilo':                    'W/kg',
+    'Watt Per Second':                  'W/s',
+    'Watt Per Second Per Kilo':         'W/s/kg',
+    'Percent':                          '%',
+    'Pound':                            'lb',
+    'RSIModified':                      'RSI_mod',
+    'No Unit':                          '',     # blank for unitless
+}
+
+
+@lru_cache(maxsize=None)
+def canonical_metric_id(result_key, limb, unit):
+    """BigQuery-safe metric id for one (result, limb, unit) definition; cached across tests."""
+    short_unit = UNIT_MAP.get(unit, unit)
+    metric_id = f"{result_key}_{limb}_{short_unit}"
+    return metric_id.replace('/', '_').rstrip('_')
+
+
+def flatten_trials_matrix(test_data_json):
+    """
+    Flatten a raw /trials response into a dense matrix.
+
+    Returns:
+        (metric_ids, values): metric_ids is a sorted array of canonical ids and values a
+        float matrix of shape (n_metrics, n_trials), NaN where a metric has no value for
+        that trial. Trial k of a metric is its k-th result in response order, matching
+        the groupby().cumcount() numbering of the old pandas path. Returns None when the
+        response is not a list of trials.
+    """
+    if not test_data_json or not isinstance(test_data_json, list):
+        return None
+
+    codes_by_metric = {}
+    codes = []
+    values = []
+    for trial in test_data_json:
+        for res in trial.get("results", ()):
+            definition = res["definition"]
+            metric_id = canonical_metric_id(str(definition.get("result")), str(res.get("limb")), definition.get("unit"))
+            code = codes_by_metric.get(metric_id)
+            if code is None:
+                code = codes_by_metric[metric_id] = len(codes_by_metric)
+            codes.append(code)
+            values.append(res.get("value"))
+
+    if not codes:
+        return np.array([], dtype=object), np.empty((0, 0))
+
+    codes = np.asarray(codes, dtype=np.intp)
+    values = np.asarray(values, dtype=float)
+
+    # Trial number = position of each result within its metric (stable sort keeps response order)
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(sorted_codes)])
+    trial_index = np.empty_like(codes)
+    trial_index[order] = np.arange(len(codes)) - np.repeat(group_starts, group_sizes)
+
+    matrix = np.full((len(codes_by_metric), int(trial_index.max()) + 1), np.nan)
+    matrix[codes, trial_index] = values
+
+    # Rows in metric-id order, as pivot() produced them
+    metric_ids = np.array(list(codes_by_metric), dtype=object)
+    row_order = np.argsort(metric_ids)
+    return metric_ids[row_order], matrix[row_order]
+
+
+def flatten_trials(test_data_json):
+    """
+    Flatten a raw /trials response into the 'metric_id' + 'trial N' DataFrame every processor uses.
+
+    Returns:
+        The DataFrame (empty when the response has no results), or None when it is not a list of trials
+    """
+    flattened = flatten_trials_matrix(test_data_json)
+    if flattened is None:
+        return None
+    metric_ids, matrix = flattened
+    if len(metric_ids) == 0:
+        return pd.DataFrame()
+    df = pd.DataFrame(matrix, columns=[f'trial {c}' for c in range(1, matrix.shape[1] + 1)])
+    df.insert(0, 'metric_id', metric_ids)
+    return df
@@ -0,0 +1,323 @@
+"""
+Shared VALD API client.
+Every pipeline talks to VALD through one VALDClient so connections are pooled
+(keep-alive, no TCP+TLS handshake per request), tokens come from one provider,
+retries follow one backoff policy, every request passes through the shared
+adaptive rate limiter, and trial reads go through the on-disk trial cache. The client has a synchronous face backed
+by a requests.Session and an asynchronous face backed by an aiohttp.ClientSession.
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+from dotenv import load_dotenv
+
+from token_generator import get_access_token
+from rate_limiter import get_rate_limiter
+from trial_cache import get_trial_cache
+
+load_dotenv()
+FORCEDECKS_URL = os.getenv("FORCEDECKS_URL")
+DYNAMO_URL = os.getenv("DYNAMO_URL")
+PROFILE_URL = os.getenv("PROFILE_URL")
+TENANT_ID = os.getenv("TENANT_ID")
+
+# =================================================================================
+# CONFIGURATION
+# =================================================================================
+POOL_SIZE = 20  # Keep-alive connections held open per host
+CONNECT_TIMEOUT = 5  # Seconds to establish a connection
+READ_TIMEOUT = 30  # Seconds to wait for a response body
+MAX_RETRIES = 5  # Attempts per request for retryable failures
+BACKOFF_BASE = 1.0  # Seconds; doubled on every retry
+BACKOFF_MAX = 60.0  # Upper bound on a single backoff sleep
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CACHEABLE_STATUSES = {200, 204}  # Trial responses worth keeping (204 = test has no trials)
+
+log = logging.getLogger(__name__)
+
+
+class VALDClient:
+    """Pooled VALD API client with sync (requests) and async (aiohttp) faces."""
+
+    def __init__(self, token_provider=None, pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, rate_limiter=None, trial_cache=None):
+        self.token_provider = token_provider or get_access_token
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.trial_cache = trial_cache or get_trial_cache()
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._async_session = None
+
+    # -----------------------------------------------------------------------------
+    # Endpoints
+    # -----------------------------------------------------------------------------
+    def profiles_url(self):
+        return f"{PROFILE_URL}/profiles?tenantId={TENANT_ID}"
+
+    def profile_url(self, profile_id):
+        return f"{PROFILE_URL}/profiles/{profile_id}?tenantId={TENANT_ID}"
+
+    def tests_url(self, modified_from, profile_id):
+        return f"{FORCEDECKS_URL}/tests?TenantId={TENANT_ID}&ModifiedFromUtc={modified_from}&ProfileId={profile_id}"
+
+    def trials_url(self, test_id):
+        return f"{FORCEDECKS_URL}/v2019q3/teams/{TENANT_ID}/tests/{test_id}/trials"
+
+    def dynamo_tests_url(self, profile_id):
+        return f"{DYNAMO_URL}/v2022q2/teams/{TENANT_ID}/tests?athleteId={profile_id}&includeRepSummaries=false&includeReps=false"
+
+    # -----------------------------------------------------------------------------
+    # Token and retry policy
+    # -----------------------------------------------------------------------------
+    def get_token(self, force_refresh=False, rejected_token=None):
+        """
+        Return an access token from the provider.
+
+        The provider holds the token in memory and renews it, so it is asked on every
+        request; after a 401 the rejected token is passed along so concurrent 401s
+        share one refresh.
+        """
+        if force_refresh:
+            return self.token_provider(force_refresh=True, rejected_token=rejected_token)
+        return self.token_provider()
+
+    def _headers(self, token):
+        return {"Authorization": f"Bearer {token}"}
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """Exponential backoff with jitter; a server Retry-After always wins."""
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+        base = BACKOFF_BASE * (2 ** attempt)
+        return min(base + random.uniform(0, 0.1 * base), BACKOFF_MAX)
+
+    # -----------------------------------------------------------------------------
+    # Synchronous face
+    # -----------------------------------------------------------------------------
+    def get(self, url, token=None, read_timeout=None):
+        """
+        GET a VALD endpoint over the pooled session.
+
+        Every attempt is bounded by the connect timeout and read_timeout (defaults to
+        the client's), so a stalled request fails in the calling thread rather than
+        needing a watchdog thread around it. Every attempt takes a slot from the shared rate limiter and reports its status
+        back to it. 429s are re-queued behind the limiter (which honours Retry-After);
+        5xx and connection errors are retried with backoff. When no
+        token is passed the provider's token is used and refreshed once on a 401;
+        an explicit token is used as-is so callers keep control of their own refresh.
+
+        Returns:
+            The final requests.Response (callers branch on status_code as before)
+        """
+        use_provider = token is None
+        refreshed = False
+        attempt = 0
+        while True:
+            request_token = self.get_token() if use_provider else token
+            self.rate_limiter.acquire()
+            try:
+                response = self._session.get(url, headers=self._headers(request_token),
+                                             timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error, response = e, None
+            finally:
+                self.rate_limiter.release()
+
+            if response is None:
+                if attempt >= self.max_retries - 1:
+                    raise error
+                wait_time = self._retry_delay(attempt)
+                log.warning(f"{type(error).__name__} for {url}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{self.max_retries})")
+                time.sleep(wait_time)
+                attempt += 1
+                continue
+
+            retry_after = response.headers.get("Retry-After")
+            self.rate_limiter.on_response(response.status_code, retry_after)
+            if response.status_code == 401 and use_provider and not refreshed:
+                log.warning(f"401 Unauthorized for {url}, refreshing token and retrying...")
+                self.get_token(force_refresh=True, rejected_token=request_token)
+                refreshed = True
+                continue
+            if response.status_code == 429 and attempt < self.max_retries - 1:
+                # The shared limiter has already paused for Retry-After; queue up again behind it
+                log.warning(f"429 for {url}. Re-queued behind the rate limiter (attempt {attempt + 1}/{self.max_retries})")
+                attempt += 1
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries - 1:
+                wait_time = self._retry_delay(attempt, retry_after)
+                log.warning(f"{response.status_code} for {url}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{self.max_retries})")
+                time.sleep(wait_time)
+                attempt += 1
+                continue
+            return response
+
+    def get_json(self, url, token=None):
+        """GET and decode JSON. Returns (status, body); body is None unless status is 200."""
+        response = self.get(url, token=token)
+        if response.status_code == 200:
+            return response.status_code, response.json()
+        return response.status_code, None
+
+    def get_trials(self, test_id, token=None, modified_date=None, read_timeout=None):
+        """
+        Read the raw trials JSON for one test through the trial cache.
+
+        Args:
+            test_id: VALD testId
+            token: Optional explicit access token (see get())
+            modified_date: The test's modifiedDateUtc, used to spot stale cache entries (without it
+                the cache is bypassed and the response re-cached)
+            read_timeout: Per-attempt read timeout in seconds (see get())
+
+        Returns:
+            (status, body): (200, trial list) or (204, None)
+
+        Raises:
+            requests.exceptions.HTTPError: For any other status, with the response attached
+        """
+        cached = self.trial_cache.get(test_id, modified_date)
+        if cached is not None:
+            return cached
+        response = self.get(self.trials_url(test_id), token=token, read_timeout=read_timeout)
+        if response.status_code not in CACHEABLE_STATUSES:
+            response.raise_for_status()
+            raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+        body = response.json() if response.status_code == 200 else None
+        self.trial_cache.put(test_id, response.status_code, body, modified_date)
+        return response.status_code, body
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # -----------------------------------------------------------------------------
+    # Asynchronous face
+    # -----------------------------------------------------------------------------
+    def async_session(self):
+        """Return the pooled aiohttp session, creating it inside the running event loop."""
+        if self._async_session is None or self._async_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._async_session
+
+    async def _off_loop(self, func, *args, **kwargs):
+        """Run a blocking call (token provider, trial cache) in the default executor so the event loop keeps serving."""
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+    async def get_json_async(self, url, token=None):
+        """
+        Async GET with the same token and retry policy as get().
+
+        Returns:
+            (status, body) where body is the decoded JSON for a 200 and None otherwise
+        """
+        session = self.async_session()
+        use_provider = token is None
+        refreshed = False
+        attempt = 0
+        while True:
+            request_token = await self._off_loop(self.get_token) if use_provider else token
+            await self.rate_limiter.acquire_async()
+            try:
+                async with session.get(url, headers=self._headers(request_token)) as response:
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    body = await response.json(content_type=None) if status == 200 else None
+                error = None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                self.rate_limiter.release()
+
+            if error is not None:
+                if attempt >= self.max_retries - 1:
+                    raise error
+                wait_time = self._retry_delay(attempt)
+                log.warning(f"{type(error).__name__} for {url}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(wait_time)
+                attempt += 1
+                continue
+
+            self.rate_limiter.on_response(status, retry_after)
+            if status == 401 and use_provider and not refreshed:
+                log.warning(f"401 Unauthorized for {url}, refreshing token and retrying...")
+                await self._off_loop(self.get_token, force_refresh=True, rejected_token=request_token)
+                refreshed = True
+                continue
+            if status == 429 and attempt < self.max_retries - 1:
+                # The shared limiter has already paused for Retry-After; queue up again behind it
+                log.warning(f"429 for {url}. Re-queued behind the rate limiter (attempt {attempt + 1}/{self.max_retries})")
+                attempt += 1
+                continue
+            if status in RETRY_STATUSES and attempt < self.max_retries - 1:
+                wait_time = self._retry_delay(attempt, retry_after)
+                log.warning(f"{status} for {url}. Retrying in {wait_time:.2f}s... (attempt {attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(wait_time)
+                attempt += 1
+                continue
+            return status, body
+
+    async def get_trials_async(self, test_id, token=None, modified_date=None):
+        """Async get_trials(): read one test's raw trials JSON through the trial cache. Returns (status, body)."""
+        cached = await self._off_loop(self.trial_cache.get, test_id, modified_date)
+        if cached is not None:
+            return cached
+        status, body = await self.get_json_async(self.trials_url(test_id), token=token)
+        if status in CACHEABLE_STATUSES:
+            await self._off_loop(self.trial_cache.put, test_id, status, body, modified_date)
+        return status, body
+
+    async def aclose(self):
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+
+    async def __aenter__(self):
+        self.async_session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+# =================================================================================
+# Process-wide shared client
+# =================================================================================
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide VALDClient, creating it on first use."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = VALDClient()
+        return _default_client
@@ -0,0 +1,83 @@
+"""
+Registry of the test sessions a pipeline run is working through, keyed by testId.
+Each entry carries the athlete row, the test row and a processing status, so fetch
+tasks hand their entry straight back to the result loop (no scan over every session
+to find which athlete a result belongs to) and the run can report or retry by status.
+"""
+
+from collections import Counter
+
+# Entry statuses
+PENDING = "pending"  # Listed, not fetched yet
+DONE = "done"  # Record built
+SKIPPED = "skipped"  # Fetched, but no trials or no usable metrics
+FAILED = "failed"  # Fetch failed; retry next run
+
+
+class WorkEntry:
+    """One test session: who it belongs to, its metadata, and where it is in the run."""
+
+    __slots__ = ("test_id", "athlete", "test", "status", "error")
+
+    def __init__(self, athlete, test):
+        self.test_id = test['testId']
+        self.athlete = athlete
+        self.test = test
+        self.status = PENDING
+        self.error = None
+
+    @property
+    def modified_date(self):
+        return self.test['modifiedDateUtc']
+
+    def __repr__(self):
+        return f"WorkEntry({self.test_id!r}, status={self.status!r})"
+
+
+class WorkRegistry:
+    """Insertion-ordered {testId: WorkEntry} with O(1) lookup and status bookkeeping."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def add(self, athlete, test):
+        """Register a test session (a re-listed testId replaces the earlier entry) and return its entry."""
+        entry = WorkEntry(athlete, test)
+        self._entries[entry.test_id] = entry
+        return entry
+
+    def get(self, test_id):
+        return self._entries.get(test_id)
+
+    def __getitem__(self, test_id):
+        return self._entries[test_id]
+
+    def __contains__(self, test_id):
+        return test_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def entries(self):
+        """Entries as a list, in the order they were registered."""
+        return list(self._entries.values())
+
+    def mark(self, test_id, status, error=None):
+        entry = self._entries[test_id]
+        entry.status = status
+        entry.error = error
+        return entry
+
+    def with_status(self, status):
+        return [entry for entry in self._entries.values() if entry.status == status]
+
+    def failed_ids(self):
+        """testIds whose fetch failed, for the watermark store."""
+        return {entry.test_id for entry in self._entries.values() if entry.status == FAILED}
+
+    def summary(self):
+        """Count of entries per status, e.g. {'done': 120, 'skipped': 4}."""
+        return dict(Counter(entry.status for entry in self._entries.values()))